@@ -1,5 +1,6 @@
 import numpy as np
-from .dragfilter import DragFilter
+from .dragfilter import DragFilter, Fd, Qd, predict
+from .filterstate import FilterCheckpoint
 from .IMM import IMMEstimator
 from scipy.linalg import expm
 import numba
@@ -26,12 +27,15 @@ def get_filter(force, drag):
     return lambda: DragFilter(force, drag, np.copy(m0), np.copy(S0))
 
 # Median matched to speeds
-filters = {
-    'still': get_filter(0.5, 1.0),
-    'walking': get_filter(2.0, 0.6),
-    'cycling': get_filter(3.0, 0.06),
-    'driving': get_filter(3.5, 0.008),
+filter_params = {
+    'still': (0.5, 1.0),
+    'walking': (2.0, 0.6),
+    'cycling': (3.0, 0.06),
+    'driving': (3.5, 0.008),
 }
+filters = {mode: get_filter(force, drag) for mode, (force, drag) in filter_params.items()}
+filter_forces = np.array([force for force, _ in filter_params.values()])
+filter_drags = np.array([drag for _, drag in filter_params.values()])
 
 # Just some stetson-harrisons
 """
@@ -56,7 +60,392 @@ mean_state_duration = 5*60
 transition_rate = np.zeros((N_states, N_states)) + (1/mean_state_duration)/(N_states - 1)
 transition_rate[np.diag_indices(N_states)] = -1/mean_state_duration
 
+# Max. time step for the Kalman filter prediction (same as in DragFilter)
+MAX_PREDICT_DT = 300.0
+VEHICLE_GIS_PROB_FACTOR = 2
+
+
+@numba.njit(cache=True)
+def transition_matrix(dt, n_states, switch_rate):
+    """expm(transition_rate*dt) in closed form.
+
+    The rate matrix is switch_rate*(ones - n_states*I), whose exponential is
+    exp(-n*r*dt)*I + (1 - exp(-n*r*dt))/n*ones.
+    """
+    decay = np.exp(-n_states*switch_rate*dt)
+    M = np.full((n_states, n_states), (1 - decay)/n_states)
+    for i in range(n_states):
+        M[i, i] += decay
+    return M
+
+
+@numba.njit(cache=True)
+def safelog(x):
+    return np.log(np.maximum(x, 1e-9))
+
+
+@numba.njit(cache=True)
+def _viterbi_forward(log_probs, emissions, dts, switch_rate, back):
+    """Advance the Viterbi path scores `log_probs` in place over `emissions`.
+
+    dts[k] is the time from the previous sample to sample k. The
+    back-pointers are written to `back`.
+    """
+    n, n_states = emissions.shape
+    new_probs = np.empty(n_states)
+    for k in range(n):
+        emission = emissions[k]
+        total_prob = np.sum(emission)
+        if total_prob > 1e-9:
+            log_emission = safelog(emission/total_prob)
+        else:
+            log_emission = np.full(n_states, np.log(1/n_states))
+        log_trans = safelog(transition_matrix(dts[k], n_states, switch_rate))
+        for j in range(n_states):
+            best = -np.inf
+            best_i = 0
+            for i in range(n_states):
+                p = log_probs[i] + log_trans[i, j]
+                if p > best:
+                    best = p
+                    best_i = i
+            back[k, j] = best_i
+            new_probs[j] = log_emission[j] + best
+        log_probs[:] = new_probs
+
+
+@numba.njit(cache=True)
+def _viterbi_backtrack(back, log_probs):
+    n = len(back)
+    path = np.empty(n, dtype=np.int64)
+    if n == 0:
+        return path
+    path[n - 1] = np.argmax(log_probs)
+    for k in range(n - 1, 0, -1):
+        path[k - 1] = back[k, path[k]]
+    return path
+
+
+@numba.njit(cache=True)
+def _viterbi_start(initial_probs, emissions, dts, switch_rate, log_probs, back):
+    # The first sample has no transition
+    log_probs[:] = safelog(emissions[0]) + safelog(initial_probs)
+    back[0] = 0
+    _viterbi_forward(log_probs, emissions[1:], dts[1:], switch_rate, back[1:])
+
+
+@numba.njit(cache=True)
+def viterbi(initial_probs, emissions, dts, switch_rate):
+    """Most likely mode sequence given the IMM state probabilities.
+
+    The transition probabilities between samples are computed from the
+    time steps `dts` (dts[k] is the time from sample k-1 to k). Returns the
+    path and its log-likelihood.
+    """
+    n, n_states = emissions.shape
+    if n == 0:
+        return np.empty(0, dtype=np.int64), 0.0
+    back = np.empty((n, n_states), dtype=np.int64)
+    log_probs = np.empty(n_states)
+    _viterbi_start(initial_probs, emissions, dts, switch_rate, log_probs, back)
+    path = _viterbi_backtrack(back, log_probs)
+    return path, log_probs[path[n - 1]]
+
+
+def initial_imm_state(n_states=N_states):
+    """Return the filter means and covariances, mu, omega and cbar before the first sample."""
+    xs = np.tile(m0, (n_states, 1))
+    Ps = np.tile(S0, (n_states, 1, 1))
+    mu = np.full(n_states, 1.0/n_states)
+    # Mixing as computed with an identity transition matrix
+    omega = np.eye(n_states)
+    cbar = mu.copy()
+    return xs, Ps, mu, omega, cbar
+
+
+@numba.njit(cache=True)
+def _imm_filter(
+    time, x, y, location_std, atype, aconf, vehicle_way_distance, forces, drags, switch_rate,
+    xs, Ps, mu, omega, cbar, prev_time,
+):
+    """Run the IMM filter over the samples.
+
+    The filter state (xs, Ps, mu, omega, cbar) is updated in place, so it
+    can be used to continue with later samples. `prev_time` is the time of
+    the sample before time[0], or NaN if there is none.
+    """
+    n = len(time)
+    n_states = len(forces)
+    float_eps = np.finfo(np.float64).eps
+    log2pi = np.log(2*np.pi)
+
+    ms = np.empty((n, 4))
+    Ss = np.empty((n, 4, 4))
+    state_probs = np.empty((n, n_states))
+    likelihood = np.empty(n_states)
+    mixed_xs = np.empty((n_states, 4))
+    mixed_Ps = np.empty((n_states, 4, 4))
+    total_loglikelihood = 0.0
+
+    if np.isnan(prev_time) and n:
+        prev_time = time[0]
+    for k in range(n):
+        dt = time[k] - prev_time
+        prev_time = time[k]
+        M = transition_matrix(dt, n_states, switch_rate)
+
+        # IMM predict: mix the filter states and propagate each filter
+        for j in range(n_states):
+            mixed_xs[j] = 0.0
+            for i in range(n_states):
+                mixed_xs[j] += omega[i, j]*xs[i]
+            mixed_Ps[j] = 0.0
+            for i in range(n_states):
+                d = xs[i] - mixed_xs[j]
+                mixed_Ps[j] += omega[i, j]*(np.outer(d, d) + Ps[i])
+        pdt = min(dt, MAX_PREDICT_DT)
+        for j in range(n_states):
+            xs[j], Ps[j] = predict(
+                pdt, mixed_xs[j], mixed_Ps[j], Fd(pdt, forces[j], drags[j]), Qd(pdt, forces[j], drags[j])
+            )
+
+        r = location_std[k]
+        if r <= 0:
+            r = 100.0
+        r2 = r*r
+
+        # Kalman update of each filter with closed-form 2x2 innovation
+        # covariance inverse and likelihood
+        z0 = x[k]
+        z1 = y[k]
+        for j in range(n_states):
+            P = Ps[j]
+            a = P[0, 0] + r2
+            b = P[0, 1]
+            c = P[1, 0]
+            d = P[1, 1] + r2
+            res0 = z0 - xs[j, 0]
+            res1 = z1 - xs[j, 1]
+
+            # The likelihood uses the lower triangle like np.linalg.eigh
+            det = a*d - c*c
+            maha = (d*res0*res0 - 2*c*res0*res1 + a*res1*res1)/det
+            lik = np.exp(-0.5*(2*log2pi + maha + np.log(det)))
+            likelihood[j] = max(lik, float_eps)
+
+            inv_det = 1.0/(a*d - b*c)
+            Sinv = np.array([[d*inv_det, -b*inv_det], [-c*inv_det, a*inv_det]])
+            K = np.ascontiguousarray(P[:, :2]) @ Sinv
+            xs[j] = xs[j] + K @ np.array([res0, res1])
+            I_KH = np.eye(4)
+            I_KH[:, :2] -= K
+            Ps[j] = I_KH @ P @ I_KH.T + r2*(K @ K.T)
+
+        # External estimates of the mode probabilities
+        state_prob_ests = np.ones(n_states)
+        if atype[k] >= 0:
+            state_prob_ests[:] = (1 - aconf[k])/(n_states - 1)
+            state_prob_ests[atype[k]] = aconf[k]
+        if vehicle_way_distance[k] < 2*location_std[k]:
+            state_prob_ests[-1] *= VEHICLE_GIS_PROB_FACTOR
+        else:
+            state_prob_ests[-1] /= VEHICLE_GIS_PROB_FACTOR
+        state_prob_ests /= np.sum(state_prob_ests)
+
+        # IMM update of the mode probabilities and mixing
+        cbar *= state_prob_ests
+        mu[:] = cbar*likelihood
+        weighted_likelihood = np.sum(mu)
+        mu /= weighted_likelihood
+        total_loglikelihood += np.log(weighted_likelihood)
+
+        cbar[:] = mu @ M
+        for i in range(n_states):
+            for j in range(n_states):
+                omega[i, j] = (M[i, j]*mu[i])/cbar[j]
+
+        m = np.zeros(4)
+        for j in range(n_states):
+            m += mu[j]*xs[j]
+        S = np.zeros((4, 4))
+        for j in range(n_states):
+            d = xs[j] - m
+            S += mu[j]*(np.outer(d, d) + Ps[j])
+        ms[k] = m
+        Ss[k] = S
+        state_probs[k] = mu
+
+    return ms, Ss, state_probs, total_loglikelihood
+
+
+def _as_float(a):
+    return np.ascontiguousarray(a, dtype=np.float64)
+
+
+def _as_int(a):
+    return np.ascontiguousarray(a, dtype=np.int64)
+
+
+def filter_trajectory_arrays(time, x, y, location_std, atype, aconf, vehicle_way_distance):
+    """Array version of filter_trajectory().
+
+    `atype` is an index to `filters` (-1 if unknown). Returns the same
+    values as filter_trajectory().
+    """
+    ms, Ss, state_probs, total_loglikelihood = _imm_filter(
+        _as_float(time), _as_float(x), _as_float(y), _as_float(location_std), _as_int(atype),
+        _as_float(aconf), _as_float(vehicle_way_distance), filter_forces, filter_drags, transition_rate[0, 1],
+        *initial_imm_state(), np.nan,
+    )
+    initial_state_probs = np.ones(N_states)/N_states
+    dts = np.diff(np.asarray(time, dtype=np.float64), prepend=np.nan)
+    most_likely_path, _ = viterbi(initial_state_probs, state_probs, dts, transition_rate[0, 1])
+    return ms, Ss, state_probs, most_likely_path, total_loglikelihood
+
+
+def filter_trajectory_resume(checkpoint, time, x, y, location_std, atype, aconf, vehicle_way_distance):
+    """Filter the samples following `checkpoint` and return a new checkpoint.
+
+    If `checkpoint` is None, the samples are the start of a trajectory. The
+    results for the whole trajectory are in the returned checkpoint; use
+    checkpoint_path() for the most likely mode path.
+    """
+    time = _as_float(time)
+    n = len(time)
+    if checkpoint is None:
+        state = initial_imm_state()
+        prev_time = np.nan
+    else:
+        state = tuple(np.array(a) for a in (
+            checkpoint.xs, checkpoint.Ps, checkpoint.mu, checkpoint.omega, checkpoint.cbar
+        ))
+        prev_time = float(checkpoint.time[-1])
+    ms, Ss, state_probs, loglikelihood = _imm_filter(
+        time, _as_float(x), _as_float(y), _as_float(location_std), _as_int(atype),
+        _as_float(aconf), _as_float(vehicle_way_distance), filter_forces, filter_drags, transition_rate[0, 1],
+        *state, prev_time,
+    )
+
+    dts = np.diff(time, prepend=prev_time)
+    back = np.zeros((n, N_states), dtype=np.int64)
+    if checkpoint is None:
+        log_probs = np.empty(N_states)
+        if n:
+            _viterbi_start(np.ones(N_states)/N_states, state_probs, dts, transition_rate[0, 1], log_probs, back)
+    else:
+        log_probs = np.array(checkpoint.log_probs)
+        _viterbi_forward(log_probs, state_probs, dts, transition_rate[0, 1], back)
+        time = np.concatenate([checkpoint.time, time])
+        ms = np.concatenate([checkpoint.xy, ms[:, :2]])
+        state_probs = np.concatenate([checkpoint.state_probs, state_probs])
+        back = np.concatenate([checkpoint.backpointers, back])
+        loglikelihood += checkpoint.loglikelihood
+
+    xs, Ps, mu, omega, cbar = state
+    return FilterCheckpoint(
+        time=time, xy=np.ascontiguousarray(ms[:, :2]), state_probs=state_probs,
+        backpointers=back.astype(np.int8), log_probs=log_probs,
+        xs=xs, Ps=Ps, mu=mu, omega=omega, cbar=cbar, loglikelihood=loglikelihood,
+    )
+
+
+def checkpoint_path(checkpoint):
+    """Return the most likely mode path of the samples covered by `checkpoint`."""
+    return _viterbi_backtrack(checkpoint.backpointers.astype(np.int64), checkpoint.log_probs)
+
+
+@numba.njit(cache=True, parallel=True)
+def _imm_filter_batch(
+    offsets, time, x, y, location_std, atype, aconf, vehicle_way_distance, forces, drags, switch_rate
+):
+    n = len(time)
+    n_trips = len(offsets) - 1
+    n_states = len(forces)
+    ms = np.empty((n, 4))
+    Ss = np.empty((n, 4, 4))
+    state_probs = np.empty((n, n_states))
+    paths = np.empty(n, dtype=np.int64)
+    back = np.zeros((n, n_states), dtype=np.int64)
+    loglikelihoods = np.empty(n_trips)
+    # Final filter and Viterbi states of each trajectory
+    final_xs = np.empty((n_trips, n_states, 4))
+    final_Ps = np.empty((n_trips, n_states, 4, 4))
+    final_mu = np.empty((n_trips, n_states))
+    final_omega = np.empty((n_trips, n_states, n_states))
+    final_cbar = np.empty((n_trips, n_states))
+    final_log_probs = np.zeros((n_trips, n_states))
+    initial_state_probs = np.full(n_states, 1.0/n_states)
+
+    for t in numba.prange(n_trips):
+        start = offsets[t]
+        end = offsets[t + 1]
+        for j in range(n_states):
+            final_xs[t, j] = m0
+            final_Ps[t, j] = S0
+        final_mu[t] = 1.0/n_states
+        final_omega[t] = np.eye(n_states)
+        final_cbar[t] = final_mu[t]
+        trip_ms, trip_Ss, trip_state_probs, loglikelihood = _imm_filter(
+            time[start:end], x[start:end], y[start:end], location_std[start:end], atype[start:end],
+            aconf[start:end], vehicle_way_distance[start:end], forces, drags, switch_rate,
+            final_xs[t], final_Ps[t], final_mu[t], final_omega[t], final_cbar[t], np.nan,
+        )
+        if end > start:
+            dts = np.empty(end - start)
+            dts[0] = np.nan
+            dts[1:] = time[start + 1:end] - time[start:end - 1]
+            _viterbi_start(
+                initial_state_probs, trip_state_probs, dts, switch_rate, final_log_probs[t], back[start:end]
+            )
+            paths[start:end] = _viterbi_backtrack(back[start:end], final_log_probs[t])
+        ms[start:end] = trip_ms
+        Ss[start:end] = trip_Ss
+        state_probs[start:end] = trip_state_probs
+        loglikelihoods[t] = loglikelihood
+
+    return (
+        ms, Ss, state_probs, paths, loglikelihoods,
+        back, final_xs, final_Ps, final_mu, final_omega, final_cbar, final_log_probs,
+    )
+
+
+def filter_trajectories(
+    offsets, time, x, y, location_std, atype, aconf, vehicle_way_distance, return_checkpoints=False
+):
+    """Filter many trajectories in one call, in parallel.
+
+    The samples of all trajectories are concatenated; trajectory i is
+    samples offsets[i]:offsets[i + 1]. Returns the per-sample results of
+    filter_trajectory_arrays() concatenated in the same way, and the total
+    log-likelihood of each trajectory. With `return_checkpoints`, a list of
+    FilterCheckpoint objects (one per trajectory) is returned as well.
+    """
+    offsets = _as_int(offsets)
+    time = _as_float(time)
+    (
+        ms, Ss, state_probs, paths, loglikelihoods,
+        back, final_xs, final_Ps, final_mu, final_omega, final_cbar, final_log_probs,
+    ) = _imm_filter_batch(
+        offsets, time, _as_float(x), _as_float(y), _as_float(location_std), _as_int(atype),
+        _as_float(aconf), _as_float(vehicle_way_distance), filter_forces, filter_drags, transition_rate[0, 1],
+    )
+    if not return_checkpoints:
+        return ms, Ss, state_probs, paths, loglikelihoods
+
+    checkpoints = []
+    for t in range(len(offsets) - 1):
+        s = slice(offsets[t], offsets[t + 1])
+        checkpoints.append(FilterCheckpoint(
+            time=time[s].copy(), xy=ms[s, :2].copy(), state_probs=state_probs[s].copy(),
+            backpointers=back[s].astype(np.int8), log_probs=final_log_probs[t],
+            xs=final_xs[t], Ps=final_Ps[t], mu=final_mu[t], omega=final_omega[t], cbar=final_cbar[t],
+            loglikelihood=float(loglikelihoods[t]),
+        ))
+    return ms, Ss, state_probs, paths, loglikelihoods, checkpoints
+
+
 def filter_trajectory(traj):
+    """Reference implementation of the IMM filter; see filter_trajectory_arrays()."""
     # TODO: Smoothing!
     filts = [f() for f in filters.values()]
     # TODO: Could use some global average. Probably doesn't matter
@@ -64,21 +453,14 @@ def filter_trajectory(traj):
     state_probs /= np.sum(state_probs)
 
     initial_state_probs = np.copy(state_probs)
-    # The trellis with a less confusing name.
-    # Note that state_probs is different from path_probs.
-    # The latter refers to sort of "maximum likelihood attainable by selecting
-    # this state at this step". More or less standard Viterbi, but with the
-    # IMM observation probs. Breaking quite a few assumptions here probably, so
-    # not strictly optimal but probably works relatively well; IMM breaks them all already anyway.
-    path_probs = np.copy(state_probs)
-    most_likely_transitions = []
-    
+
     imm = IMMEstimator(filts, state_probs)
     #imm = filts[-1] # HACK!
     
     ms = []
     Ss = []
     state_probs = []
+    dts = []
 
     prev_time = None
     for z in traj:
@@ -86,6 +468,7 @@ def filter_trajectory(traj):
             prev_time = z.time
         dt = z.time - prev_time
         prev_time = z.time
+        dts.append(dt)
         # The transition matrix for this timestep. For some reason FilterPy has
         # this in the update step. I think it would be more logical in the prediction
         # step as this can be computed without any measurements. TODO: Verify FilterPy
@@ -144,77 +527,10 @@ def filter_trajectory(traj):
         Ss.append(np.copy(imm.P))
         state_probs.append(np.copy(imm.mu))
 
-        # Compute the most likely path stuff
-        path_probs_new = np.empty_like(path_probs)
-        new_transitions = []
-        for new_mode_i in range(N_states):
-            best_prev_i = None
-            best_new_prob = -1
-            for prev_mode_i in range(len(filters)):
-                obs_lik = filts[new_mode_i].likelihood
-                new_prob = path_probs[prev_mode_i]*obs_lik*M[prev_mode_i,new_mode_i]
-                if new_prob > best_new_prob:
-                    best_new_prob = new_prob
-                    best_prev_i = prev_mode_i
-            path_probs_new[new_mode_i] = best_new_prob
-            new_transitions.append(best_prev_i)
-        path_probs = path_probs_new
-        path_probs /= np.sum(path_probs)
-        most_likely_transitions.append(new_transitions)
-    
-    state_probs = np.array(state_probs)
+    state_probs = np.array(state_probs).reshape(-1, N_states)
 
-    most_likely_state = np.argmax(path_probs)
-    most_likely_path = [most_likely_state]
-    for states in most_likely_transitions[::-1]:
-        most_likely_state = states[most_likely_state]
-        most_likely_path.append(most_likely_state)
-    
-    # TODO FIXME: This seems to be broken ATM! Fix or remove the duplicate viterbi-attempt
-    most_likely_path = most_likely_path[::-1][1:]
+    # "Most likely path decoding" with the IMM state probs as emissions.
+    # Theoretically not quite right, but works well enough in practice.
+    most_likely_path, _ = viterbi(initial_state_probs, state_probs, np.array(dts, dtype=float), transition_rate[0, 1])
 
-    # TODO FIXME: Temporary hack as the viterbi is a bit buggy ATM
-    #most_likely_path = np.argmax(state_probs, axis=1)
-    
-    # TODO FIXME: Hack to do "most likely path decoding" with IMM state probs. Theoretically HIDEOUS!
-    # TODO FIXME: Known to cause problems that time-variant transition probs will fix easily!
-    HACK_FIXED_DT_TRANSITIONS = expm(transition_rate*5)
-    most_likely_path = viterbi(initial_state_probs, HACK_FIXED_DT_TRANSITIONS, state_probs)
-    most_likely_path = np.array(most_likely_path)
-    
     return np.array(ms), np.array(Ss), state_probs, most_likely_path, imm.total_loglikelihood
-
-
-def safelog(x):
-    return np.log(np.clip(x, 1e-9, None))
-
-def viterbi(initial_probs, transition_probs, emissions):
-    # TODO: Online mode
-    # TODO: Variable dt transitions!!
-    n_states = len(initial_probs)
-    emissions = iter(emissions)
-    emission = next(emissions)
-    transition_probs = safelog(transition_probs)
-    probs = safelog(emission) + safelog(initial_probs)
-    state_stack = []
-    
-    for i, emission in enumerate(emissions):
-        total_prob = np.sum(emission)
-        if total_prob > 1e-9:
-            emission /= total_prob
-        else:
-            emission[:] = 1/len(emission)
-        trans_probs = transition_probs + np.row_stack(probs)
-        most_likely_states = np.argmax(trans_probs, axis=0)
-        probs = safelog(emission) + trans_probs[most_likely_states, np.arange(n_states)]
-        state_stack.append(most_likely_states)
-    
-    state_seq = [np.argmax(probs)]
-
-    while state_stack:
-        most_likely_states = state_stack.pop()
-        state_seq.append(most_likely_states[state_seq[-1]])
-
-    state_seq.reverse()
-
-    return state_seq
@@ -0,0 +1,63 @@
+"""Checkpoints of the IMM trajectory filter.
+
+A checkpoint holds everything needed to continue filtering a trajectory
+after its last filtered sample: the per-mode filter states, the IMM mixing
+state and the Viterbi scores. It also keeps the per-sample outputs and
+Viterbi back-pointers of the samples filtered so far, so that the results
+for the whole trajectory can be produced without filtering it again.
+"""
+import io
+from dataclasses import dataclass, fields
+
+import numpy as np
+
+
+@dataclass
+class FilterCheckpoint:
+    # Per-sample
+    time: np.ndarray  # (n,) seconds since the Unix epoch
+    xy: np.ndarray  # (n, 2) filtered location
+    state_probs: np.ndarray  # (n, n_states) IMM mode probabilities
+    backpointers: np.ndarray  # (n, n_states) Viterbi back-pointers
+    # State after the last sample
+    log_probs: np.ndarray  # (n_states,) Viterbi path scores
+    xs: np.ndarray  # (n_states, 4) filter means
+    Ps: np.ndarray  # (n_states, 4, 4) filter covariances
+    mu: np.ndarray  # (n_states,)
+    omega: np.ndarray  # (n_states, n_states)
+    cbar: np.ndarray  # (n_states,)
+    loglikelihood: float
+
+    def __len__(self):
+        return len(self.time)
+
+    @property
+    def start_time(self) -> float:
+        return float(self.time[0])
+
+    def covers(self, time) -> bool:
+        """Return True if the checkpoint was taken from the first samples of `time`."""
+        n = len(self.time)
+        return 0 < n <= len(time) and np.array_equal(np.asarray(time[:n], dtype=np.float64), self.time)
+
+
+def pack_checkpoints(checkpoints) -> bytes:
+    arrays = {}
+    for i, cp in enumerate(checkpoints):
+        for f in fields(FilterCheckpoint):
+            arrays['%d_%s' % (i, f.name)] = np.asarray(getattr(cp, f.name))
+    out = io.BytesIO()
+    np.savez_compressed(out, **arrays)
+    return out.getvalue()
+
+
+def unpack_checkpoints(data: bytes):
+    with np.load(io.BytesIO(bytes(data)), allow_pickle=False) as npz:
+        arrays = {name: npz[name] for name in npz.files}
+    count = len([name for name in arrays if name.endswith('_time')])
+    checkpoints = []
+    for i in range(count):
+        kwargs = {f.name: arrays['%d_%s' % (i, f.name)] for f in fields(FilterCheckpoint)}
+        kwargs['loglikelihood'] = float(kwargs['loglikelihood'])
+        checkpoints.append(FilterCheckpoint(**kwargs))
+    return checkpoints
@@ -0,0 +1,244 @@
+"""Read and write typed arrays with binary COPY.
+
+The result of `COPY (<query>) TO STDOUT (FORMAT binary)` is scanned once to
+find the fields of each tuple and the fixed-width columns are then decoded
+with vectorized gathers straight into NumPy arrays of the requested type.
+Only text columns go through Python objects.
+
+For writing, the columns are packed into one structured array that has the
+layout of the binary COPY tuples, so no per-row Python code is run.
+
+The SQL expressions of the columns must produce exactly the PostgreSQL type
+given in the schema (cast them explicitly), and the target columns of a
+write must have exactly the given types, as binary COPY does no conversions.
+"""
+import io
+
+import numba
+import numpy as np
+import pandas as pd
+
+
+SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+TIMESTAMPTZ = 'timestamptz'
+FLOAT8 = 'float8'
+FLOAT4 = 'float4'
+INT8 = 'int8'
+INT4 = 'int4'
+INT2 = 'int2'
+BOOL = 'bool'
+TEXT = 'text'
+# Preformatted fixed-width field values, e.g. EWKB points for geometry columns
+RAW = 'raw'
+
+# Big-endian wire types of the fixed-width columns
+WIRE_DTYPES = {
+    TIMESTAMPTZ: '>i8',
+    FLOAT8: '>f8',
+    FLOAT4: '>f4',
+    INT8: '>i8',
+    INT4: '>i4',
+    INT2: '>i2',
+    BOOL: 'u1',
+}
+
+# PostgreSQL timestamps are microseconds since 2000-01-01 UTC
+PG_EPOCH_NS = 946684800 * 10**9
+
+# Little-endian EWKB point with an SRID: byte order, type, SRID, x, y
+EWKB_POINT_DTYPE = np.dtype([
+    ('byte_order', 'u1'), ('type', '<u4'), ('srid', '<u4'), ('x', '<f8'), ('y', '<f8')
+])
+EWKB_POINT_WITH_SRID = 0x20000001
+
+
+class CopyFormatError(Exception):
+    pass
+
+
+@numba.njit(cache=True)
+def _read_int32(buf, pos):
+    val = (
+        (np.int64(buf[pos]) << 24) | (np.int64(buf[pos + 1]) << 16)
+        | (np.int64(buf[pos + 2]) << 8) | np.int64(buf[pos + 3])
+    )
+    if val >= 2**31:
+        val -= 2**32
+    return val
+
+
+@numba.njit(cache=True)
+def _count_tuples(buf, pos, n_fields):
+    n = 0
+    while True:
+        field_count = (np.int64(buf[pos]) << 8) | np.int64(buf[pos + 1])
+        if field_count == 0xFFFF:
+            return n
+        if field_count != n_fields:
+            return -1
+        pos += 2
+        for j in range(n_fields):
+            length = _read_int32(buf, pos)
+            pos += 4
+            if length > 0:
+                pos += length
+        n += 1
+
+
+@numba.njit(cache=True)
+def _scan_tuples(buf, pos, n_rows, n_fields):
+    offsets = np.zeros((n_fields, n_rows), dtype=np.int64)
+    lengths = np.zeros((n_fields, n_rows), dtype=np.int32)
+    for i in range(n_rows):
+        pos += 2
+        for j in range(n_fields):
+            length = _read_int32(buf, pos)
+            pos += 4
+            lengths[j, i] = length
+            if length > 0:
+                offsets[j, i] = pos
+                pos += length
+    return offsets, lengths
+
+
+def _decode_fixed(buf, offsets, lengths, col_type):
+    dtype = np.dtype(WIRE_DTYPES[col_type])
+    null = lengths < 0
+    if np.any(~null & (lengths != dtype.itemsize)):
+        raise CopyFormatError('unexpected field length for %s column' % col_type)
+    idx = offsets[:, None] + np.arange(dtype.itemsize)
+    vals = buf[idx].view(dtype).ravel().astype(dtype.newbyteorder('='))
+
+    if col_type == TIMESTAMPTZ:
+        ns = vals * 1000 + PG_EPOCH_NS
+        ns[null] = np.iinfo(np.int64).min  # NaT
+        return pd.DatetimeIndex(ns.view('datetime64[ns]')).tz_localize('UTC')
+    if col_type == BOOL:
+        return pd.arrays.BooleanArray(vals.astype(bool), null)
+    if col_type in (FLOAT8, FLOAT4):
+        vals[null] = np.nan
+    else:
+        vals[null] = -1
+    return vals
+
+
+def _decode_text(buf, offsets, lengths):
+    data = buf.tobytes()
+    out = np.empty(len(offsets), dtype=object)
+    for i, (start, length) in enumerate(zip(offsets.tolist(), lengths.tolist())):
+        out[i] = data[start:start + length].decode('utf8') if length >= 0 else None
+    return out
+
+
+def parse_copy_binary(data, columns):
+    """Decode a binary COPY stream into a DataFrame.
+
+    `columns` is a list of (name, type) tuples in the order of the fields.
+    NULLs become NaN or NaT, -1 in integer columns, None in text columns
+    and NA in boolean columns.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if bytes(buf[:len(SIGNATURE)]) != SIGNATURE:
+        raise CopyFormatError('invalid binary COPY signature')
+    pos = len(SIGNATURE) + 4
+    ext_length = int(_read_int32(buf, pos))
+    pos += 4 + ext_length
+
+    n_fields = len(columns)
+    n_rows = _count_tuples(buf, pos, n_fields)
+    if n_rows < 0:
+        raise CopyFormatError('expected %d fields per tuple' % n_fields)
+    offsets, lengths = _scan_tuples(buf, pos, n_rows, n_fields)
+
+    out = {}
+    for j, (name, col_type) in enumerate(columns):
+        if col_type == TEXT:
+            out[name] = _decode_text(buf, offsets[j], lengths[j])
+        else:
+            out[name] = _decode_fixed(buf, offsets[j], lengths[j], col_type)
+    return pd.DataFrame(out, index=pd.RangeIndex(n_rows))
+
+
+def copy_query(conn, query, params, columns):
+    """Run `query` with binary COPY and return the result as a DataFrame.
+
+    `query` must select the columns listed in `columns` (see
+    parse_copy_binary()) in the same order.
+    """
+    out = io.BytesIO()
+    with conn.cursor() as cursor:
+        sql = cursor.mogrify(query, params)
+        if isinstance(sql, bytes):
+            sql = sql.decode('utf8')
+        cursor.copy_expert('COPY (%s) TO STDOUT (FORMAT binary)' % sql, out)
+    return parse_copy_binary(out.getbuffer(), columns)
+
+
+def ewkb_points(x, y, srid):
+    """Return EWKB points for the coordinate arrays as RAW field values."""
+    out = np.empty(len(x), dtype=EWKB_POINT_DTYPE)
+    out['byte_order'] = 1
+    out['type'] = EWKB_POINT_WITH_SRID
+    out['srid'] = srid
+    out['x'] = x
+    out['y'] = y
+    return out.view(np.uint8).reshape(len(x), EWKB_POINT_DTYPE.itemsize)
+
+
+def encode_copy_binary(columns):
+    """Encode columns into a binary COPY stream.
+
+    `columns` is a list of (type, values) tuples. The fixed-width types take
+    1-D arrays (DatetimeIndex or datetime64 for TIMESTAMPTZ) and RAW takes a
+    2-D uint8 array with the field value of each tuple on its own row. NULLs
+    are not supported.
+    """
+    fields = [('field_count', '>i2')]
+    values = []
+    n_rows = None
+    for i, (col_type, vals) in enumerate(columns):
+        if col_type == RAW:
+            vals = np.asarray(vals, dtype=np.uint8)
+            field_dtype = (np.uint8, vals.shape[1])
+        elif col_type == TIMESTAMPTZ:
+            ns = pd.DatetimeIndex(vals).asi8
+            vals = (ns - PG_EPOCH_NS) // 1000
+            field_dtype = WIRE_DTYPES[col_type]
+        elif col_type in WIRE_DTYPES:
+            vals = np.asarray(vals)
+            field_dtype = WIRE_DTYPES[col_type]
+        else:
+            raise CopyFormatError('unsupported column type for writing: %s' % col_type)
+        if n_rows is None:
+            n_rows = len(vals)
+        elif len(vals) != n_rows:
+            raise CopyFormatError('columns have different lengths')
+        fields += [('length%d' % i, '>i4'), ('value%d' % i, field_dtype)]
+        values.append(vals)
+
+    dtype = np.dtype(fields)
+    tuples = np.empty(n_rows or 0, dtype=dtype)
+    tuples['field_count'] = len(columns)
+    for i, vals in enumerate(values):
+        name = 'value%d' % i
+        tuples['length%d' % i] = dtype[name].itemsize
+        tuples[name] = vals
+
+    header = SIGNATURE + np.array([0, 0], dtype='>i4').tobytes()
+    trailer = np.array([-1], dtype='>i2').tobytes()
+    return header + tuples.tobytes() + trailer
+
+
+def copy_insert(conn, table, column_names, columns):
+    """Insert columns of arrays into `table` with binary COPY.
+
+    `columns` are the (type, values) tuples of encode_copy_binary() for the
+    table columns in `column_names`.
+    """
+    data = encode_copy_binary(columns)
+    with conn.cursor() as cursor:
+        cursor.copy_expert(
+            'COPY %s (%s) FROM STDIN (FORMAT binary)' % (table, ', '.join(column_names)),
+            io.BytesIO(data)
+        )
@@ -0,0 +1,83 @@
+-- Transit vehicle locations near the legs of a trip, ordered by leg and time.
+-- The legs are given as arrays: the points of all legs with the leg of each
+-- point, and the id, start time and end time of each leg. The output columns
+-- and extra joins are filled in by the reader.
+--
+-- The locations are read from the compacted per-journey segments, and the
+-- ones in the trailing window that may still be recompacted with late
+-- locations from the raw location table.
+WITH leg_points AS (
+    SELECT p.leg_id, p.x, p.y, p.idx
+    FROM unnest(
+        %(point_legs)s :: bigint[], %(xs)s :: double precision[], %(ys)s :: double precision[]
+    ) WITH ORDINALITY AS p(leg_id, x, y, idx)
+),
+legs AS (
+    SELECT
+        t.leg_id,
+        t.start_time,
+        t.end_time,
+        ST_Buffer(
+            ST_MakeLine(ST_SetSRID(ST_MakePoint(p.x, p.y), %(srid)s) ORDER BY p.idx), %(buffer)s
+        ) AS area
+    FROM unnest(
+        %(leg_ids)s :: bigint[], %(start_times)s :: timestamptz[], %(end_times)s :: timestamptz[]
+    ) AS t(leg_id, start_time, end_time)
+    JOIN leg_points AS p ON p.leg_id = t.leg_id
+    GROUP BY t.leg_id, t.start_time, t.end_time
+),
+compacted AS (
+    SELECT MAX(bucket) + %(segment_duration)s - %(late_window)s AS until
+    FROM transitrt_vehicletrajectorysegment
+),
+candidates AS (
+    SELECT
+        l.leg_id,
+        s.vehicle_journey_ref,
+        s.vehicle_ref,
+        s.route_type,
+        s.gtfs_feed_id,
+        s.gtfs_route_id,
+        p.time,
+        p.loc
+    FROM legs AS l
+    CROSS JOIN compacted AS c
+    JOIN transitrt_vehicletrajectorysegment AS s ON
+        s.end_time >= l.start_time - interval '1 minute'
+        AND s.start_time <= l.end_time + interval '1 minute'
+        AND s.start_time <= c.until
+        AND s.locs && l.area
+    CROSS JOIN LATERAL (
+        SELECT to_timestamp(s.times[(d).path[1]]) AS time, (d).geom AS loc
+        FROM ST_DumpPoints(s.locs) AS d
+    ) AS p
+    WHERE
+        p.time >= l.start_time - interval '1 minute'
+        AND p.time <= l.end_time + interval '1 minute'
+        AND p.time <= c.until
+        AND p.loc && l.area
+    UNION ALL
+    SELECT
+        l.leg_id,
+        vl.vehicle_journey_ref,
+        vl.vehicle_ref,
+        vl.route_type,
+        vl.gtfs_feed_id,
+        vl.gtfs_route_id,
+        vl.time,
+        vl.loc
+    FROM legs AS l
+    CROSS JOIN compacted AS c
+    JOIN transitrt_vehiclelocation AS vl ON
+        vl.time >= l.start_time - interval '1 minute'
+        AND vl.time <= l.end_time + interval '1 minute'
+        AND (c.until IS NULL OR vl.time > c.until)
+        AND vl.loc && l.area
+)
+SELECT
+    {columns}
+FROM
+    candidates AS vl
+{joins}
+ORDER BY
+    vl.leg_id, vl.time
@@ -0,0 +1,148 @@
+-- Samples of a device grouped into trips. The output columns are filled in
+-- by the reader from the summary row `s`, the samples `r` and the closest
+-- ways `ccw` and `crw`. When no samples are returned, there is still one row
+-- with the summary columns.
+WITH samples AS (
+    SELECT
+        l.time,
+        l.loc,
+        l.loc_error,
+        l.atype,
+        l.aconf,
+        l.speed,
+        l.heading,
+        l.is_moving,
+        l.manual_atype,
+        l.odometer,
+        l.battery_charging,
+        l.created_at,
+        EXTRACT(EPOCH FROM l.time - LAG(l.time) OVER w) AS timediff,
+        COALESCE(ST_Distance(l.loc, LAG(l.loc) OVER w), 0) AS distance
+    FROM
+        trips_ingest_location AS l
+    WHERE
+        l.uuid = %(uuid)s
+        AND l.time >= %(start_time)s
+        AND l.time <= %(end_time)s
+        AND l.deleted_at IS NULL
+    WINDOW w AS (ORDER BY l.time)
+),
+segmented AS (
+    SELECT
+        s.*,
+        COUNT(*) FILTER (WHERE s.timediff > %(trip_gap)s) OVER (ORDER BY s.time ROWS UNBOUNDED PRECEDING) AS trip_id
+    FROM samples AS s
+),
+bounds AS (
+    SELECT
+        MAX(time) AS last_sample_time,
+        MAX(time) FILTER (WHERE is_moving = false) AS last_not_moving,
+        MAX(created_at) AS last_created_at
+    FROM samples
+),
+marked AS (
+    -- Everything after the latest "not moving" sample is cut off, because a
+    -- trip might still be ongoing. Without such samples, the last burst is
+    -- cut off.
+    SELECT
+        g.*,
+        %(include_all)s OR COALESCE(
+            CASE
+                WHEN b.last_not_moving IS NOT NULL THEN g.time <= b.last_not_moving
+                ELSE g.created_at < b.last_created_at
+            END, false
+        ) AS kept
+    FROM segmented AS g, bounds AS b
+),
+trip_centers AS (
+    SELECT trip_id, AVG(ST_X(loc)) AS avg_x, AVG(ST_Y(loc)) AS avg_y
+    FROM marked
+    WHERE kept AND loc_error < %(max_loc_error)s
+    GROUP BY trip_id
+),
+good_trips AS (
+    -- Trips that have enough low location error samples far enough from
+    -- the trip center point
+    SELECT m.trip_id
+    FROM marked AS m
+    JOIN trip_centers AS c ON c.trip_id = m.trip_id
+    WHERE
+        m.kept AND m.loc_error < %(max_loc_error)s
+        AND sqrt((ST_X(m.loc) - c.avg_x) ^ 2 + (ST_Y(m.loc) - c.avg_y) ^ 2) > %(min_distance)s
+    GROUP BY m.trip_id
+    HAVING COUNT(*) > %(min_samples)s
+),
+open_part AS (
+    -- The trip that was cut off (or the last one) can still grow
+    SELECT
+        COALESCE(
+            (SELECT trip_id FROM marked WHERE NOT kept ORDER BY time LIMIT 1),
+            (SELECT trip_id FROM marked ORDER BY time DESC LIMIT 1)
+        ) AS trip_id,
+        COALESCE(
+            (SELECT MIN(time) FROM marked WHERE NOT kept),
+            (SELECT last_sample_time FROM bounds)
+        ) AS part_start
+),
+summary AS (
+    -- If the part of the open trip read so far is not a trip, it is
+    -- stationary and only the cut-off part needs to be read again.
+    SELECT
+        b.last_sample_time,
+        CASE
+            WHEN o.trip_id IN (SELECT trip_id FROM good_trips)
+                THEN (SELECT MIN(time) FROM marked WHERE trip_id = o.trip_id)
+            ELSE o.part_start
+        END AS open_trip_start
+    FROM bounds AS b, open_part AS o
+)
+SELECT
+    {columns}
+FROM
+    summary AS s
+LEFT JOIN (
+    SELECT
+        m.time,
+        m.loc,
+        m.loc_error,
+        m.atype,
+        m.aconf,
+        m.speed,
+        m.heading,
+        m.is_moving,
+        m.manual_atype,
+        m.odometer,
+        m.battery_charging,
+        m.created_at,
+        CASE WHEN gt.trip_id IS NULL THEN -1 ELSE m.trip_id END AS trip_id,
+        m.distance
+    FROM marked AS m
+    LEFT JOIN good_trips AS gt ON gt.trip_id = m.trip_id
+    WHERE %(include_all)s OR (m.kept AND gt.trip_id IS NOT NULL)
+) AS r ON true
+LEFT JOIN LATERAL (
+    SELECT
+        osm_id AS closest_car_way_id,
+        name AS closest_car_way_name,
+        ST_Distance(cw.way, r.loc) AS closest_car_way_dist,
+        highway AS closest_car_way_type
+    FROM planet_osm_car_ways AS cw
+    WHERE
+        %(with_ways)s AND cw.way && ST_Expand(r.loc, 50)
+    ORDER BY ST_Distance(cw.way, r.loc) ASC
+    LIMIT 1
+) AS ccw ON true
+LEFT JOIN LATERAL (
+    SELECT
+        osm_id AS closest_rail_way_id,
+        name AS closest_rail_way_name,
+        ST_Distance(rw.way, r.loc) AS closest_rail_way_dist,
+        railway AS closest_rail_way_type
+    FROM planet_osm_rail_ways AS rw
+    WHERE
+        %(with_ways)s AND rw.way && ST_Expand(r.loc, 50)
+    ORDER BY ST_Distance(rw.way, r.loc) ASC
+    LIMIT 1
+) AS crw ON true
+ORDER BY
+    r.time
@@ -0,0 +1,123 @@
+from collections import namedtuple
+
+import numpy as np
+import pytest
+from scipy.linalg import expm
+
+from calc import dragimm
+from calc.filterstate import pack_checkpoints, unpack_checkpoints
+
+
+Sample = namedtuple('Sample', 'time x y location_std atype aconf vehicle_way_distance')
+
+MODES = list(dragimm.filters)
+
+
+@pytest.fixture
+def trajectory():
+    """A fixed trajectory with irregular time steps, a long gap and mode changes."""
+    rng = np.random.default_rng(0)
+    n = 300
+    time = 1.6e9 + np.cumsum(rng.uniform(0.5, 30, n))
+    time[150:] += 2000
+    x = 327000 + np.cumsum(rng.normal(3, 5, n)) + rng.normal(0, 5, n)
+    y = 6820000 + np.cumsum(rng.normal(3, 5, n)) + rng.normal(0, 5, n)
+    location_std = rng.uniform(3, 60, n)
+    location_std[::37] = 0
+    atype = np.repeat(rng.integers(-1, len(MODES), n // 50 + 1), 50)[:n]
+    aconf = rng.uniform(0.2, 0.9, n)
+    vehicle_way_distance = rng.uniform(0, 100, n)
+    vehicle_way_distance[::7] = np.nan
+    return time, x, y, location_std, atype, aconf, vehicle_way_distance
+
+
+def as_samples(time, x, y, location_std, atype, aconf, vehicle_way_distance):
+    return [
+        Sample(t, xx, yy, std, MODES[a] if a >= 0 else None, c, d)
+        for t, xx, yy, std, a, c, d in zip(time, x, y, location_std, atype, aconf, vehicle_way_distance)
+    ]
+
+
+def reference_viterbi(emissions, dts):
+    """Viterbi with per-step transition matrices from scipy's expm."""
+    n_states = emissions.shape[1]
+    log_probs = dragimm.safelog(emissions[0]) + np.log(1 / n_states)
+    back = []
+    for emission, dt in zip(emissions[1:], dts[1:]):
+        emission = emission / emission.sum()
+        trans = dragimm.safelog(expm(dragimm.transition_rate * dt)) + log_probs[:, None]
+        best = np.argmax(trans, axis=0)
+        log_probs = dragimm.safelog(emission) + trans[best, np.arange(n_states)]
+        back.append(best)
+    path = [np.argmax(log_probs)]
+    for best in reversed(back):
+        path.append(best[path[-1]])
+    return np.array(path[::-1])
+
+
+def assert_results_equal(actual, expected):
+    ms, Ss, state_probs, path, loglikelihood = actual
+    exp_ms, exp_Ss, exp_state_probs, exp_path, exp_loglikelihood = expected
+    np.testing.assert_allclose(ms, exp_ms, rtol=1e-9, atol=1e-6)
+    np.testing.assert_allclose(Ss, exp_Ss, rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(state_probs, exp_state_probs, rtol=1e-6, atol=1e-9)
+    np.testing.assert_array_equal(path, exp_path)
+    assert loglikelihood == pytest.approx(exp_loglikelihood, rel=1e-9)
+
+
+@pytest.mark.parametrize('dt', [0, 1, 5, 300, 10000])
+def test_transition_matrix(dt):
+    expected = expm(dragimm.transition_rate * dt)
+    actual = dragimm.transition_matrix(dt, dragimm.N_states, dragimm.transition_rate[0, 1])
+    np.testing.assert_allclose(actual, expected, rtol=1e-12, atol=1e-15)
+
+
+def test_filter_matches_dragfilter_reference(trajectory):
+    expected = dragimm.filter_trajectory(as_samples(*trajectory))
+    actual = dragimm.filter_trajectory_arrays(*trajectory)
+    assert_results_equal(actual, expected)
+
+
+def test_viterbi_uses_time_steps(trajectory):
+    time = trajectory[0]
+    _, _, state_probs, path, _ = dragimm.filter_trajectory_arrays(*trajectory)
+    np.testing.assert_array_equal(path, reference_viterbi(state_probs, np.diff(time, prepend=np.nan)))
+
+
+def test_filter_trajectories_batch(trajectory):
+    offsets = np.array([0, 100, 100, 230, 300])
+    ms, Ss, state_probs, paths, loglikelihoods = dragimm.filter_trajectories(offsets, *trajectory)
+    assert len(loglikelihoods) == len(offsets) - 1
+    for i, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        if start == end:
+            assert loglikelihoods[i] == 0
+            continue
+        expected = dragimm.filter_trajectory_arrays(*(a[start:end] for a in trajectory))
+        s = slice(start, end)
+        assert_results_equal((ms[s], Ss[s], state_probs[s], paths[s], loglikelihoods[i]), expected)
+
+
+def test_filter_resumes_from_checkpoints(trajectory):
+    ms, _, state_probs, path, loglikelihood = dragimm.filter_trajectory_arrays(*trajectory)
+
+    checkpoint = None
+    for start, end in [(0, 120), (120, 120), (120, 200), (200, 300)]:
+        checkpoint = dragimm.filter_trajectory_resume(checkpoint, *(a[start:end] for a in trajectory))
+        # Checkpoints are stored between runs
+        checkpoint = unpack_checkpoints(pack_checkpoints([checkpoint]))[0]
+
+    np.testing.assert_array_equal(checkpoint.time, trajectory[0])
+    np.testing.assert_allclose(checkpoint.xy, ms[:, :2], rtol=1e-9, atol=1e-6)
+    np.testing.assert_allclose(checkpoint.state_probs, state_probs, rtol=1e-6, atol=1e-9)
+    np.testing.assert_array_equal(dragimm.checkpoint_path(checkpoint), path)
+    assert checkpoint.loglikelihood == pytest.approx(loglikelihood, rel=1e-9)
+
+
+def test_batch_checkpoints_match_resume(trajectory):
+    offsets = np.array([0, 120, 300])
+    *_, checkpoints = dragimm.filter_trajectories(offsets, *trajectory, return_checkpoints=True)
+    for checkpoint, (start, end) in zip(checkpoints, zip(offsets[:-1], offsets[1:])):
+        expected = dragimm.filter_trajectory_resume(None, *(a[start:end] for a in trajectory))
+        np.testing.assert_allclose(checkpoint.xs, expected.xs, rtol=1e-9)
+        np.testing.assert_allclose(checkpoint.log_probs, expected.log_probs, rtol=1e-9)
+        np.testing.assert_array_equal(dragimm.checkpoint_path(checkpoint), dragimm.checkpoint_path(expected))
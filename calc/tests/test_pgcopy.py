@@ -0,0 +1,155 @@
+import struct
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from calc import pgcopy
+from calc.pgcopy import CopyFormatError, encode_copy_binary, ewkb_points, parse_copy_binary
+
+
+HEADER = pgcopy.SIGNATURE + struct.pack('>ii', 0, 0)
+TRAILER = struct.pack('>h', -1)
+
+# Wire formats of the fixed-width types for building streams by hand
+STRUCT_FORMATS = {
+    pgcopy.INT2: '>h',
+    pgcopy.INT4: '>i',
+    pgcopy.INT8: '>q',
+    pgcopy.FLOAT4: '>f',
+    pgcopy.FLOAT8: '>d',
+    pgcopy.BOOL: '>?',
+    pgcopy.TIMESTAMPTZ: '>q',
+}
+
+
+def build_stream(col_types, rows):
+    """Build a binary COPY stream; None values are written as NULLs."""
+    out = [HEADER]
+    for row in rows:
+        out.append(struct.pack('>h', len(row)))
+        for col_type, val in zip(col_types, row):
+            if val is None:
+                out.append(struct.pack('>i', -1))
+                continue
+            if col_type == pgcopy.TEXT:
+                data = val.encode('utf8')
+            else:
+                data = struct.pack(STRUCT_FORMATS[col_type], val)
+            out.append(struct.pack('>i', len(data)) + data)
+    out.append(TRAILER)
+    return b''.join(out)
+
+
+def test_round_trip_fixed_width_types():
+    times = pd.DatetimeIndex([
+        '1970-01-01T00:00:00', '2000-01-01T00:00:00', '2021-05-01T12:34:56.789012', '1999-12-31T23:59:59.999999',
+    ], tz='UTC')
+    columns = [
+        ('i2', pgcopy.INT2, np.array([-32768, -1, 0, 32767], dtype=np.int16)),
+        ('i4', pgcopy.INT4, np.array([-2**31, -1, 7, 2**31 - 1], dtype=np.int32)),
+        ('i8', pgcopy.INT8, np.array([-2**63, -1, 7, 2**63 - 1], dtype=np.int64)),
+        ('f4', pgcopy.FLOAT4, np.array([-1.5, 0, np.inf, 3.25], dtype=np.float32)),
+        ('f8', pgcopy.FLOAT8, np.array([-1e300, 0, 1 / 3, np.pi])),
+        ('b', pgcopy.BOOL, np.array([True, False, False, True])),
+        ('t', pgcopy.TIMESTAMPTZ, times),
+    ]
+    data = encode_copy_binary([(col_type, vals) for _, col_type, vals in columns])
+    df = parse_copy_binary(data, [(name, col_type) for name, col_type, _ in columns])
+
+    assert list(df.columns) == [name for name, _, _ in columns]
+    assert len(df) == 4
+    for name, col_type, vals in columns:
+        if col_type == pgcopy.TIMESTAMPTZ:
+            pd.testing.assert_index_equal(pd.DatetimeIndex(df[name]), vals, check_names=False)
+        elif col_type == pgcopy.BOOL:
+            assert df[name].tolist() == vals.tolist()
+        else:
+            np.testing.assert_array_equal(df[name].to_numpy(), vals)
+            assert df[name].dtype == vals.dtype
+
+
+def test_timestamptz_epoch_conversion():
+    data = encode_copy_binary([(pgcopy.TIMESTAMPTZ, pd.DatetimeIndex(['1970-01-01', '2000-01-01'], tz='UTC'))])
+    # PostgreSQL timestamps are microseconds since 2000-01-01
+    values = [struct.unpack_from('>q', data, len(HEADER) + 2 + 4 + i * 14)[0] for i in range(2)]
+    assert values == [-946684800 * 10**6, 0]
+
+    stream = build_stream([pgcopy.TIMESTAMPTZ], [(0,), (1,), (-946684800 * 10**6,)])
+    df = parse_copy_binary(stream, [('time', pgcopy.TIMESTAMPTZ)])
+    assert list(df.time) == [
+        pd.Timestamp('2000-01-01', tz='UTC'),
+        pd.Timestamp('2000-01-01 00:00:00.000001', tz='UTC'),
+        pd.Timestamp('1970-01-01', tz='UTC'),
+    ]
+
+
+def test_nulls_in_each_type():
+    col_types = [
+        pgcopy.INT2, pgcopy.INT4, pgcopy.INT8, pgcopy.FLOAT4, pgcopy.FLOAT8, pgcopy.BOOL, pgcopy.TIMESTAMPTZ,
+        pgcopy.TEXT,
+    ]
+    rows = [
+        (1, 2, 3, 1.5, 2.5, True, 0, 'abc'),
+        (None,) * len(col_types),
+        (4, 5, 6, 3.5, 4.5, False, 10**6, 'äö'),
+    ]
+    names = ['i2', 'i4', 'i8', 'f4', 'f8', 'b', 't', 'text']
+    df = parse_copy_binary(build_stream(col_types, rows), list(zip(names, col_types)))
+
+    assert df.i2.tolist() == [1, -1, 4]
+    assert df.i4.tolist() == [2, -1, 5]
+    assert df.i8.tolist() == [3, -1, 6]
+    np.testing.assert_array_equal(df.f4.to_numpy(), np.array([1.5, np.nan, 3.5], dtype=np.float32))
+    np.testing.assert_array_equal(df.f8.to_numpy(), np.array([2.5, np.nan, 4.5]))
+    assert df.b[0] and not df.b[2]
+    assert df.b.isna().tolist() == [False, True, False]
+    assert df.t.isna().tolist() == [False, True, False]
+    assert df.t[2] == pd.Timestamp('2000-01-01 00:00:01', tz='UTC')
+    assert df.text.tolist() == ['abc', None, 'äö']
+
+
+def test_empty_result():
+    df = parse_copy_binary(build_stream([pgcopy.INT4, pgcopy.TEXT], []), [('a', pgcopy.INT4), ('b', pgcopy.TEXT)])
+    assert len(df) == 0
+    assert list(df.columns) == ['a', 'b']
+
+    data = encode_copy_binary([(pgcopy.INT4, np.array([], dtype=np.int32))])
+    assert data == HEADER + TRAILER
+
+
+def test_ewkb_points():
+    points = ewkb_points(np.array([1.0, 24.94]), np.array([61.0, 60.17]), 4326)
+    assert points.shape == (2, 25)
+    assert points[0].tobytes().hex() == '0101000020e6100000000000000000f03f0000000000804e40'
+    assert struct.unpack('<BIIdd', points[1].tobytes()) == (1, 0x20000001, 4326, 24.94, 60.17)
+
+    data = encode_copy_binary([(pgcopy.INT4, np.array([7, 8])), (pgcopy.RAW, points)])
+    tuple_size = 2 + (4 + 4) + (4 + 25)
+    assert len(data) == len(HEADER) + 2 * tuple_size + len(TRAILER)
+    for i in range(2):
+        pos = len(HEADER) + i * tuple_size
+        assert struct.unpack_from('>hiiI', data, pos) == (2, 4, 7 + i, 25)
+        assert data[pos + 14:pos + 14 + 25] == points[i].tobytes()
+
+
+def test_field_count_mismatch():
+    data = build_stream([pgcopy.INT4, pgcopy.INT4], [(1, 2)])
+    with pytest.raises(CopyFormatError):
+        parse_copy_binary(data, [('a', pgcopy.INT4)])
+    with pytest.raises(CopyFormatError):
+        parse_copy_binary(data, [('a', pgcopy.INT4), ('b', pgcopy.INT4), ('c', pgcopy.INT4)])
+
+
+def test_invalid_streams():
+    data = build_stream([pgcopy.INT4], [(1,)])
+    with pytest.raises(CopyFormatError):
+        parse_copy_binary(b'X' + data[1:], [('a', pgcopy.INT4)])
+    # The field length must match the type
+    with pytest.raises(CopyFormatError):
+        parse_copy_binary(data, [('a', pgcopy.INT8)])
+
+    with pytest.raises(CopyFormatError):
+        encode_copy_binary([(pgcopy.INT4, np.array([1, 2])), (pgcopy.INT4, np.array([1]))])
+    with pytest.raises(CopyFormatError):
+        encode_copy_binary([(pgcopy.TEXT, np.array(['a']))])
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from calc.transitest import transit_prob_ests_糞, transit_scores
+
+
+@pytest.fixture
+def leg():
+    rng = np.random.default_rng(0)
+    n = 60
+    time = 1.6e9 + np.sort(rng.uniform(0, 600, n))
+    return pd.DataFrame(dict(
+        time=time,
+        x=327000 + (time - time[0]) * 8 + rng.normal(0, 10, n),
+        y=6820000 + (time - time[0]) * 3 + rng.normal(0, 10, n),
+        location_std=rng.uniform(3, 60, n),
+    ))
+
+
+def make_transit_locs(leg, seed=1):
+    """Random vehicles, some of which start after or end before the leg."""
+    rng = np.random.default_rng(seed)
+    leg_start, leg_end = leg.time.min(), leg.time.max()
+    vehicles = []
+    for i in range(12):
+        n = rng.integers(2, 40)
+        start = leg_start + rng.uniform(-300, 300)
+        end = start + rng.uniform(10, 900)
+        # Unique, unsorted times
+        time = rng.permutation(np.linspace(start, end, n) + rng.uniform(0, 0.1, n))
+        vehicles.append(pd.DataFrame(dict(
+            vehicle_ref='v%02d' % i,
+            time=time,
+            x=327000 + (time - leg_start) * rng.uniform(0, 12) + rng.normal(0, 20, n),
+            y=6820000 + (time - leg_start) * rng.uniform(0, 6) + rng.normal(0, 20, n),
+        )))
+    # Vehicles with all locations after or before the leg
+    for ref, start in (('after', leg_end + 100), ('before', leg_start - 700)):
+        time = start + np.array([30.0, 0.0, 90.0, 60.0])
+        vehicles.append(pd.DataFrame(dict(vehicle_ref=ref, time=time, x=327000 + time - start, y=6820000.0)))
+    # Too few locations to interpolate
+    vehicles.append(pd.DataFrame(dict(vehicle_ref='single', time=[leg_start], x=[327000.0], y=[6820000.0])))
+    return pd.concat(vehicles, ignore_index=True).sample(frac=1, random_state=2)
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_transit_scores_match_reference(leg, seed):
+    transit_locs = make_transit_locs(leg, seed)
+    transits = {ref: df for ref, df in transit_locs.groupby('vehicle_ref')}
+    expected = transit_prob_ests_糞(leg, transits)
+
+    scores = transit_scores(leg, transit_locs)
+    assert list(scores) == sorted(expected)
+    assert np.isnan(scores['single'])
+    refs = [ref for ref in sorted(expected) if ref != 'single']
+    np.testing.assert_allclose([scores[ref] for ref in refs], [expected[ref] for ref in refs], rtol=1e-9)
+
+
+def test_transit_scores_extrapolates_outside_vehicle_times(leg):
+    # A vehicle moving exactly along the leg's linear trend, seen only before the leg
+    start = leg.time.iloc[0]
+    time = np.array([start - 100, start - 50])
+    transit_locs = pd.DataFrame(dict(
+        vehicle_ref='v', time=time, x=327000 + (time - start) * 8, y=6820000 + (time - start) * 3,
+    ))
+    exact = leg.assign(x=327000 + (leg.time - start) * 8, y=6820000 + (leg.time - start) * 3)
+    assert transit_scores(exact, transit_locs)['v'] == pytest.approx(0, abs=1e-6)
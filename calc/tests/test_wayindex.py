@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import LineString, MultiLineString, Point
+
+from calc.wayindex import MAX_WAY_DISTANCE, WayIndex, WayIndexSet
+
+X0, Y0 = 385000.0, 6672000.0
+
+
+def make_ways(lines):
+    """Build a ways DataFrame from a list of lines per way."""
+    return pd.DataFrame(dict(
+        osm_id=np.arange(len(lines)) + 100,
+        name=['way %d' % i for i in range(len(lines))],
+        type=['residential'] * len(lines),
+        coords=[[np.asarray(coords, dtype=np.float64) for coords in way] for way in lines],
+    ))
+
+
+def random_ways(rng, n=40, size=2000):
+    lines = []
+    for i in range(n):
+        n_lines = 2 if i % 10 == 0 else 1
+        way = []
+        for _ in range(n_lines):
+            start = rng.uniform(0, size, 2)
+            # Vertices up to a few hundred meters apart, so that most of the
+            # segments are subdivided
+            steps = rng.normal(0, 150, (rng.integers(2, 7), 2))
+            way.append(np.vstack([start, start + np.cumsum(steps, axis=0)]) + (X0, Y0))
+        lines.append(way)
+    return lines
+
+
+def shapely_nearest(lines, x, y):
+    geoms = [MultiLineString([LineString(c) for c in way]) for way in lines]
+    return np.array([[geom.distance(Point(px, py)) for geom in geoms] for px, py in zip(x, y)])
+
+
+def assert_matches_shapely(index, lines, x, y):
+    dists, ways = index.nearest(x, y)
+    expected = shapely_nearest(lines, x, y)
+    min_dists = expected.min(axis=1)
+    found = min_dists <= MAX_WAY_DISTANCE
+    np.testing.assert_array_equal(ways >= 0, found)
+    np.testing.assert_allclose(dists[found], min_dists[found], rtol=0, atol=1e-6)
+    assert np.isnan(dists[~found]).all()
+    # On ties any of the closest ways will do
+    np.testing.assert_allclose(expected[found, ways[found]], min_dists[found], rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_nearest_matches_shapely(seed):
+    rng = np.random.default_rng(seed)
+    lines = random_ways(rng)
+    index = WayIndex.build(make_ways(lines))
+    # Also points outside the grid
+    x = X0 + rng.uniform(-300, 2300, 3000)
+    y = Y0 + rng.uniform(-300, 2300, 3000)
+    assert_matches_shapely(index, lines, x, y)
+
+    # Points close to the ways
+    way = rng.integers(0, len(lines), 1000)
+    coords = [lines[i][0][rng.integers(0, len(lines[i][0]))] for i in way]
+    x = np.array([c[0] for c in coords]) + rng.uniform(-70, 70, 1000)
+    y = np.array([c[1] for c in coords]) + rng.uniform(-70, 70, 1000)
+    assert_matches_shapely(index, lines, x, y)
+
+
+def test_nearest_includes_ways_at_max_distance():
+    # The way runs along the bottom edge of the grid and ends at its right edge
+    lines = [[[(X0, Y0), (X0 + 230, Y0)]], [[(X0, Y0 + 500), (X0 + 230, Y0 + 500)]]]
+    index = WayIndex.build(make_ways(lines))
+    x = X0 + np.array([100, 100, 100, 100, 230 + 30, 230 + 50, 230 + 50.001, -40, 100, 100])
+    y = Y0 + np.array([50, 50.001, -50, -50.001, 40, 0, 0, -30, 240, 275])
+    dists, ways = index.nearest(x, y)
+    np.testing.assert_array_equal(ways, [0, -1, 0, -1, 0, 0, -1, 0, -1, -1])
+    np.testing.assert_allclose(dists, [50, np.nan, 50, np.nan, 50, 50, np.nan, 50, np.nan, np.nan])
+    assert_matches_shapely(index, lines, x, y)
+
+    # The cutoff can be changed
+    dists, ways = index.nearest(x, y, max_dist=250)
+    np.testing.assert_array_equal(ways, [0, 0, 0, 0, 0, 0, 0, 0, 0, 1])
+
+
+def test_nearest_handles_non_finite_points_and_empty_index():
+    index = WayIndex.build(make_ways([[[(X0, Y0), (X0 + 100, Y0)]]]))
+    dists, ways = index.nearest([np.nan, X0 + 10], [Y0, np.inf])
+    assert np.isnan(dists).all()
+    np.testing.assert_array_equal(ways, [-1, -1])
+
+    empty = WayIndex.build(make_ways([]))
+    dists, ways = empty.nearest([X0], [Y0])
+    assert np.isnan(dists).all()
+    np.testing.assert_array_equal(ways, [-1])
+
+
+def test_add_way_columns():
+    car = WayIndex.build(make_ways([[[(X0, Y0), (X0 + 100, Y0)]], [[(X0, Y0 + 80), (X0 + 100, Y0 + 80)]]]))
+    rail = WayIndex.build(make_ways([]))
+    index_set = WayIndexSet(dict(car=car, rail=rail))
+    df = pd.DataFrame(dict(x=X0 + np.array([50.0, 50.0, 500.0]), y=Y0 + np.array([10.04, 60.0, 0.0])), index=[5, 6, 7])
+
+    index_set.add_way_columns(df)
+    assert df.closest_car_way_dist.dtype == np.float32
+    np.testing.assert_allclose(df.closest_car_way_dist, [10.0, 20.0, np.nan])
+    assert list(df.closest_car_way_name) == ['way 0', 'way 1', None]
+    assert list(df.closest_car_way_type) == ['residential', 'residential', None]
+    assert list(df.closest_car_way_id) == ['100', '101', None]
+    assert df.closest_rail_way_dist.isna().all()
+    assert list(df.closest_rail_way_name) == [None] * 3
+
+    df = df[['x', 'y']].copy()
+    index_set.add_way_columns(df, include_names=False)
+    assert list(df.columns) == ['x', 'y', 'closest_car_way_dist', 'closest_rail_way_dist']
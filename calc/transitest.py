@@ -1,5 +1,7 @@
 from scipy.interpolate import interp1d
+import numba
 import numpy as np
+import pandas as pd
 from scipy.stats import norm
 
 def transit_likelihoods(leg, transits):
@@ -57,6 +59,58 @@ def transit_prob_ests_糞(leg, transits, transit_loc_std=10.0):
     return trans_shit
 
 
+def transit_scores(leg, transit_locs, transit_loc_std=10.0):
+    """Batched version of transit_prob_ests_糞().
+
+    `transit_locs` has the locations of all candidate vehicles, with their
+    `vehicle_ref`, and is scored in one pass. Returns a dict of scores keyed
+    by vehicle_ref, in vehicle_ref order.
+    """
+    vehicle_codes, vehicle_refs = pd.factorize(transit_locs['vehicle_ref'], sort=True)
+    transit_t = transit_locs['time'].to_numpy(dtype=np.float64)
+    # Like interp1d, order each vehicle's locations by time
+    order = np.lexsort((transit_t, vehicle_codes))
+    counts = np.bincount(vehicle_codes, minlength=len(vehicle_refs))
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    # The weights depend only on the leg
+    leg_pos_var = leg['location_std'].values**2
+    error_vars = transit_loc_std**2 + leg_pos_var**2
+    precisions = 1/error_vars
+    weights = precisions/np.sum(precisions)
+    scores = _transit_scores(
+        leg['time'].to_numpy(dtype=np.float64), leg['x'].to_numpy(dtype=np.float64),
+        leg['y'].to_numpy(dtype=np.float64), weights.astype(np.float64), offsets, transit_t[order],
+        transit_locs['x'].to_numpy(dtype=np.float64)[order], transit_locs['y'].to_numpy(dtype=np.float64)[order],
+    )
+    return dict(zip(vehicle_refs, scores))
+
+
+@numba.njit(cache=True, error_model='numpy')
+def _transit_scores(leg_t, leg_x, leg_y, weights, offsets, t, x, y):
+    n_vehicles = len(offsets) - 1
+    scores = np.full(n_vehicles, np.nan)
+
+    for v in range(n_vehicles):
+        start = offsets[v]
+        n = offsets[v + 1] - start
+        if n < 2:
+            continue
+        vt = t[start:start + n]
+        est_mean_dist = 0.0
+        for i in range(len(leg_t)):
+            # Linear interpolation (and extrapolation) as in interp1d()
+            k = np.searchsorted(vt, leg_t[i])
+            k = min(max(k, 1), n - 1)
+            lo = start + k - 1
+            hi = start + k
+            dt = t[hi] - t[lo]
+            px = (x[hi] - x[lo]) / dt * (leg_t[i] - t[lo]) + x[lo]
+            py = (y[hi] - y[lo]) / dt * (leg_t[i] - t[lo]) + y[lo]
+            est_mean_dist += np.sqrt((leg_x[i] - px) ** 2 + (leg_y[i] - py) ** 2) * weights[i]
+        scores[v] = -est_mean_dist
+    return scores
+
+
 def transit_likelihoods_(leg, transits, transit_loc_std=10.0):
 
     leg_t = leg.time.values
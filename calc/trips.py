@@ -1,13 +1,19 @@
+import functools
 import os
 import logging
 import numba
 import numpy as np
 from datetime import date, datetime, timedelta
 import pandas as pd
+from psycopg2 import DatabaseError
 from utils.perf import PerfCounter
 
-from .dragimm import filter_trajectory, filters as transport_modes
-from .transitest import transit_prob_ests_糞
+from . import pgcopy
+from .dragimm import (
+    checkpoint_path, filter_idx, filter_trajectories, filter_trajectory_arrays, filter_trajectory_resume,
+    filters as transport_modes
+)
+from .transitest import transit_scores
 
 
 TABLE_NAME = 'trips_ingest_location'
@@ -17,7 +23,13 @@ LOCAL_TZ = 'Europe/Helsinki'
 
 MINS_BETWEEN_TRIPS = 20
 MIN_DISTANCE_MOVED_IN_TRIP = 200
+# A trip needs more than this many good samples farther than
+# MIN_DISTANCE_MOVED_IN_TRIP from its center point
+MIN_FAR_SAMPLES_IN_TRIP = 10
+MAX_GOOD_LOC_ERROR = 100
 MIN_SAMPLES_PER_LEG = 15
+# Max. number of samples per chunk in read_locations_chunked()
+LOCATION_CHUNK_ROWS = 100000
 
 DAYS_TO_FETCH = 5
 LOCAL_2D_CRS = 3067
@@ -25,29 +37,164 @@ LOCAL_2D_CRS = 3067
 logger = logging.getLogger(__name__)
 
 
-def prepare_sql_statements(conn):
-    with conn.cursor() as curs:
-        # Check if we have prepared the statement for this DB session before.
-        curs.execute(
-            'SELECT COUNT(*) FROM pg_prepared_statements WHERE name = %(name)s',
-            dict(name='read_locations')
-        )
-        rows = curs.fetchall()
-        if rows[0][0]:
-            return
+# Columns read for each location sample: name, SQL expression and type.
+# The summary columns are the same on every row.
+SUMMARY_COLUMNS = ['last_sample_time', 'open_trip_start']
+LOCATION_COLUMNS = [
+    ('last_sample_time', 's.last_sample_time', pgcopy.TIMESTAMPTZ),
+    ('open_trip_start', 's.open_trip_start', pgcopy.TIMESTAMPTZ),
+    ('time', 'r.time', pgcopy.TIMESTAMPTZ),
+    ('x', 'ST_X(r.loc)', pgcopy.FLOAT8),
+    ('y', 'ST_Y(r.loc)', pgcopy.FLOAT8),
+    ('loc_error', 'r.loc_error :: real', pgcopy.FLOAT4),
+    ('atype', 'COALESCE(array_position(%(atypes)s :: text[], r.atype :: text) - 1, -1) :: smallint', pgcopy.INT2),
+    ('aconf', 'r.aconf :: real', pgcopy.FLOAT4),
+    ('speed', 'r.speed', pgcopy.FLOAT8),
+    ('created_at', 'r.created_at', pgcopy.TIMESTAMPTZ),
+    ('trip_id', 'COALESCE(r.trip_id, -1) :: bigint', pgcopy.INT8),
+    ('distance', 'r.distance', pgcopy.FLOAT8),
+]
+WAY_DISTANCE_COLUMNS = [
+    ('closest_car_way_dist', 'ROUND(ccw.closest_car_way_dist :: numeric, 1) :: real', pgcopy.FLOAT4),
+    ('closest_rail_way_dist', 'ROUND(crw.closest_rail_way_dist :: numeric, 1) :: real', pgcopy.FLOAT4),
+]
+WAY_DEBUG_COLUMNS = [
+    ('closest_car_way_name', 'ccw.closest_car_way_name :: text', pgcopy.TEXT),
+    ('closest_car_way_type', 'ccw.closest_car_way_type :: text', pgcopy.TEXT),
+    ('closest_car_way_id', 'ccw.closest_car_way_id :: text', pgcopy.TEXT),
+    ('closest_rail_way_name', 'crw.closest_rail_way_name :: text', pgcopy.TEXT),
+    ('closest_rail_way_type', 'crw.closest_rail_way_type :: text', pgcopy.TEXT),
+    ('closest_rail_way_id', 'crw.closest_rail_way_id :: text', pgcopy.TEXT),
+]
+LOCATION_DEBUG_COLUMNS = [
+    ('heading', 'r.heading :: real', pgcopy.FLOAT4),
+    ('is_moving', 'r.is_moving', pgcopy.BOOL),
+    ('manual_atype', 'r.manual_atype :: text', pgcopy.TEXT),
+    ('odometer', 'r.odometer', pgcopy.FLOAT8),
+    ('battery_charging', 'r.battery_charging', pgcopy.BOOL),
+]
+
+# Activity types of the location samples; `atype` is read as a categorical
+# with these categories.
+LOCATION_ATYPES = ['unknown', 'still', 'on_foot', 'walking', 'running', 'on_bicycle', 'in_vehicle']
 
-        path = os.path.dirname(__file__)
-        fn = os.path.join(path, 'sql', 'read_locations.sql')
-        query = open(fn, 'r').read()
-        with conn.cursor() as curs:
-            curs.execute(query)
 
+@functools.lru_cache()
+def read_sql_file(name):
+    path = os.path.dirname(__file__)
+    fn = os.path.join(path, 'sql', '%s.sql' % name)
+    with open(fn, 'r') as f:
+        return f.read()
 
-def read_locations(conn, uid, start_time=None, end_time=None, include_all=False):
+
+def read_locations(
+    conn, uid, start_time=None, end_time=None, include_all=False, way_index=None, include_debug_columns=False
+):
+    """Read the location samples of a device and group them into trips.
+
+    If `way_index` (a calc.wayindex.WayIndexSet) is given, the distances to
+    the closest car and rail ways are computed in-process instead of in
+    the database.
+
+    The columns not needed for trip generation (the closest way names and
+    the raw heading, odometer and state fields) are only read with
+    `include_debug_columns`.
+
+    The returned DataFrame has two timestamps in `attrs`: `last_sample_time`
+    is the time of the last sample read and `open_trip_start` the start of
+    the trailing data that can still change as new samples arrive. Earlier
+    samples need not be read again.
+    """
     pc = PerfCounter('read %s' % uid, show_time_to_last=True)
 
-    prepare_sql_statements(conn)
+    columns = _location_columns(way_index, include_debug_columns)
+    params = _location_params(uid, start_time, end_time, include_all, way_index)
+    df = pgcopy.copy_query(conn, _location_query(columns), params, [(name, col_type) for name, _, col_type in columns])
+    pc.display('query done, got %d rows' % len(df))
+
+    # Every result has at least one row with the summary columns
+    last_sample_time = df.last_sample_time.iloc[0]
+    open_trip_start = df.open_trip_start.iloc[0]
+    df = df[df.time.notna()].drop(columns=SUMMARY_COLUMNS).reset_index(drop=True)
+    df = _finish_locations(df, way_index, include_debug_columns, last_sample_time, open_trip_start)
+    pc.display('returning %d trips (%d rows)' % (df.trip_id[df.trip_id >= 0].nunique(), len(df)))
+
+    return df
+
+
+def read_locations_chunked(conn, uid, start_time=None, end_time=None, way_index=None, chunk_rows=LOCATION_CHUNK_ROWS):
+    """Like read_locations(), but yield the samples in chunks of whole trips.
+
+    The trips are grouped in the database into a temporary table, which is
+    read in time order at most `chunk_rows` samples at a time (or one trip,
+    if it is longer). Every chunk has the same `attrs`. If there are no
+    trips, one empty chunk is yielded.
+    """
+    pc = PerfCounter('read %s in chunks' % uid, show_time_to_last=True)
+
+    columns = _location_columns(way_index, False)
+    params = _location_params(uid, start_time, end_time, False, way_index)
+    table = 'pg_temp.trip_location_chunks'
+    with conn.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS %s' % table)
+        cursor.execute(('CREATE TABLE %s AS ' % table) + _location_query(columns), params)
+        cursor.execute('CREATE INDEX ON %s (trip_id)' % table)
+        cursor.execute('SELECT %s FROM %s LIMIT 1' % (', '.join(SUMMARY_COLUMNS), table))
+        last_sample_time, open_trip_start = cursor.fetchone()
+        cursor.execute(
+            'SELECT trip_id, COUNT(*) FROM %s WHERE time IS NOT NULL GROUP BY trip_id ORDER BY trip_id' % table
+        )
+        trip_sizes = cursor.fetchall()
+    pc.display('query done, got %d trips' % len(trip_sizes))
+
+    # Consecutive trips are read together until the chunk would get too large
+    chunks = []
+    for trip_id, count in trip_sizes:
+        if chunks and chunks[-1][2] + count <= chunk_rows:
+            first, _, rows = chunks[-1]
+            chunks[-1] = (first, trip_id, rows + count)
+        else:
+            chunks.append((trip_id, trip_id, count))
+    if not chunks:
+        chunks.append((0, -1, 0))
+
+    sample_columns = [(name, col_type) for name, _, col_type in columns if name not in SUMMARY_COLUMNS]
+    query = 'SELECT %s FROM %s WHERE trip_id >= %%(first)s AND trip_id <= %%(last)s ORDER BY time' % (
+        ', '.join(name for name, _ in sample_columns), table
+    )
+    last_sample_time = pd.Timestamp(last_sample_time).tz_convert('UTC') if last_sample_time else None
+    open_trip_start = pd.Timestamp(open_trip_start).tz_convert('UTC') if open_trip_start else None
+    try:
+        for first, last, _ in chunks:
+            df = pgcopy.copy_query(conn, query, dict(first=first, last=last), sample_columns)
+            df = _finish_locations(df, way_index, False, last_sample_time, open_trip_start)
+            pc.display('trips %d-%d: %d rows' % (first, last, len(df)))
+            yield df
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS %s' % table)
+
+
+def _location_columns(way_index, include_debug_columns):
+    columns = list(LOCATION_COLUMNS)
+    if way_index is None:
+        columns += WAY_DISTANCE_COLUMNS
+        if include_debug_columns:
+            columns += WAY_DEBUG_COLUMNS
+    if include_debug_columns:
+        columns += LOCATION_DEBUG_COLUMNS
+    return columns
+
+
+def _location_query(columns):
+    # The samples are grouped into trips in the database, and only the
+    # samples of trips are returned (or all samples with `include_all`).
+    return read_sql_file('read_trip_locations').format(
+        columns=',\n    '.join('%s AS %s' % (expr, name) for name, expr, _ in columns)
+    )
 
+
+def _location_params(uid, start_time, end_time, include_all, way_index):
     if end_time is None:
         end_time = datetime.utcnow()
 
@@ -57,53 +204,22 @@ def read_locations(conn, uid, start_time=None, end_time=None, include_all=False)
         else:
             start_time = (date.today() - timedelta(days=14)).isoformat()
 
-    params = dict(uuid=uid, start_time=start_time, end_time=end_time)
-    query = 'EXECUTE read_locations(%(uuid)s, %(start_time)s, %(end_time)s)'
-    df = pd.read_sql_query(query, conn, params=params)
-    pc.display('query done, got %d rows' % len(df))
-
-    df['time'] = pd.to_datetime(df.time, utc=True)
-    df['timediff'] = df['time'].diff().dt.total_seconds().fillna(value=0)
-    df['new_trip'] = df['timediff'] > MINS_BETWEEN_TRIPS * 60
-    df['trip_id'] = df['new_trip'].cumsum()
-    d = ((df.x - df.x.shift()) ** 2 + (df.y - df.y.shift()) ** 2).pow(.5).fillna(0)
-    df['distance'] = d
-
-    # Filter out everything after the latest "not moving" event,
-    # because a trip might still be ongoing
-    if not include_all:
-        not_moving = df[df.is_moving == False]
-        if not len(not_moving):
-            # If we don't have any "not moving" samples, just filter
-            # out the last burst.
-            df = df[df.created_at < df.created_at.max()]
-        else:
-            last_not_moving = not_moving.time.max()
-            df = df[df.time <= last_not_moving]
-
-    # Filter out trips that do not have enough low location error samples
-    # far enough from the trip center point.
-    good_samples = df[df.loc_error < 100]
-    if not len(good_samples):
-        print('No good samples, returning')
-        return
-
-    avg_loc = good_samples.groupby('trip_id')[['x', 'y']].mean()
-    avg_loc.columns = ['avg_x', 'avg_y']
-    d = good_samples.join(avg_loc, on='trip_id')
-    d['mean_distance'] = ((d.x - d.avg_x) ** 2 + (d.y - d.avg_y) ** 2).pow(.5)
-
-    loc_count = d[d['mean_distance'] > MIN_DISTANCE_MOVED_IN_TRIP].groupby('trip_id')['time'].count()
-    trips_to_keep = loc_count.index[loc_count > 10]
-
-    df.loc[~df.trip_id.isin(trips_to_keep), 'trip_id'] = -1
+    return dict(
+        uuid=uid, start_time=start_time, end_time=end_time, with_ways=way_index is None,
+        include_all=include_all, trip_gap=MINS_BETWEEN_TRIPS * 60, max_loc_error=MAX_GOOD_LOC_ERROR,
+        min_distance=MIN_DISTANCE_MOVED_IN_TRIP, min_samples=MIN_FAR_SAMPLES_IN_TRIP, atypes=LOCATION_ATYPES,
+    )
 
-    if not include_all:
-        df = df[df.trip_id >= 0]
 
-    df = df.drop(columns=['timediff', 'new_trip'])
-    pc.display('returning %d trips (%d rows)' % (len(trips_to_keep), len(df)))
+def _finish_locations(df, way_index, include_debug_columns, last_sample_time, open_trip_start):
+    df['atype'] = pd.Categorical.from_codes(df['atype'].to_numpy(), categories=LOCATION_ATYPES)
+    if way_index is not None:
+        way_index.add_way_columns(df, include_names=include_debug_columns)
 
+    df.attrs.update(
+        last_sample_time=last_sample_time if pd.notna(last_sample_time) else None,
+        open_trip_start=open_trip_start if pd.notna(open_trip_start) else None,
+    )
     return df
 
 
@@ -131,24 +247,51 @@ ATYPE_UNKNOWN = ALL_ATYPES.index('unknown')
 IDX_MAPPING = {idx: ATYPE_REVERSE[x] for idx, x in enumerate(transport_modes.keys())}
 
 
-def filter_trips(df: pd.DataFrame):
-    out = df[['time', 'x', 'y', 'speed']].copy()
-    s = df['time'].dt.tz_convert(None) - pd.Timestamp('1970-01-01')
-    out['time'] = s / pd.Timedelta('1s')
+def partition_offsets(keys):
+    """Return the offsets of the runs of equal values in `keys`.
+
+    The i'th run is keys[offsets[i]:offsets[i + 1]].
+    """
+    keys = np.asarray(keys)
+    if not len(keys):
+        return np.zeros(1, dtype=np.int64)
+    starts = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    return np.concatenate([[0], starts, [len(keys)]]).astype(np.int64)
+
 
-    out['location_std'] = df['loc_error'].clip(lower=0.1)
-    out['atype'] = df['atype'].map(ATYPE_MAPPING)
-    out['aconf'] = df['aconf'] / 100
-    out['vehicle_way_distance'] = df[['closest_car_way_dist', 'closest_rail_way_dist']].min(axis=1)
-    out.loc[out.aconf == 1, 'aconf'] /= 2
+def iter_partitions(df: pd.DataFrame, column):
+    """Iterate over the runs of equal `column` values in `df`.
+
+    Yields (value, rows) pairs. The rows are positional slices of `df` and
+    share its data, so they must not be modified.
+    """
+    keys = df[column].to_numpy()
+    offsets = partition_offsets(keys)
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        yield keys[start], df.iloc[start:end]
+
+
+def _filter_inputs(df: pd.DataFrame):
+    s = df['time'].dt.tz_convert(None) - pd.Timestamp('1970-01-01')
+    aconf = df['aconf'] / 100
+    aconf.loc[aconf == 1] /= 2
+    atype = df['atype'].map(ATYPE_MAPPING).map(filter_idx).fillna(-1).astype(int)
+    return dict(
+        time=s / pd.Timedelta('1s'),
+        x=df['x'],
+        y=df['y'],
+        location_std=df['loc_error'].clip(lower=0.1),
+        atype=atype,
+        aconf=aconf,
+        vehicle_way_distance=df[['closest_car_way_dist', 'closest_rail_way_dist']].min(axis=1),
+    )
 
-    ms, Ss, state_probs, most_likely_path, _ = filter_trajectory((r for i, r in out.iterrows()))
 
-    x = ms[:, 0]
-    y = ms[:, 1]
-    df = df.copy()
-    df['xf'] = x
-    df['yf'] = y
+def _add_filter_results(df: pd.DataFrame, ms, state_probs, most_likely_path, copy=True):
+    if copy:
+        df = df.copy()
+    df['xf'] = ms[:, 0]
+    df['yf'] = ms[:, 1]
     df['atypef'] = most_likely_path
     df['atypef'] = df['atypef'].map(IDX_MAPPING)
 
@@ -158,11 +301,78 @@ def filter_trips(df: pd.DataFrame):
             mode = 'in_vehicle'
         elif mode == 'cycling':
             mode = 'on_bicycle'
-        df[mode] = [x[idx] for x in state_probs]
+        df[mode] = state_probs[:, idx]
 
     return df
 
 
+def filter_trips(df: pd.DataFrame):
+    ms, Ss, state_probs, most_likely_path, _ = filter_trajectory_arrays(**_filter_inputs(df))
+    return _add_filter_results(df, ms, state_probs, most_likely_path)
+
+
+def filter_trips_batch(df: pd.DataFrame, trip_column='trip_id'):
+    """Filter all trips in `df` in one parallel call.
+
+    Each value of `trip_column` is filtered as a separate trajectory. Returns
+    the same columns as filter_trips(), with the rows ordered by trip and time.
+    """
+    # sort_values() returns a new frame, so the results are added to it as is
+    df = df.sort_values([trip_column, 'time'], kind='stable')
+    offsets = partition_offsets(df[trip_column].to_numpy())
+    ms, Ss, state_probs, most_likely_path, _ = filter_trajectories(offsets, **_filter_inputs(df))
+    return _add_filter_results(df, ms, state_probs, most_likely_path, copy=False)
+
+
+def filter_trips_incremental(df: pd.DataFrame, checkpoints, trip_column='trip_id'):
+    """Like filter_trips_batch(), but continue from earlier filter checkpoints.
+
+    A trip whose first samples are covered by one of `checkpoints` is
+    filtered only from the end of the checkpoint on. Returns the filtered
+    DataFrame and a dict of a new checkpoint per trip.
+    """
+    df = df.sort_values([trip_column, 'time'], kind='stable')
+    inputs = {key: np.asarray(val) for key, val in _filter_inputs(df).items()}
+    keys = df[trip_column].to_numpy()
+    offsets = partition_offsets(keys)
+    starts, ends = offsets[:-1], offsets[1:]
+    cp_by_start = {cp.start_time: cp for cp in checkpoints}
+
+    ms = np.empty((len(df), 2))
+    state_probs = np.empty((len(df), len(transport_modes)))
+    most_likely_path = np.empty(len(df), dtype=int)
+    trip_checkpoints = {}
+
+    # Trips without a usable checkpoint are filtered in one batch
+    batch_trips = []
+    for start, end in zip(starts, ends):
+        cp = cp_by_start.get(float(inputs['time'][start]))
+        if cp is None or not cp.covers(inputs['time'][start:end]):
+            batch_trips.append((start, end))
+            continue
+        done = start + len(cp)
+        if done < end:
+            cp = filter_trajectory_resume(cp, **{key: val[done:end] for key, val in inputs.items()})
+        ms[start:end] = cp.xy
+        state_probs[start:end] = cp.state_probs
+        most_likely_path[start:end] = checkpoint_path(cp)
+        trip_checkpoints[keys[start]] = cp
+
+    if batch_trips:
+        idx = np.concatenate([np.arange(start, end) for start, end in batch_trips])
+        offsets = np.cumsum([0] + [end - start for start, end in batch_trips])
+        batch_ms, _, batch_state_probs, batch_path, _, batch_checkpoints = filter_trajectories(
+            offsets, **{key: val[idx] for key, val in inputs.items()}, return_checkpoints=True,
+        )
+        ms[idx] = batch_ms[:, :2]
+        state_probs[idx] = batch_state_probs
+        most_likely_path[idx] = batch_path
+        for (start, _), cp in zip(batch_trips, batch_checkpoints):
+            trip_checkpoints[keys[start]] = cp
+
+    return _add_filter_results(df, ms, state_probs, most_likely_path, copy=False), trip_checkpoints
+
+
 def read_uuids_from_sql(conn):
     print('Reading uids')
     with conn.cursor() as cursor:
@@ -188,37 +398,26 @@ def read_uuids(conn):
     return uuids
 
 
-def get_transit_locations(conn, uid: str, start_time: datetime, end_time: datetime):
+def get_transit_locations(conn, uid: str, start_time: datetime, end_time: datetime, include_debug_columns=False):
+    """Read the transit vehicle locations near the samples of a device."""
     query = """
-        SELECT
-            vehicle_journey_ref,
-            vehicle_ref,
-            time,
-            extract(epoch from time) AS epoch_time,
-            ST_X(loc) AS x,
-            ST_Y(loc) AS y,
-            route_type,
-            (SELECT route_long_name FROM gtfs.routes
-                WHERE feed_index = vl.gtfs_feed_id AND route_id = vl.gtfs_route_id
-            ) AS route_name
-        FROM transitrt_vehiclelocation vl
+        SELECT ST_X(loc), ST_Y(loc)
+        FROM trips_ingest_location
         WHERE
-            time >= %(start)s :: timestamp - interval '1 minute' AND time <= %(end)s :: timestamp + interval '1 minute'
-            AND loc && (
-                SELECT ST_Buffer(ST_MakeLine(l.loc ORDER BY l.time), 200)
-                FROM trips_ingest_location AS l
-                WHERE
-                    time >= %(start)s :: timestamp
-                    AND time <= %(end)s :: timestamp
-                    AND uuid = %(uuid)s
-                    AND loc_error <= 200
-            )
+            time >= %(start)s AND time <= %(end)s
+            AND uuid = %(uuid)s
+            AND loc_error <= 200
         ORDER BY time
     """
-    params = dict(start=start_time, end=end_time, uuid=uid)
-
-    df = pd.read_sql_query(query, conn, params=params)
-    return df
+    with conn.cursor() as cursor:
+        cursor.execute(query, dict(start=start_time, end=end_time, uuid=uid))
+        coords = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 2)
+    if not len(coords):
+        columns = TRANSIT_CANDIDATE_COLUMNS + (TRANSIT_CANDIDATE_DEBUG_COLUMNS if include_debug_columns else [])
+        return pd.DataFrame(columns=[name for name, _, _ in columns if name != 'leg_id'])
+    legs = [(0, start_time, end_time, coords[:, 0], coords[:, 1])]
+    df = get_transit_candidates(conn, legs, include_debug_columns=include_debug_columns)
+    return df.drop(columns=['leg_id'])
 
 
 @numba.njit(cache=True)
@@ -298,64 +497,152 @@ ATYPE_BY_TRANSIT_TYPE = {
 }
 
 
+TRANSIT_CANDIDATE_COLUMNS = [
+    ('leg_id', 'vl.leg_id', pgcopy.INT8),
+    ('vehicle_journey_ref', 'vl.vehicle_journey_ref :: text', pgcopy.TEXT),
+    ('vehicle_ref', 'vl.vehicle_ref :: text', pgcopy.TEXT),
+    ('epoch_time', 'extract(epoch from vl.time) :: double precision', pgcopy.FLOAT8),
+    ('x', 'ST_X(vl.loc)', pgcopy.FLOAT8),
+    ('y', 'ST_Y(vl.loc)', pgcopy.FLOAT8),
+    ('route_type', 'vl.route_type :: integer', pgcopy.INT4),
+]
+TRANSIT_CANDIDATE_DEBUG_COLUMNS = [
+    ('time', 'vl.time', pgcopy.TIMESTAMPTZ),
+    ('route_name', 'r.route_long_name :: text', pgcopy.TEXT),
+]
+TRANSIT_CANDIDATE_DEBUG_JOINS = """LEFT JOIN gtfs.routes AS r ON
+    r.feed_index = vl.gtfs_feed_id AND r.route_id = vl.gtfs_route_id"""
+# Vehicle locations this far from a leg are candidates for it (m)
+TRANSIT_CANDIDATE_DISTANCE = 200
+# Transit vehicle locations are compacted into segments of this duration
+TRANSIT_SEGMENT_DURATION = timedelta(minutes=5)
+# Segments this close to the last compacted bucket may still get late
+# locations, so the locations in them are read from the raw table. This has
+# to be longer than the delay of the realtime feeds.
+TRANSIT_LATE_LOCATION_WINDOW = timedelta(minutes=30)
+
+
+def get_transit_candidates(conn, legs, include_debug_columns=False):
+    """Read the transit vehicle locations near the given legs in one query.
+
+    `legs` is a list of (leg_id, start_time, end_time, x, y) tuples, where `x`
+    and `y` are the coordinates of the leg samples. Returns one DataFrame
+    ordered by `leg_id` and time.
+    """
+    columns = list(TRANSIT_CANDIDATE_COLUMNS)
+    joins = ''
+    if include_debug_columns:
+        columns += TRANSIT_CANDIDATE_DEBUG_COLUMNS
+        joins = TRANSIT_CANDIDATE_DEBUG_JOINS
+    query = read_sql_file('read_transit_candidates').format(
+        columns=',\n    '.join('%s AS %s' % (expr, name) for name, expr, _ in columns),
+        joins=joins,
+    )
+    params = dict(
+        point_legs=np.concatenate([np.full(len(x), leg_id) for leg_id, _, _, x, _ in legs]).tolist(),
+        xs=np.concatenate([x for _, _, _, x, _ in legs]).astype(np.float64).tolist(),
+        ys=np.concatenate([y for _, _, _, _, y in legs]).astype(np.float64).tolist(),
+        leg_ids=[leg_id for leg_id, _, _, _, _ in legs],
+        start_times=[start for _, start, _, _, _ in legs],
+        end_times=[end for _, _, end, _, _ in legs],
+        srid=LOCAL_2D_CRS,
+        buffer=TRANSIT_CANDIDATE_DISTANCE,
+        segment_duration=TRANSIT_SEGMENT_DURATION,
+        late_window=TRANSIT_LATE_LOCATION_WINDOW,
+    )
+    return pgcopy.copy_query(conn, query, params, [(name, col_type) for name, _, col_type in columns])
+
+
+def match_transit_vehicle(leg_df: pd.DataFrame, transit_locs: pd.DataFrame):
+    """Return the atype of the transit vehicle `leg_df` was on, or None.
+
+    `leg_df` has the epoch time, x, y and location_std of the leg samples
+    and `transit_locs` the candidate vehicle locations for the leg.
+    """
+    first_locs = transit_locs.drop_duplicates('vehicle_ref')
+    transit_type_by_id = dict(zip(first_locs.vehicle_ref, first_locs.route_type))
+
+    transit_probs = transit_scores(leg_df, transit_locs)
+    transit_probs = sorted(
+        [(key, dist) for key, dist in transit_probs.items() if dist == dist],
+        key=lambda p: p[1]
+    )
+    if not len(transit_probs):
+        return None
+    vid, closest_dist = transit_probs[-1]
+    vtype = transit_type_by_id[vid]
+    max_dist = MAX_DISTANCE_BY_TRANSIT_TYPE.get(vtype, 30)
+
+    if closest_dist > -max_dist:
+        return ATYPE_BY_TRANSIT_TYPE[vtype]
+    return None
+
+
 def split_trip_legs(conn, uid, df, include_all=False):
+    """Split the samples of a trip into legs.
+
+    `df` is not modified. Returns a new DataFrame with the samples of the
+    legs (all samples with `include_all`) and a `leg_id` column, or None if
+    there are none.
+    """
     assert len(df.trip_id.unique()) == 1
 
     s = df['time'].dt.tz_convert(None) - pd.Timestamp('1970-01-01')
-    df['epoch_ts'] = s / pd.Timedelta('1s')
-    df['calc_speed'] = df.speed
-    df['int_atype'] = df.atype.map(ALL_ATYPES.index).astype(int)
-    df['leg_id'] = filter_legs(
-        time=df.epoch_ts.to_numpy(), x=df.x.to_numpy(), y=df.y.to_numpy(), atype=df.int_atype.to_numpy(),
-        distance=df.distance.to_numpy(), loc_error=df.loc_error.to_numpy(), speed=df.speed.to_numpy(dtype=np.float64, na_value=np.nan)
+    epoch_ts = (s / pd.Timedelta('1s')).to_numpy()
+    # filter_legs() fixes the activity types and distances in place
+    int_atype = df.atype.map(ALL_ATYPES.index).to_numpy(dtype=np.int64)
+    distance = df.distance.to_numpy(dtype=np.float64, copy=True)
+    leg_ids = filter_legs(
+        time=epoch_ts, x=df.x.to_numpy(), y=df.y.to_numpy(), atype=int_atype,
+        distance=distance, loc_error=df.loc_error.to_numpy(), speed=df.speed.to_numpy(dtype=np.float64, na_value=np.nan)
     )
-    df.atype = df.int_atype.map(lambda x: ALL_ATYPES[x])
 
-    if False:
-        pd.set_option("max_rows", None)
-        pd.set_option("min_rows", None)
-        print(df.set_index(df.time.dt.tz_convert(LOCAL_TZ)).drop(columns=['time']))
-
-    if not include_all:
-        df = df[df.leg_id != -1]
-    if not len(df):
+    if include_all:
+        rows = np.arange(len(df))
+    else:
+        rows = np.flatnonzero(leg_ids != -1)
+    if not len(rows):
         return None
 
-    df = df.copy()
-
-    for leg_id in df.leg_id.unique():
-        leg_df = df[df.leg_id == leg_id].copy()
-        if leg_df.iloc[0].atype != 'in_vehicle':
-            continue
-
+    df = df.take(rows)
+    df['distance'] = distance[rows]
+    df['leg_id'] = leg_ids = leg_ids[rows]
+    atypes = np.array(ALL_ATYPES, dtype=object)[int_atype[rows]]
+    epoch_ts = epoch_ts[rows]
+    x = df.x.to_numpy()
+    y = df.y.to_numpy()
+    loc_error = df.loc_error.to_numpy()
+    times = df.time
+
+    # The samples of a leg are consecutive once the dropped ones are skipped
+    leg_rows = np.flatnonzero(leg_ids != -1)
+    offsets = partition_offsets(leg_ids[leg_rows])
+    vehicle_legs = [
+        leg_rows[start:end] for start, end in zip(offsets[:-1], offsets[1:])
+        if atypes[leg_rows[start]] == 'in_vehicle'
+    ]
+    if vehicle_legs:
+        # The candidate vehicles for all the legs are read at once
         try:
-            transit_locs = get_transit_locations(conn, uid, leg_df.time.min(), leg_df.time.max())
-        except pd.io.sql.DatabaseError as e:
+            candidates = get_transit_candidates(conn, [
+                (leg_idx, times.iloc[idx[0]], times.iloc[idx[-1]], x[idx], y[idx])
+                for leg_idx, idx in enumerate(vehicle_legs)
+            ])
+        except DatabaseError as e:
             logger.error('Error when querying transit locations from the db.', exc_info=e)
-            continue
-        if not len(transit_locs):
-            continue
-        transit_locs['time'] = transit_locs.epoch_time
-        leg_df['location_std'] = leg_df['loc_error']
-        transit_loc_by_id = {vech: d for vech, d in transit_locs.groupby('vehicle_ref')}
-        transit_type_by_id = {vech: d.iloc[0].route_type for vech, d in transit_loc_by_id.items()}
-
-        leg_df['time'] = df['epoch_ts'].astype(float)
-        transit_probs = transit_prob_ests_糞(leg_df, transit_loc_by_id)
-        transit_probs = sorted(
-            [(key, dist) for key, dist in transit_probs.items() if dist == dist],
-            key=lambda p: p[1]
-        )
-        if not len(transit_probs):
-            continue
-        vid, closest_dist = transit_probs[-1]
-        vtype = transit_type_by_id[vid]
-        max_dist = MAX_DISTANCE_BY_TRANSIT_TYPE.get(vtype, 30)
-
-        if closest_dist > -max_dist:
-            df.loc[df.leg_id == leg_id, 'atype'] = ATYPE_BY_TRANSIT_TYPE[vtype]
-
-    df = df.drop(columns=['epoch_ts', 'calc_speed', 'int_atype'])
+            candidates = None
+        if candidates is not None and len(candidates):
+            candidates['time'] = candidates['epoch_time']
+            leg_idxs = candidates['leg_id'].to_numpy()
+            cand_offsets = partition_offsets(leg_idxs)
+            for start, end in zip(cand_offsets[:-1], cand_offsets[1:]):
+                idx = vehicle_legs[leg_idxs[start]]
+                leg_df = pd.DataFrame(dict(time=epoch_ts[idx], x=x[idx], y=y[idx], location_std=loc_error[idx]))
+                atype = match_transit_vehicle(leg_df, candidates.iloc[start:end])
+                if atype is not None:
+                    atypes[idx] = atype
+
+    df['atype'] = atypes
 
     return df
 
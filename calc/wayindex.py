@@ -0,0 +1,294 @@
+"""In-process spatial index of OSM ways for nearest-way lookups.
+
+The ways are split into segments of at most MAX_SEGMENT_LENGTH meters and
+bucketed into a uniform grid of CELL_SIZE meter cells by segment midpoint.
+The segments are sorted by cell, so each cell is a contiguous slice of the
+segment arrays (found with a binary search over the sorted cell keys).
+
+An index is stored as a directory of .npy files that are memory-mapped on
+load; all worker processes on a host share the same pages.
+"""
+import json
+import os
+import shutil
+import tempfile
+
+import numba
+import numpy as np
+import pandas as pd
+from shapely import wkb
+
+
+CELL_SIZE = 50.0
+MAX_SEGMENT_LENGTH = 50.0
+MAX_WAY_DISTANCE = 50.0
+
+# Table, way type column
+WAY_LAYERS = {
+    'car': ('planet_osm_car_ways', 'highway'),
+    'rail': ('planet_osm_rail_ways', 'railway'),
+}
+
+ARRAYS = ('segments', 'seg_way', 'cell_keys', 'cell_starts', 'way_ids', 'way_names', 'way_types')
+
+
+def _line_coords(geom):
+    if hasattr(geom, 'geoms'):
+        for g in geom.geoms:
+            yield from _line_coords(g)
+    else:
+        yield np.asarray(geom.coords, dtype=np.float64)[:, :2]
+
+
+def subdivide_line(coords, max_length=MAX_SEGMENT_LENGTH):
+    """Return an (n, 4) array of segments at most `max_length` long."""
+    if len(coords) < 2:
+        return np.empty((0, 4))
+    start = coords[:-1]
+    delta = coords[1:] - start
+    lengths = np.hypot(delta[:, 0], delta[:, 1])
+    pieces = np.maximum(np.ceil(lengths / max_length), 1).astype(np.int64)
+    src = np.repeat(np.arange(len(start)), pieces)
+    # Position of each piece within its source segment
+    first = np.cumsum(pieces) - pieces
+    k = np.arange(len(src)) - np.repeat(first, pieces)
+    f0 = (k / pieces[src])[:, None]
+    f1 = ((k + 1) / pieces[src])[:, None]
+    p0 = start[src] + delta[src] * f0
+    p1 = start[src] + delta[src] * f1
+    return np.hstack([p0, p1])
+
+
+class WayIndex:
+    def __init__(self, arrays, origin, nx, ny, cell_size=CELL_SIZE, max_segment_length=MAX_SEGMENT_LENGTH):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.origin = origin
+        self.nx = nx
+        self.ny = ny
+        self.cell_size = cell_size
+        self.max_segment_length = max_segment_length
+
+    @classmethod
+    def build(cls, ways: pd.DataFrame, cell_size=CELL_SIZE, max_segment_length=MAX_SEGMENT_LENGTH):
+        """Build an index from a DataFrame with osm_id, name, type and coords columns.
+
+        `coords` is a list of (n, 2) coordinate arrays per way.
+        """
+        seg_parts = []
+        way_parts = []
+        for idx, lines in enumerate(ways['coords']):
+            for coords in lines:
+                segs = subdivide_line(coords, max_segment_length)
+                seg_parts.append(segs)
+                way_parts.append(np.full(len(segs), idx, dtype=np.int32))
+        if seg_parts:
+            segments = np.vstack(seg_parts)
+            seg_way = np.concatenate(way_parts)
+        else:
+            segments = np.empty((0, 4))
+            seg_way = np.empty(0, dtype=np.int32)
+
+        if len(segments):
+            origin = (
+                float(np.floor(segments[:, [0, 2]].min() / cell_size) * cell_size),
+                float(np.floor(segments[:, [1, 3]].min() / cell_size) * cell_size),
+            )
+            nx = int((segments[:, [0, 2]].max() - origin[0]) // cell_size) + 1
+            ny = int((segments[:, [1, 3]].max() - origin[1]) // cell_size) + 1
+        else:
+            origin = (0.0, 0.0)
+            nx = ny = 0
+
+        mid_x = (segments[:, 0] + segments[:, 2]) / 2
+        mid_y = (segments[:, 1] + segments[:, 3]) / 2
+        keys = (
+            ((mid_y - origin[1]) // cell_size).astype(np.int64) * nx
+            + ((mid_x - origin[0]) // cell_size).astype(np.int64)
+        )
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        cell_keys, cell_starts = np.unique(keys, return_index=True)
+
+        arrays = dict(
+            segments=np.ascontiguousarray(segments[order]),
+            seg_way=seg_way[order],
+            cell_keys=cell_keys,
+            cell_starts=np.append(cell_starts, len(keys)).astype(np.int64),
+            way_ids=ways['osm_id'].to_numpy(dtype=np.int64),
+            way_names=ways['name'].fillna('').to_numpy(dtype=str),
+            way_types=ways['type'].fillna('').to_numpy(dtype=str),
+        )
+        return cls(arrays, origin, nx, ny, cell_size, max_segment_length)
+
+    @classmethod
+    def from_db(cls, conn, table, type_column, **kwargs):
+        query = f'SELECT osm_id, name, {type_column} AS type, ST_AsBinary(way) AS way FROM {table}'
+        with conn.cursor() as cursor:
+            cursor.execute(query)
+            rows = cursor.fetchall()
+        ways = pd.DataFrame(rows, columns=['osm_id', 'name', 'type', 'way'])
+        ways['coords'] = [list(_line_coords(wkb.loads(bytes(w)))) for w in ways.pop('way')]
+        return cls.build(ways, **kwargs)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(path, '%s.npy' % name), getattr(self, name))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(dict(
+                origin=self.origin, nx=self.nx, ny=self.ny, cell_size=self.cell_size,
+                max_segment_length=self.max_segment_length,
+            ), f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(path, '%s.npy' % name), mmap_mode=mmap_mode) for name in ARRAYS}
+        return cls(arrays, tuple(meta['origin']), meta['nx'], meta['ny'], meta['cell_size'], meta['max_segment_length'])
+
+    def nearest(self, x, y, max_dist=MAX_WAY_DISTANCE):
+        """Find the closest way for each point.
+
+        Returns the distances (NaN if no way within `max_dist`) and the way
+        indexes (-1 if none).
+        """
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        y = np.ascontiguousarray(y, dtype=np.float64)
+        # A segment within max_dist has its midpoint within this many cells
+        reach = int(np.ceil((max_dist + self.max_segment_length / 2) / self.cell_size))
+        return _nearest_segments(
+            x, y, self.segments, self.seg_way, self.cell_keys, self.cell_starts,
+            self.origin[0], self.origin[1], self.cell_size, self.nx, self.ny, reach, max_dist,
+        )
+
+
+@numba.njit(cache=True)
+def _nearest_segments(px, py, segments, seg_way, cell_keys, cell_starts, x0, y0, cell_size, nx, ny, reach, max_dist):
+    n = len(px)
+    dists = np.full(n, np.nan)
+    ways = np.full(n, -1, dtype=np.int64)
+    for i in range(n):
+        x = px[i]
+        y = py[i]
+        if not (np.isfinite(x) and np.isfinite(y)):
+            continue
+        cx = int(np.floor((x - x0) / cell_size))
+        cy = int(np.floor((y - y0) / cell_size))
+        best = max_dist * max_dist
+        best_seg = -1
+        for gy in range(max(cy - reach, 0), min(cy + reach + 1, ny)):
+            for gx in range(max(cx - reach, 0), min(cx + reach + 1, nx)):
+                key = gy * nx + gx
+                k = np.searchsorted(cell_keys, key)
+                if k >= len(cell_keys) or cell_keys[k] != key:
+                    continue
+                for s in range(cell_starts[k], cell_starts[k + 1]):
+                    ax = segments[s, 0]
+                    ay = segments[s, 1]
+                    dx = segments[s, 2] - ax
+                    dy = segments[s, 3] - ay
+                    seg_len2 = dx * dx + dy * dy
+                    t = 0.0
+                    if seg_len2 > 0:
+                        t = ((x - ax) * dx + (y - ay) * dy) / seg_len2
+                        t = min(max(t, 0.0), 1.0)
+                    ex = ax + t * dx - x
+                    ey = ay + t * dy - y
+                    d2 = ex * ex + ey * ey
+                    if d2 <= best:
+                        best = d2
+                        best_seg = s
+        if best_seg >= 0:
+            dists[i] = np.sqrt(best)
+            ways[i] = seg_way[best_seg]
+    return dists, ways
+
+
+class WayIndexSet:
+    """The car and rail way indexes stored under one directory."""
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        return cls({layer: WayIndex.load(os.path.join(path, layer), mmap=mmap) for layer in WAY_LAYERS})
+
+    @classmethod
+    def build_from_db(cls, conn, path):
+        """Build all indexes and atomically replace the ones stored in `path`.
+
+        `path` is a symlink to a versioned directory next to it, and a new
+        version is taken into use by replacing the symlink, so `path` always
+        exists for the processes loading it.
+        """
+        path = os.path.abspath(path)
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        prefix = '.%s-' % os.path.basename(path)
+        version_path = tempfile.mkdtemp(dir=parent, prefix=prefix)
+        try:
+            for layer, (table, type_column) in WAY_LAYERS.items():
+                WayIndex.from_db(conn, table, type_column).save(os.path.join(version_path, layer))
+            os.chmod(version_path, 0o755)
+            if os.path.isdir(path) and not os.path.islink(path):
+                # An index built before the indexes were versioned
+                os.rename(path, version_path + '.old')
+            previous = os.path.realpath(path) if os.path.islink(path) else None
+            link_path = version_path + '.link'
+            os.symlink(os.path.basename(version_path), link_path)
+            os.replace(link_path, path)
+        except Exception:
+            shutil.rmtree(version_path, ignore_errors=True)
+            raise
+        # The previous version is kept for processes that resolved the old
+        # symlink just before it was replaced; older ones are removed.
+        # Processes that have mapped removed files keep them until they reload.
+        keep = {version_path, previous}
+        for fn in os.listdir(parent):
+            old_path = os.path.join(parent, fn)
+            if fn.startswith(prefix) and old_path not in keep and os.path.isdir(old_path):
+                shutil.rmtree(old_path, ignore_errors=True)
+
+    def add_way_columns(self, df: pd.DataFrame, include_names=True):
+        """Add the closest_<layer>_way_* columns for the x and y columns of `df`.
+
+        Without `include_names` only the distance columns are added.
+        """
+        x = df['x'].to_numpy(dtype=np.float64)
+        y = df['y'].to_numpy(dtype=np.float64)
+        for layer, index in self.indexes.items():
+            dists, ways = index.nearest(x, y)
+            found = ways >= 0
+            way_idx = np.where(found, ways, 0)
+            prefix = 'closest_%s_way_' % layer
+            df[prefix + 'dist'] = np.round(dists, 1).astype(np.float32)
+            if not include_names:
+                continue
+            if len(index.way_ids):
+                names = index.way_names[way_idx]
+                types = index.way_types[way_idx]
+                ids = index.way_ids[way_idx].astype(str)
+            else:
+                names = types = ids = np.full(len(df), '')
+            df[prefix + 'name'] = pd.Series(names, index=df.index, dtype=object).where(found, None)
+            df[prefix + 'type'] = pd.Series(types, index=df.index, dtype=object).where(found, None)
+            df[prefix + 'id'] = pd.Series(ids, index=df.index, dtype=object).where(found, None)
+        return df
+
+
+_loaded = {}
+
+
+def get_way_index(path) -> WayIndexSet:
+    """Return the index stored in `path`, loading it again if it has been rebuilt."""
+    meta_path = os.path.join(path, 'car', 'meta.json')
+    mtime = os.stat(meta_path).st_mtime_ns
+    cached = _loaded.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, WayIndexSet.load(path))
+        _loaded[path] = cached
+    return cached[1]
@@ -106,7 +106,7 @@ def make_transit_layer(df):
         return None
 
     print('reading transit')
-    trdf = get_transit_locations(conn, locations_uuid, df.time.min(), df.time.max())
+    trdf = get_transit_locations(conn, locations_uuid, df.time.min(), df.time.max(), include_debug_columns=True)
     print('transit rows:')
     print(trdf)
     if not len(trdf):
@@ -522,7 +522,7 @@ def render_output(new_path, disable_filters, show_probs):
 
     if locations_uuid is None or locations_uuid != new_uid or filters_enabled != new_filtered:
         pc.display('reading trips for %s' % new_uid)
-        df = read_locations(conn, new_uid, include_all=True, start_time='2022-01-01')
+        df = read_locations(conn, new_uid, include_all=True, start_time='2022-01-01', include_debug_columns=True)
         pc.display('trips read (%d rows)' % len(df))
         df.time = pd.to_datetime(df.time, utc=True)
 
@@ -0,0 +1,18 @@
+"""
+ASGI config for mocaf project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Serving through ASGI lets the buffered ingest view run without tying up a
+worker thread per request.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mocaf.settings")
+
+application = get_asgi_application()
@@ -47,6 +47,16 @@ env = environ.Env(
     INTERNAL_IPS=(list, []),
     PROMETHEUS_METRICS_AUTH_TOKEN=(str, None),
     PROMETHEUS_EXPORT_MIGRATIONS=(bool, False),
+    INGEST_SHARDS=(int, 1),
+    INGEST_DEVICE_CACHE_TTL=(int, 60),
+    INGEST_DEVICE_CACHE_ALIAS=(str, ''),
+    INGEST_DEVICE_CACHE_NEGATIVE_TTL=(int, 5),
+    INGEST_BUFFER_ENABLED=(bool, False),
+    INGEST_BUFFER_REDIS_URL=(str, ''),
+    INGEST_ARCHIVE_DIR=(str, ''),
+    WAY_INDEX_DIR=(str, ''),
+    TRANSITRT_LOCATION_RETENTION_DAYS=(int, 0),
+    TRIPS_RECONCILE_LEGS=(bool, False),
 )
 PROMETHEUS_EXPORT_MIGRATIONS = env('PROMETHEUS_EXPORT_MIGRATIONS')
 
@@ -93,6 +103,32 @@ TRANSITRT_TASKS = {'transitrt-import-%s' % key: dict(
     args=(key,),
 ) for key, val in TRANSITRT_IMPORTERS.items()}
 
+# If set, raw transit vehicle locations older than this many days are
+# dropped once they have been compacted into trajectory segments
+TRANSITRT_LOCATION_RETENTION_DAYS = env('TRANSITRT_LOCATION_RETENTION_DAYS')
+
+# Number of parallel workers that process received ingest data
+INGEST_SHARDS = env('INGEST_SHARDS')
+
+# Device metadata cache for the ingest endpoint. If an alias from CACHES is
+# given, the entries are shared between processes through that cache.
+# Unknown uuids are cached for a shorter time (0 disables caching them), so
+# uploads from a device that has just registered get linked to it.
+INGEST_DEVICE_CACHE_SIZE = 10000
+INGEST_DEVICE_CACHE_TTL = env('INGEST_DEVICE_CACHE_TTL')
+INGEST_DEVICE_CACHE_NEGATIVE_TTL = env('INGEST_DEVICE_CACHE_NEGATIVE_TTL')
+INGEST_DEVICE_CACHE_ALIAS = env('INGEST_DEVICE_CACHE_ALIAS') or None
+
+# If enabled, the ingest endpoint only appends uploads to a Redis stream
+# and a periodic task flushes them to the database in batches.
+INGEST_BUFFER_ENABLED = env('INGEST_BUFFER_ENABLED')
+INGEST_BUFFER_REDIS_URL = env('INGEST_BUFFER_REDIS_URL') or env('CELERY_BROKER_URL')
+INGEST_BUFFER_STREAM = 'mocaf:ingest'
+
+# If set, processed ReceiveData payloads are moved from the database to
+# hourly segment files in this directory
+INGEST_ARCHIVE_DIR = env('INGEST_ARCHIVE_DIR')
+
 CELERY_BROKER_URL = env('CELERY_BROKER_URL')
 CELERY_RESULT_BACKEND = env('CELERY_RESULT_BACKEND')
 
@@ -104,9 +140,23 @@ CELERY_BEAT_SCHEDULE = {
             'expires': 30,
         }
     },
+    'archive-received-data': {
+        'task': 'trips_ingest.tasks.archive_received_data',
+        'schedule': 600,
+        'options': {
+            'expires': 300,
+        }
+    },
+    'compact-transit-locations': {
+        'task': 'transitrt.tasks.compact_vehicle_locations',
+        'schedule': 60,
+        'options': {
+            'expires': 30,
+        }
+    },
     'generate-new-trips': {
         'task': 'trips.tasks.generate_new_trips',
-        'schedule': 240,
+        'schedule': 60,
         'options': {
             'expires': 30,
         }
@@ -164,6 +214,14 @@ CELERY_BEAT_SCHEDULE = {
     # },
     **TRANSITRT_TASKS,
 }
+if INGEST_BUFFER_ENABLED:
+    CELERY_BEAT_SCHEDULE['flush-ingest-buffer'] = {
+        'task': 'trips_ingest.tasks.flush_ingest_buffer',
+        'schedule': 5,
+        'options': {
+            'expires': 4,
+        }
+    }
 CELERY_TASK_ROUTES = {
     'transitrt.tasks.*': {'queue': 'transitrt'},
     'trips.tasks.*': {'queue': 'trips'},
@@ -361,6 +419,19 @@ BASE_URL = 'http://example.com'
 
 LOCAL_SRS = 3067  # ETRS-TM35-FIN
 
+# Trips are generated for a device once no new location samples have been
+# ingested for it for this many seconds
+TRIP_GENERATION_QUIET_PERIOD = 90
+
+# Directory of the in-process OSM way index used in trip generation (built
+# with the `build_way_index` management command). If unset, the closest ways
+# are looked up in the database.
+WAY_INDEX_DIR = env('WAY_INDEX_DIR')
+
+# If set, re-generated trips update the matching existing legs in place
+# instead of deleting and recreating all overlapping trips
+TRIPS_RECONCILE_LEGS = env('TRIPS_RECONCILE_LEGS')
+
 # How many hours a trip leg is editable by the user
 ALLOWED_TRIP_UPDATE_HOURS = 3 * 24
 
@@ -9,7 +9,7 @@ from wagtail.admin import urls as wagtailadmin_urls
 # from wagtail.core import urls as wagtail_urls
 from wagtail.documents import urls as wagtaildocs_urls
 
-from trips_ingest.api import ingest_view, upload_log_view
+from trips_ingest.api import ingest_buffered_view, ingest_view, upload_log_view
 from analytics.views import area_type_topojson, area_type_geojson, area_type_stats, cubejs_api_request
 from .graphql_views import MocafGraphQLView
 from .views import health_view, prometheus_exporter_view
@@ -25,7 +25,7 @@ urlpatterns = [
     path('v1/area-type-<int:id>.topojson', area_type_topojson, name='area-type-topojson'),
     path('v1/area-type-<int:id>.geojson', area_type_geojson, name='area-type-geojson'),
     path('v1/area-type-<int:id>-stats-<str:type>.csv', area_type_stats, name='area-type-stats'),
-    path('v1/ingest/', csrf_exempt(ingest_view)),
+    path('v1/ingest/', ingest_buffered_view if settings.INGEST_BUFFER_ENABLED else csrf_exempt(ingest_view)),
     path('v1/upload-log/<slug:uuid>/', csrf_exempt(upload_log_view), name='upload-debug-log'),
     re_path('^cubejs-api/v1', cubejs_api_request, name='cubejs-api'),
     path('analytics/', TemplateView.as_view(template_name='analytics/home.html')),
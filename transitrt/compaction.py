@@ -0,0 +1,121 @@
+"""Compaction of transit vehicle locations into per-journey segments.
+
+The locations of each vehicle journey are folded into one
+VehicleTrajectorySegment per SEGMENT_DURATION time bucket. Only buckets
+that ended at least COMPACTION_DELAY ago are compacted, and every run
+compacts again the buckets within LATE_LOCATION_WINDOW of the last
+compacted bucket to pick up locations that arrived late. Until a bucket is
+out of that window, its locations are read from the raw table.
+"""
+import logging
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from calc.trips import TRANSIT_LATE_LOCATION_WINDOW, TRANSIT_SEGMENT_DURATION
+
+from .models import VehicleLocation, VehicleTrajectorySegment
+
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_DURATION = TRANSIT_SEGMENT_DURATION
+# Buckets this close to the last compacted bucket are compacted again
+LATE_LOCATION_WINDOW = TRANSIT_LATE_LOCATION_WINDOW
+COMPACTION_DELAY = timedelta(minutes=2)
+# At most this much is compacted per run, so catching up is done in steps
+MAX_COMPACTION_RANGE = timedelta(hours=6)
+
+LOCATION_TABLE = VehicleLocation._meta.db_table
+SEGMENT_TABLE = VehicleTrajectorySegment._meta.db_table
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def floor_to_bucket(time):
+    buckets = (time - EPOCH) // SEGMENT_DURATION
+    return EPOCH + buckets * SEGMENT_DURATION
+
+
+def get_compacted_until():
+    """Return the end of the last compacted bucket (None if none)."""
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT MAX(bucket) FROM {SEGMENT_TABLE}')
+        last_bucket = cursor.fetchone()[0]
+    if last_bucket is None:
+        return None
+    return last_bucket + SEGMENT_DURATION
+
+
+def compact_vehicle_locations(now=None):
+    if now is None:
+        now = timezone.now()
+    compacted_until = get_compacted_until()
+    # Continue from the first location in the late location window before the
+    # end of the compacted buckets, which also skips periods without any
+    # locations
+    query = f'SELECT MIN(time) FROM {LOCATION_TABLE}'
+    params = {}
+    if compacted_until is not None:
+        query += ' WHERE time >= %(since)s'
+        params['since'] = compacted_until - LATE_LOCATION_WINDOW
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        first_time = cursor.fetchone()[0]
+    if first_time is None:
+        return 0
+    start = floor_to_bucket(first_time)
+    end = min(floor_to_bucket(now - COMPACTION_DELAY), start + MAX_COMPACTION_RANGE)
+    if start >= end:
+        return 0
+
+    query = f'''
+        INSERT INTO {SEGMENT_TABLE} (
+            vehicle_journey_ref, bucket, vehicle_ref, route_type, gtfs_feed_id, gtfs_route_id,
+            start_time, end_time, locs, times
+        )
+        SELECT
+            vehicle_journey_ref,
+            time_bucket(%(duration)s, time) AS bucket,
+            (array_agg(vehicle_ref ORDER BY time))[1],
+            (array_agg(route_type ORDER BY time))[1],
+            (array_agg(gtfs_feed_id ORDER BY time))[1],
+            (array_agg(gtfs_route_id ORDER BY time))[1],
+            MIN(time),
+            MAX(time),
+            ST_Multi(ST_Collect(loc ORDER BY time)),
+            array_agg(extract(epoch from time) :: double precision ORDER BY time)
+        FROM {LOCATION_TABLE}
+        WHERE time >= %(start)s AND time < %(end)s
+        GROUP BY vehicle_journey_ref, bucket
+        ON CONFLICT (vehicle_journey_ref, bucket) DO UPDATE SET
+            vehicle_ref = EXCLUDED.vehicle_ref,
+            route_type = EXCLUDED.route_type,
+            gtfs_feed_id = EXCLUDED.gtfs_feed_id,
+            gtfs_route_id = EXCLUDED.gtfs_route_id,
+            start_time = EXCLUDED.start_time,
+            end_time = EXCLUDED.end_time,
+            locs = EXCLUDED.locs,
+            times = EXCLUDED.times
+        WHERE {SEGMENT_TABLE}.times IS DISTINCT FROM EXCLUDED.times
+    '''
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(query, dict(duration=SEGMENT_DURATION, start=start, end=end))
+            count = cursor.rowcount
+    logger.info('Compacted %d vehicle journey segments between %s and %s' % (count, start, end))
+
+    retention_days = settings.TRANSITRT_LOCATION_RETENTION_DAYS
+    if retention_days:
+        # Raw locations are only dropped once they can no longer be compacted
+        # again, as they are still read from the raw table until then
+        older_than = min(now - timedelta(days=retention_days), start)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT drop_chunks(%(table)s, older_than => %(older_than)s)',
+                dict(table=LOCATION_TABLE, older_than=older_than)
+            )
+
+    return count
@@ -0,0 +1,37 @@
+import django.contrib.gis.db.models.fields
+import django.contrib.postgres.fields
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transitrt', '0002_add_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VehicleTrajectorySegment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vehicle_journey_ref', models.CharField(max_length=50)),
+                ('bucket', models.DateTimeField(db_index=True)),
+                ('vehicle_ref', models.CharField(max_length=30)),
+                ('route_type', models.PositiveBigIntegerField(null=True)),
+                ('gtfs_feed_id', models.IntegerField(null=True)),
+                ('gtfs_route_id', models.TextField(null=True)),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField()),
+                ('locs', django.contrib.gis.db.models.fields.MultiPointField(srid=settings.LOCAL_SRS)),
+                ('times', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), size=None)),
+            ],
+            options={
+                'unique_together': {('vehicle_journey_ref', 'bucket')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='vehicletrajectorysegment',
+            index=models.Index(fields=['start_time', 'end_time'], name='transitrt_segment_time_idx'),
+        ),
+    ]
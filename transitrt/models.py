@@ -1,5 +1,6 @@
 from django.conf import settings
 from django.contrib.gis.db import models
+from django.contrib.postgres.fields import ArrayField
 from gtfs.models import Route, FeedInfo
 
 
@@ -26,3 +27,30 @@ class VehicleLocation(models.Model):
         return '%s (%s) - %s - %s' % (
             self.route, self.direction_ref, self.vehicle_ref, self.time
         )
+
+
+class VehicleTrajectorySegment(models.Model):
+    """The locations of a vehicle journey within one time bucket.
+
+    Built from VehicleLocation rows by transitrt.compaction. `times` has the
+    timestamps (seconds since the Unix epoch) of the points in `locs`.
+    """
+    vehicle_journey_ref = models.CharField(max_length=50)
+    bucket = models.DateTimeField(db_index=True)
+    vehicle_ref = models.CharField(max_length=30)
+    route_type = models.PositiveBigIntegerField(null=True)
+    gtfs_feed_id = models.IntegerField(null=True)
+    gtfs_route_id = models.TextField(null=True)
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+    locs = models.MultiPointField(srid=settings.LOCAL_SRS)
+    times = ArrayField(models.FloatField())
+
+    class Meta:
+        unique_together = (('vehicle_journey_ref', 'bucket'),)
+        indexes = [
+            models.Index(fields=['start_time', 'end_time'], name='transitrt_segment_time_idx'),
+        ]
+
+    def __str__(self):
+        return '%s (%s) - %s - %s' % (self.vehicle_journey_ref, self.vehicle_ref, self.start_time, self.end_time)
@@ -4,17 +4,19 @@ import logging
 from datetime import datetime, timedelta
 from typing import Dict
 
+import numpy as np
 import pytz
 import requests
 from psycopg2.extras import execute_values
 from django.db import transaction, connection
 from django.conf import settings
-from django.contrib.gis.geos import Point
-from django.contrib.gis.gdal import CoordTransform, SpatialReference
+from django.utils import timezone
 
+from transitrt.compaction import LATE_LOCATION_WINDOW
 from transitrt.models import VehicleLocation
 from trips.models import TransportMode
 from gtfs.models import FeedInfo, Route
+from utils.geo import finland_bounds_mask, gps_to_local
 from .exceptions import CommonTaskFailure
 
 
@@ -24,11 +26,6 @@ MAX_TIME_IN_PAST = 120  # s
 
 LOCAL_TZ = pytz.timezone('Europe/Helsinki')
 
-GPS_SRS = SpatialReference('WGS84')
-LOCAL_SRS = SpatialReference(settings.LOCAL_SRS)
-
-gps_to_local = CoordTransform(GPS_SRS, LOCAL_SRS)
-
 
 class TransitRTImporter:
     ROUTE_TYPE_TRAM = 0
@@ -118,10 +115,21 @@ class TransitRTImporter:
         self._batch_jids.add(vjid)
         self._batch.append(act)
 
+    def filter_out_of_bounds(self, acts):
+        if not acts:
+            return acts
+        lon = np.array([act['loc']['lon'] for act in acts], dtype=np.float64)
+        lat = np.array([act['loc']['lat'] for act in acts], dtype=np.float64)
+        mask = finland_bounds_mask(lon, lat)
+        if mask.all():
+            return acts
+        self.logger.info('Skipping %d vehicle locations outside Finland' % np.count_nonzero(~mask))
+        return [act for act, inside in zip(acts, mask) if inside]
+
     def commit(self):
         self.update_cached_locs(self._batch_jids)
         new_objs = []
-        for act in self._batch:
+        for act in self.filter_out_of_bounds(self._batch):
             vjid = act['vehicle_journey_ref']
             j = self.cached_journeys.get(vjid)
             # Ensure the new sample is fresh enough
@@ -135,6 +143,14 @@ class TransitRTImporter:
         self._batch = []
         self._batch_jids = set()
 
+        # Locations this late are before the window that compaction
+        # rewrites, so they never reach the segments and transit candidate
+        # queries do not see them
+        compaction_cutoff = timezone.now() - LATE_LOCATION_WINDOW
+        n_late = len([act for act in new_objs if act['time'] < compaction_cutoff])
+        if n_late:
+            self.logger.warning('%d observations arrived too late to be compacted' % n_late)
+
         self.logger.info('Saving %d observations' % len(new_objs))
         if new_objs:
             self.bulk_insert_locations(new_objs)
@@ -152,15 +168,13 @@ class TransitRTImporter:
         table_name = VehicleLocation._meta.db_table
         local_srs = settings.LOCAL_SRS
 
-        # Reuse the same point object for better performance
-        point = Point(x=0, y=0, srid=4326)
+        lon = np.array([obj['loc']['lon'] for obj in objs], dtype=np.float64)
+        lat = np.array([obj['loc']['lat'] for obj in objs], dtype=np.float64)
+        xs, ys = gps_to_local(lon, lat, local_srs)
 
-        for obj in objs:
-            point.x = obj['loc']['lon']
-            point.y = obj['loc']['lat']
-            point.transform(gps_to_local)
-            obj['x'] = point.x
-            obj['y'] = point.y
+        for obj, x, y in zip(objs, xs.tolist(), ys.tolist()):
+            obj['x'] = x
+            obj['y'] = y
             obj['gtfs_feed'] = self.gtfs_feed.pk if self.gtfs_feed is not None else None
             if 'bearing' not in obj:
                 obj['bearing'] = None
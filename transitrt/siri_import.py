@@ -7,10 +7,6 @@ from .rt_import import TransitRTImporter
 
 
 MIN_TIME_BETWEEN_LOCATIONS = 2  # in seconds
-FINLAND_BOUNDS = {
-    'lat': [59.846373196, 70.1641930203],
-    'lon': [20.6455928891, 31.5160921567]
-}
 
 LOCAL_TZ = pytz.timezone('Europe/Helsinki')
 
@@ -35,16 +31,9 @@ class SiriImporter(TransitRTImporter):
         else:
             route_type = route.type_id
             route = route.pk
+        # Coordinates outside Finland are filtered out for the whole batch on commit
         lon = d['VehicleLocation']['Longitude']
         lat = d['VehicleLocation']['Latitude']
-        min_lon, max_lon = FINLAND_BOUNDS['lon']
-        min_lat, max_lat = FINLAND_BOUNDS['lat']
-        if (lon < min_lon or lon > max_lon or lat < min_lat or lat > max_lat):
-            self.logger.info(
-                f'Siri import: vehicle coordinates {lat} {lon} outside Finland. Skipping coordinate point.'
-            )
-            return None
-
         loc = dict(lon=lon, lat=lat)
         jr = d['FramedVehicleJourneyRef']
         journey_ref = '%s:%s' % (jr['DataFrameRef']['value'], jr['DatedVehicleJourneyRef'])
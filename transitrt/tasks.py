@@ -1,4 +1,5 @@
 import logging
+from transitrt import compaction
 from transitrt.exceptions import CommonTaskFailure
 from transitrt.rt_import import make_importer
 from celery import shared_task
@@ -31,3 +32,9 @@ def fetch_live_locations_tampere(importer_id):
 def fetch_live_locations_rata(importer_id):
     assert importer_id == 'rata'
     fetch_live_locations(importer_id)
+
+
+@shared_task(ignore_result=True)
+def compact_vehicle_locations():
+    count = compaction.compact_vehicle_locations()
+    logger.info('Compacted %d transit vehicle segments' % count)
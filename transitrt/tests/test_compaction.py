@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from django.contrib.gis.geos import Point
+from django.db import connection
+from django.utils.timezone import make_aware, utc
+
+from calc.trips import LOCAL_2D_CRS, TRANSIT_LATE_LOCATION_WINDOW, get_transit_candidates
+from transitrt.compaction import compact_vehicle_locations, get_compacted_until
+from transitrt.models import VehicleLocation, VehicleTrajectorySegment
+
+pytestmark = pytest.mark.django_db
+
+START_TIME = make_aware(datetime(2021, 5, 1, 10, 0), utc)
+END_TIME = START_TIME + timedelta(hours=2)
+# The vehicle moves east at 5 m/s
+SPEED = 5.0
+
+
+def vehicle_x(time):
+    return 385000 + SPEED * (time - START_TIME).total_seconds()
+
+
+def make_location(journey, time):
+    return VehicleLocation(
+        vehicle_ref='veh-%s' % journey, journey_ref=journey, vehicle_journey_ref=journey, time=time,
+        loc=Point(vehicle_x(time), 6672000, srid=LOCAL_2D_CRS), route_type=3,
+    )
+
+
+def insert_locations(times):
+    VehicleLocation.objects.bulk_create([make_location('j1', time) for time in times])
+
+
+def read_candidate_times():
+    # A leg that follows the vehicle for the whole time
+    leg_times = [START_TIME + timedelta(seconds=s) for s in range(0, 7200 + 1, 60)]
+    x = np.array([vehicle_x(time) for time in leg_times])
+    y = np.full(len(x), 6672000.0)
+    df = get_transit_candidates(connection, [(1, START_TIME, END_TIME, x, y)])
+    return sorted(df.epoch_time.tolist())
+
+
+def epoch_times(times):
+    return sorted(time.timestamp() for time in times)
+
+
+@pytest.fixture(autouse=True)
+def no_retention(settings):
+    settings.TRANSITRT_LOCATION_RETENTION_DAYS = 0
+
+
+def test_compaction_keeps_every_location_once():
+    times = [START_TIME + timedelta(seconds=s) for s in range(0, 7200, 30)]
+    insert_locations(times)
+    now = END_TIME
+    compact_vehicle_locations(now)
+    compacted_until = get_compacted_until()
+    assert compacted_until == END_TIME - timedelta(minutes=5)
+    assert VehicleTrajectorySegment.objects.filter(bucket__lt=compacted_until).count() == 24
+    # Includes a location exactly at the boundary between the segments and
+    # the raw table
+    assert compacted_until - TRANSIT_LATE_LOCATION_WINDOW in times
+    assert read_candidate_times() == epoch_times(times)
+
+    # A location arriving late for a bucket that was already compacted
+    late = compacted_until - TRANSIT_LATE_LOCATION_WINDOW / 2 + timedelta(seconds=15)
+    insert_locations([late])
+    times.append(late)
+    assert read_candidate_times() == epoch_times(times)
+
+    # Compacting it again keeps every location once
+    compact_vehicle_locations(now + timedelta(minutes=1))
+    late_segment = VehicleTrajectorySegment.objects.get(bucket__lte=late, end_time__gte=late)
+    assert late.timestamp() in late_segment.times
+    assert read_candidate_times() == epoch_times(times)
+
+    # And so does compacting the rest
+    compact_vehicle_locations(now + timedelta(hours=1))
+    assert get_compacted_until() == END_TIME
+    assert read_candidate_times() == epoch_times(times)
+    segment_times = sorted(t for s in VehicleTrajectorySegment.objects.all() for t in s.times)
+    assert segment_times == epoch_times(times)
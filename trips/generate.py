@@ -1,24 +1,34 @@
 from datetime import datetime, timedelta
 import logging
 from typing import Optional
+import numpy as np
 import sentry_sdk
-import geopandas as gpd
 
 from calc.trips import (
-    LOCAL_2D_CRS, read_locations, read_uuids, split_trip_legs, filter_trips
+    LOCAL_2D_CRS, read_locations, read_locations_chunked, read_uuids, split_trip_legs, filter_trips_incremental,
+    iter_partitions, partition_offsets
 )
+from calc import pgcopy
+from calc.filterstate import pack_checkpoints, unpack_checkpoints
+from calc.wayindex import get_way_index
 
+from utils.geo import GPS_SRS, local_to_gps
 from utils.perf import PerfCounter
+from django.conf import settings
 from django.db import transaction, connection
 from django.db.models import Q, Max
 from django.contrib.gis.gdal import SpatialReference, CoordTransform
 from django.contrib.gis.geos import Point
 from django.utils import timezone
-from psycopg2.extras import execute_values
-from trips.models import Device, TransportMode, Trip, Leg, LegLocation
+from trips.models import Device, DeviceProcessingState, TransportMode, Trip, Leg, LegLocation
 from trips_ingest.models import Location
 
 
+# How many filter checkpoints of unsaved trips are kept per device
+MAX_FILTER_CHECKPOINTS = 50
+# Longer time ranges are read and processed in chunks of trips
+STREAMING_MIN_RANGE = timedelta(days=3)
+
 logger = logging.getLogger(__name__)
 
 LEG_LOCATION_TABLE = LegLocation._meta.db_table
@@ -35,23 +45,17 @@ def make_point(x, y):
     return pnt
 
 
-def generate_leg_location_rows(leg, df):
-    rows = df.apply(lambda row: (
-        leg.id,
-        row.lon, row.lat,
-        '%s' % str(row.time),
-        row.speed,
-    ), axis=1)
-    return list(rows.values)
-
-
 class GeneratorError(Exception):
     pass
 
 
 class TripGenerator:
-    def __init__(self, force=False):
+    def __init__(self, force=False, stream=False, reconcile=None):
         self.force = force
+        self.stream = stream
+        if reconcile is None:
+            reconcile = settings.TRIPS_RECONCILE_LEGS
+        self.reconcile = reconcile
         transport_modes = {x.identifier: x for x in TransportMode.objects.all()}
         self.atype_to_mode = {
             'walking': transport_modes['walk'],
@@ -64,65 +68,166 @@ class TripGenerator:
             'train': transport_modes['train'],
         }
 
-    def insert_leg_locations(self, rows):
+    def insert_leg_locations(self, leg_ids, lon, lat, time, speed):
         # Having "None" as the speed column is a periodically recurring
         # issue. Raise error to continue with other uuids if None found
         # in speed column
-        try:
-            next(x for x in rows if x[4] is None)
+        if np.isnan(speed).any():
             raise GeneratorError('Encountered invalid value None as speed for leg')
-        except StopIteration:
-            pass
+        if not (np.isfinite(lon) & np.isfinite(lat)).all():
+            raise GeneratorError('Encountered invalid coordinates for leg')
         pc = PerfCounter('save_locations', show_time_to_last=True)
-        query = f'''INSERT INTO {LEG_LOCATION_TABLE} (
-            leg_id, loc, time, speed
-        ) VALUES %s'''
-
-        with connection.cursor() as cursor:
-            pc.display('after cursor')
-            value_template = """(
-                    %s,
-                    ST_SetSRID(ST_MakePoint(%s, %s), 4326),
-                    %s :: timestamptz,
-                    %s
-            )"""
-            execute_values(
-                cursor, query, rows, template=value_template, page_size=10000
-            )
-
+        pgcopy.copy_insert(connection, LEG_LOCATION_TABLE, ['leg_id', 'loc', 'time', 'speed'], [
+            (pgcopy.INT4, leg_ids),
+            (pgcopy.RAW, pgcopy.ewkb_points(lon, lat, GPS_SRS)),
+            (pgcopy.TIMESTAMPTZ, time),
+            (pgcopy.FLOAT8, speed),
+        ])
         pc.display('after insert')
 
-    def save_leg(self, trip, df, last_ts, default_variants, pc):
+    def get_leg_fields(self, df):
         start = df.iloc[0][['time', 'x', 'y']]
         end = df.iloc[-1][['time', 'x', 'y']]
-        received_at = df.iloc[-1].created_at
+        return dict(
+            mode=self.atype_to_mode[df.iloc[0].atype],
+            length=df['distance'].sum(),
+            start_time=start.time,
+            end_time=end.time,
+            start_loc=make_point(start.x, start.y),
+            end_loc=make_point(end.x, end.y),
+            received_at=df.iloc[-1].created_at,
+        )
 
-        leg_length = df['distance'].sum()
+    def save_leg(self, trip, df, last_ts, default_variants, pc):
+        fields = self.get_leg_fields(df)
 
         # Ensure trips are ordered properly
-        assert start.time >= last_ts and end.time >= last_ts
+        assert fields['start_time'] >= last_ts and fields['end_time'] >= last_ts
 
-        mode = self.atype_to_mode[df.iloc[0].atype]
+        mode = fields['mode']
         variant = default_variants.get(mode)
 
         leg = Leg(
             trip=trip,
-            mode=mode,
             mode_variant=variant,
             estimated_mode=mode,
-            length=leg_length,
-            start_time=start.time,
-            end_time=end.time,
-            start_loc=make_point(start.x, start.y),
-            end_loc=make_point(end.x, end.y),
-            received_at=received_at,
+            **fields
         )
         leg.update_carbon_footprint()
         leg.save()
-        rows = generate_leg_location_rows(leg, df)
         pc.display(str(leg))
 
-        return rows, end.time
+        return leg, fields['end_time']
+
+    def update_leg(self, leg, trip, fields):
+        """Update the changed fields of an existing leg.
+
+        Returns the rows of the leg's samples whose locations need to be
+        saved: only the ones after the old end time if the leg was extended,
+        or all of them if it changed otherwise.
+        """
+        old_start_time, old_end_time = leg.start_time, leg.end_time
+        changed = []
+        if leg.trip_id != trip.id:
+            leg.trip = trip
+            changed.append('trip')
+        for name, value in fields.items():
+            if name == 'mode':
+                # Legs are only matched with legs of the same mode
+                continue
+            if getattr(leg, name) != value:
+                setattr(leg, name, value)
+                changed.append(name)
+        if 'length' in changed:
+            leg.update_carbon_footprint()
+            changed.append('carbon_footprint')
+        if changed:
+            leg.save(update_fields=changed)
+
+        if leg.start_time == old_start_time and leg.end_time == old_end_time:
+            return 'unchanged'
+        if leg.start_time == old_start_time and leg.end_time > old_end_time:
+            return 'extended'
+        leg.locations.all().delete()
+        return 'replaced'
+
+    def reconcile_trip(self, device, df, trips, lon, lat, default_variants, pc):
+        """Update the existing legs of `trips` to match the legs in `df`.
+
+        A new leg is matched to the first unmatched existing leg of the same
+        mode that overlaps it in time. Matched legs keep their ids and only
+        their changed fields and locations are written. New legs without a
+        match are created, and existing legs without a match are deleted
+        along with the trips that are left empty.
+        """
+        old_legs = list(
+            Leg.objects.filter(trip__in=trips, deleted_at__isnull=True)
+            .select_related('trip', 'mode', 'mode_variant')
+            .order_by('start_time')
+        )
+        matched_ids = set()
+
+        def find_match(fields):
+            for leg in old_legs:
+                if leg.id in matched_ids or leg.mode_id != fields['mode'].id:
+                    continue
+                if leg.start_time <= fields['end_time'] and leg.end_time >= fields['start_time']:
+                    return leg
+            return None
+
+        offsets = partition_offsets(df.leg_id.values)
+        leg_fields = [self.get_leg_fields(df.iloc[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+        matches = []
+        for fields in leg_fields:
+            leg = find_match(fields)
+            if leg is not None:
+                matched_ids.add(leg.id)
+            matches.append(leg)
+
+        # Keep the trip of the first matched leg
+        trip = next((leg.trip for leg in matches if leg is not None), None)
+        if trip is None:
+            trip = Trip(device=device)
+            trip.save()
+        pc.display('trip %d selected' % trip.id)
+
+        deleted = Leg.objects.filter(trip__in=trips).exclude(id__in=matched_ids).delete()
+        pc.display('deleted %d unmatched legs' % deleted[1].get(Leg._meta.label, 0))
+
+        leg_ids = []
+        rows = []
+        counts = dict(created=0, unchanged=0, extended=0, replaced=0)
+        last_ts = df.time.min()
+        for start, end, fields, leg in zip(offsets[:-1], offsets[1:], leg_fields, matches):
+            leg_df = df.iloc[start:end]
+            if leg is None:
+                leg, last_ts = self.save_leg(trip, leg_df, last_ts, default_variants, pc)
+                state = 'created'
+                leg_rows = np.arange(start, end)
+            else:
+                old_end_time = leg.end_time
+                state = self.update_leg(leg, trip, fields)
+                if state == 'unchanged':
+                    leg_rows = np.arange(0)
+                elif state == 'extended':
+                    leg_rows = start + np.flatnonzero((leg_df.time > old_end_time).values)
+                else:
+                    leg_rows = np.arange(start, end)
+            counts[state] += 1
+            rows.append(leg_rows)
+            leg_ids.append(np.full(len(leg_rows), leg.id, dtype=np.int32))
+
+        # Remove the trips whose legs all moved or were deleted
+        Trip.objects.filter(id__in=[t.id for t in trips]).exclude(id=trip.id).filter(legs__isnull=True).delete()
+        pc.display('legs reconciled: %s' % ', '.join('%d %s' % (count, state) for state, count in counts.items()))
+
+        rows = np.concatenate(rows)
+        if len(rows):
+            self.insert_leg_locations(
+                np.concatenate(leg_ids), lon[rows], lat[rows], df.time.iloc[rows],
+                df.speed.iloc[rows].to_numpy(dtype=np.float64, na_value=np.nan)
+            )
+        return trip
 
     def save_trip(self, device, df, default_variants):
         pc = PerfCounter('generate_trips', show_time_to_last=True)
@@ -135,11 +240,7 @@ class TripGenerator:
         min_time = df.time.min()
         max_time = df.time.max()
 
-        df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.x, df.y, crs=LOCAL_2D_CRS))
-        pc.display('after create gdf for %d points' % len(df))
-        df['geometry'] = df['geometry'].to_crs(4326)
-        df['lon'] = df.geometry.x
-        df['lat'] = df.geometry.y
+        lon, lat = local_to_gps(df.x.values, df.y.values, LOCAL_2D_CRS)
         pc.display('after crs for %d points' % len(df))
 
         # Delete trips that overlap with our data
@@ -159,26 +260,36 @@ class TripGenerator:
                 logger.info('Trips have user corrected elements, not deleting')
                 return
 
+        if self.reconcile:
+            trips = list(device.trips.filter(legs__in=legs).distinct())
+            trip = self.reconcile_trip(device, df, trips, lon, lat, default_variants, pc)
+            pc.display('updating carbon footprint')
+            trip.update_device_carbon_footprint()
+            pc.display('trip %d save done' % trip.id)
+            return
+
         count = device.trips.filter(legs__in=legs).delete()
         pc.display('deleted')
 
         last_ts = df.time.min()
 
         # Create trips
-        all_rows = []
+        leg_ids = []
 
         trip = Trip(device=device)
         trip.save()
         pc.display('trip %d saved' % trip.id)
 
-        leg_ids = df.leg_id.unique()
-        for leg_id in leg_ids:
-            leg_df = df[df.leg_id == leg_id]
-            leg_rows, last_ts = self.save_leg(trip, leg_df, last_ts, default_variants, pc)
-            all_rows += leg_rows
+        leg_count = 0
+        for _, leg_df in iter_partitions(df, 'leg_id'):
+            leg, last_ts = self.save_leg(trip, leg_df, last_ts, default_variants, pc)
+            leg_ids.append(np.full(len(leg_df), leg.id, dtype=np.int32))
+            leg_count += 1
 
-        pc.display('generated %d legs' % len(leg_ids))
-        self.insert_leg_locations(all_rows)
+        pc.display('generated %d legs' % leg_count)
+        self.insert_leg_locations(
+            np.concatenate(leg_ids), lon, lat, df.time, df.speed.to_numpy(dtype=np.float64, na_value=np.nan)
+        )
         pc.display('updating carbon footprint')
         trip.update_device_carbon_footprint()
         pc.display('trip %d save done' % trip.id)
@@ -186,27 +297,55 @@ class TripGenerator:
     def begin(self):
         transaction.set_autocommit(False)
 
+    def get_way_index(self):
+        if not settings.WAY_INDEX_DIR:
+            return None
+        try:
+            return get_way_index(settings.WAY_INDEX_DIR)
+        except FileNotFoundError:
+            logger.warning('Way index not found in %s, using the database' % settings.WAY_INDEX_DIR)
+            return None
+
+    def should_stream(self, start_time, end_time):
+        if self.stream:
+            return True
+        if start_time is None:
+            return False
+        return (end_time or timezone.now()) - start_time > STREAMING_MIN_RANGE
+
     def process_trip(self, device, df):
+        # `df` has already been run through filter_trips()
         pc = PerfCounter('process_trip')
         logger.info('%s: %s: trip with %d samples' % (str(device), df.time.min(), len(df)))
-        df = filter_trips(df)
-        pc.display('filter done')
 
-        # Use the fixed versions of columns
-        df['atype'] = df['atypef']
-        df['x'] = df['xf']
-        df['y'] = df['yf']
+        # Use the fixed versions of columns. `df` shares its data with the
+        # frame of all trips, so the columns are renamed instead of assigned.
+        df = df.rename(columns={
+            'atype': 'raw_atype', 'x': 'raw_x', 'y': 'raw_y', 'atypef': 'atype', 'xf': 'x', 'yf': 'y',
+        }, copy=False)
 
         df = split_trip_legs(connection, str(device.uuid), df)
         pc.display('legs split')
         if df is None:
             logger.info('%s: No legs for trip' % str(device))
-            return
+            return None
         with transaction.atomic():
             self.save_trip(device, df, device._default_variants)
         pc.display('trip saved')
+        # Return the end time of the last leg
+        return df.time.max()
 
-    def generate_trips(self, uuid, start_time, end_time, generation_started_at=None):
+    def get_filter_checkpoints(self, device):
+        data = DeviceProcessingState.get_filter_checkpoints(device)
+        if not data:
+            return []
+        try:
+            return unpack_checkpoints(data)
+        except Exception as e:
+            logger.warning('%s: Invalid filter checkpoints' % str(device), exc_info=e)
+            return []
+
+    def generate_trips(self, uuid, start_time, end_time, generation_started_at=None, pending_until=None):
         device: Device = Device.objects.filter(uuid=uuid).first()
         if device is None:
             raise GeneratorError('Device %s not found' % uuid)
@@ -214,28 +353,93 @@ class TripGenerator:
         device._default_variants = {x.mode: x.variant for x in device.default_mode_variants.all()}
 
         pc = PerfCounter('update trips for %s' % uuid, show_time_to_last=True)
-        df = read_locations(connection, uuid, start_time=start_time, end_time=end_time)
-        if df is None or not len(df):
+        way_index = self.get_way_index()
+        if self.should_stream(start_time, end_time):
+            chunks = read_locations_chunked(
+                connection, uuid, start_time=start_time, end_time=end_time, way_index=way_index
+            )
+        else:
+            chunks = [read_locations(
+                connection, uuid, start_time=start_time, end_time=end_time, way_index=way_index
+            )]
+        # Only runs for new data move the watermark, not re-generation of
+        # arbitrary time ranges
+        update_watermark = generation_started_at is not None
+
+        saved_checkpoints = None
+        unsaved_checkpoints = []
+        for chunk_idx, df in enumerate(chunks):
+            if chunk_idx == 0:
+                # All chunks have the same summary
+                last_sample_time = df.attrs.get('last_sample_time')
+                open_trip_start = df.attrs.get('open_trip_start')
+            if not len(df):
+                continue
+            pc.display('read done, got %d rows' % len(df))
+            if saved_checkpoints is None:
+                saved_checkpoints = self.get_filter_checkpoints(device)
+
+            df, trip_checkpoints = filter_trips_incremental(df, saved_checkpoints)
+            pc.display('filter done')
+
+            # The filtered samples are ordered by trip, so each trip is a slice
+            for trip_id, trip_df in iter_partitions(df, 'trip_id'):
+                with sentry_sdk.configure_scope() as scope:
+                    scope.set_tag('start_time', trip_df.time.min().isoformat())
+                    scope.set_tag('end_time', trip_df.time.max().isoformat())
+                    saved_until = self.process_trip(device, trip_df)
+                    if saved_until is None:
+                        unsaved_checkpoints.append((trip_df.time.min(), trip_checkpoints[trip_id]))
+                    elif saved_until > open_trip_start:
+                        open_trip_start = saved_until
+                    scope.clear()
+            # Only the newest unsaved trips can be kept
+            unsaved_checkpoints = unsaved_checkpoints[-MAX_FILTER_CHECKPOINTS:]
+            del df, trip_checkpoints
+
+        if saved_checkpoints is None:
+            # No samples were read
+            if update_watermark and last_sample_time is not None:
+                DeviceProcessingState.update_watermark(device, last_sample_time, open_trip_start)
             if generation_started_at is not None:
                 device.last_processed_data_received_at = generation_started_at
                 device.save(update_fields=['last_processed_data_received_at'])
+            if pending_until is not None:
+                DeviceProcessingState.clear_pending(device, pending_until)
             return
-        pc.display('read done, got %d rows' % len(df))
 
-        for trip_id in df.trip_id.unique():
-            trip_df = df[df.trip_id == trip_id].copy()
-            with sentry_sdk.configure_scope() as scope:
-                scope.set_tag('start_time', trip_df.time.min().isoformat())
-                scope.set_tag('end_time', trip_df.time.max().isoformat())
-                self.process_trip(device, trip_df)
-                scope.clear()
+        if update_watermark:
+            DeviceProcessingState.update_watermark(device, last_sample_time, open_trip_start)
+        # Trips that did not produce legs and start after the watermark will be
+        # read again in the next run, so their filter state is saved to
+        # continue from.
+        unsaved_checkpoints = [
+            cp for trip_start, cp in unsaved_checkpoints
+            if not update_watermark or trip_start >= open_trip_start
+        ]
+        DeviceProcessingState.set_filter_checkpoints(
+            device, pack_checkpoints(unsaved_checkpoints) if unsaved_checkpoints else None
+        )
 
         if generation_started_at is not None:
             device.last_processed_data_received_at = generation_started_at
             device.save(update_fields=['last_processed_data_received_at'])
+        if pending_until is not None:
+            DeviceProcessingState.clear_pending(device, pending_until)
         transaction.commit()
         pc.display('trips generated')
 
+    def get_read_start(self, device_id, open_trip_start, min_start_time):
+        """Return the time from which a device's samples need to be read."""
+        if open_trip_start is None:
+            # No watermark yet; continue after the last saved leg
+            open_trip_start = (
+                Leg.objects.filter(trip__device_id=device_id).aggregate(end_time=Max('end_time'))['end_time']
+            )
+        if open_trip_start and open_trip_start > min_start_time:
+            return open_trip_start
+        return min_start_time
+
     def find_uuids_with_new_samples(self, min_received_at: Optional[datetime]=None):
         if not min_received_at:
             min_received_at = timezone.now() - timedelta(days=7)
@@ -244,67 +448,81 @@ class TripGenerator:
             Location.objects
             .filter(deleted_at__isnull=True, time__gte=min_received_at)
             .filter(uuid__in=Device.objects.values('uuid'))
-            .values('uuid').annotate(newest_created_at=Max('created_at')).order_by()
+            .values('uuid').annotate(newest_time=Max('time'), newest_created_at=Max('created_at')).order_by()
         )
-        uuids = uuid_qs.values('uuid')
         devices = (
-            Device.objects.annotate(
-                last_leg_received_at=Max('trips__legs__received_at'),
-                last_leg_end_time=Max('trips__legs__end_time'),
+            Device.objects
+            .filter(uuid__in=uuid_qs.values('uuid'))
+            .values_list(
+                'uuid', 'id', 'last_processed_data_received_at',
+                'processing_state__last_sample_time', 'processing_state__open_trip_start',
             )
-            .values('uuid', 'last_leg_received_at', 'last_leg_end_time', 'last_processed_data_received_at')
-            .filter(uuid__in=uuids)
         )
         dev_by_uuid = {
-            x['uuid']: dict(
-                last_leg_received_at=x['last_leg_received_at'],
-                last_leg_end_time=x['last_leg_end_time'],
-                last_data_processed_at=x['last_processed_data_received_at'],
+            uuid: dict(
+                id=dev_id,
+                last_data_processed_at=last_processed_at,
+                last_sample_time=last_sample_time,
+                open_trip_start=open_trip_start,
             )
-            for x in devices
+            for uuid, dev_id, last_processed_at, last_sample_time, open_trip_start in devices
         }
 
-        uuids = uuid_qs.values('uuid', 'newest_created_at')
-
         uuids_to_process = []
-        for row in uuids:
+        for row in uuid_qs:
             uuid = row['uuid']
-            newest_created_at = row['newest_created_at']
-
             dev = dev_by_uuid.get(uuid)
-            end_time = min_received_at
-            if dev:
-                if dev['last_leg_received_at'] and newest_created_at <= dev['last_leg_received_at']:
-                    continue
-                if dev['last_data_processed_at'] and newest_created_at <= dev['last_data_processed_at']:
-                    continue
-                if dev['last_leg_end_time'] and dev['last_leg_end_time'] > min_received_at:
-                    end_time = dev['last_leg_end_time']
-
-            uuids_to_process.append([uuid, end_time])
+            if dev is None:
+                continue
+            if dev['last_sample_time'] and row['newest_time'] <= dev['last_sample_time']:
+                continue
+            if dev['last_data_processed_at'] and row['newest_created_at'] <= dev['last_data_processed_at']:
+                continue
+            start_time = self.get_read_start(dev['id'], dev['open_trip_start'], min_received_at)
+            uuids_to_process.append([uuid, start_time])
 
         return uuids_to_process
 
+    def find_pending_devices(self, now: datetime):
+        """Return devices marked pending by ingest whose upload burst has ended.
+
+        Returns (uuid, start time, pending marker) tuples.
+        """
+        min_start_time = now - timedelta(days=7)
+        quiet_since = now - timedelta(seconds=settings.TRIP_GENERATION_QUIET_PERIOD)
+        states = (
+            DeviceProcessingState.objects.pending(quiet_since)
+            .values_list('device__uuid', 'device_id', 'open_trip_start', 'new_data_at')
+        )
+        out = []
+        for uuid, device_id, open_trip_start, new_data_at in states:
+            start_time = self.get_read_start(device_id, open_trip_start, min_start_time)
+            out.append((uuid, start_time, new_data_at))
+        return out
+
     def generate_new_trips(self, only_uuid=None):
         now = timezone.now()
-        uuids = self.find_uuids_with_new_samples()
-        for uuid, last_leg_end in uuids:
+        devices = self.find_pending_devices(now)
+        for uuid, start_time, pending_until in devices:
             if only_uuid is not None:
                 if str(uuid) != only_uuid:
                     continue
-            if last_leg_end:
-                start_time = last_leg_end
-                end_time = now
-            else:
-                start_time = None
-                end_time = None
 
             with sentry_sdk.configure_scope() as scope:
                 scope.set_tag('uuid', str(uuid))
                 try:
-                    self.generate_trips(uuid, start_time=start_time, end_time=end_time, generation_started_at=now)
+                    self.generate_trips(
+                        uuid, start_time=start_time, end_time=now, generation_started_at=now,
+                        pending_until=pending_until,
+                    )
                 except GeneratorError as e:
                     sentry_sdk.capture_exception(e)
+                    # Retrying the same data on every run would fail again, so
+                    # the device waits for its next upload instead
+                    logger.warning('%s: Trip generation failed, clearing pending marker' % uuid)
+                    DeviceProcessingState.objects.filter(
+                        device__uuid=uuid, new_data_at__lte=pending_until
+                    ).update(pending_since=None)
 
     def end(self):
         transaction.commit()
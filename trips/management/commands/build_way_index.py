@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from calc.wayindex import WayIndexSet
+
+
+class Command(BaseCommand):
+    help = 'Build the in-process spatial index of OSM car and rail ways'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', type=str, help='Output directory (defaults to WAY_INDEX_DIR)')
+
+    def handle(self, *args, **options):
+        path = options['path'] or settings.WAY_INDEX_DIR
+        if not path:
+            raise CommandError('No output directory given and WAY_INDEX_DIR is not set')
+        WayIndexSet.build_from_db(connection, path)
+        self.stdout.write('Way index written to %s' % path)
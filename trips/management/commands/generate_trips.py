@@ -19,9 +19,16 @@ class Command(BaseCommand):
         parser.add_argument('--start-time', type=str)
         parser.add_argument('--end-time', type=str)
         parser.add_argument('--force', action='store_true')
+        parser.add_argument('--stream', action='store_true', help='Read and process the samples in chunks of trips')
+        parser.add_argument(
+            '--reconcile', action='store_true', default=None,
+            help='Update the matching existing legs instead of recreating the trips'
+        )
 
     def handle(self, *args, **options):
-        generator = TripGenerator(force=options['force'])
+        generator = TripGenerator(
+            force=options['force'], stream=options['stream'], reconcile=options['reconcile']
+        )
         uuid = options['uuid']
         start_uuid = options['start_after_uuid']
         start_time = options['start_time']
@@ -0,0 +1,30 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0029_add_health_impact_enabled_to_device'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceProcessingState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pending_since', models.DateTimeField(db_index=True, null=True)),
+                ('new_data_at', models.DateTimeField(null=True)),
+                ('device', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='processing_state', to='trips.device')),
+            ],
+        ),
+        # Process every device once so that data received before the switch
+        # to event-driven generation is not left behind.
+        migrations.RunSQL(
+            """
+                INSERT INTO trips_deviceprocessingstate (device_id, pending_since, new_data_at)
+                    SELECT id, now(), now() FROM trips_device
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
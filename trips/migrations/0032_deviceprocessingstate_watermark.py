@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0031_deviceprocessingstate_filter_checkpoints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deviceprocessingstate',
+            name='last_sample_time',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='deviceprocessingstate',
+            name='open_trip_start',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
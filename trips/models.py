@@ -14,7 +14,7 @@ from ranking import Ranking
 
 import pytz
 from django.utils import timezone
-from django.db import transaction
+from django.db import connection, transaction
 from django.contrib.gis.db import models
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
@@ -22,6 +22,7 @@ from django_prometheus.models import ExportModelOperationsMixin
 from modeltrans.fields import TranslationField
 
 from budget.enums import EmissionUnit, TimeResolution
+from trips_ingest.device_cache import device_cache
 from trips_ingest.models import DeviceHeartbeat, Location
 
 
@@ -76,6 +77,21 @@ class Device(ExportModelOperationsMixin('device'), models.Model):
 
     objects = DeviceQuerySet.as_manager()
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.invalidate_ingest_cache()
+
+    def delete(self, *args, **kwargs):
+        ret = super().delete(*args, **kwargs)
+        self.invalidate_ingest_cache()
+        return ret
+
+    def invalidate_ingest_cache(self):
+        uuid = self.uuid
+        device_cache.invalidate(uuid)
+        # Concurrent requests might cache the old values before we commit
+        transaction.on_commit(lambda: device_cache.invalidate(uuid))
+
     def generate_token(self):
         assert not self.token
         self.token = uuid.uuid4()
@@ -445,6 +461,68 @@ class EnableEvent(models.Model):
         get_latest_by = 'time'
 
 
+class DeviceProcessingStateQuerySet(models.QuerySet):
+    def pending(self, quiet_since: datetime):
+        """Devices with new data that has not been followed by more uploads since `quiet_since`."""
+        return self.filter(pending_since__isnull=False, new_data_at__lte=quiet_since)
+
+
+class DeviceProcessingState(models.Model):
+    device = models.OneToOneField(Device, on_delete=models.CASCADE, related_name='processing_state')
+    # Set when new location samples are ingested and cleared when trips
+    # have been generated from them
+    pending_since = models.DateTimeField(null=True, db_index=True)
+    # When the latest new samples were ingested; used to wait for the end
+    # of an upload burst before generating trips
+    new_data_at = models.DateTimeField(null=True)
+    # Time of the last location sample consumed by trip generation
+    last_sample_time = models.DateTimeField(null=True)
+    # Samples before this have been consumed and are not read again; what
+    # follows is the trip that may still be ongoing and any newer samples
+    open_trip_start = models.DateTimeField(null=True)
+    # Packed calc.filterstate checkpoints of the filtered trips that did not
+    # produce legs yet, so they can be continued when they are read again
+    filter_checkpoints = models.BinaryField(null=True)
+
+    objects = DeviceProcessingStateQuerySet.as_manager()
+
+    def __str__(self):
+        return '%s (pending since %s)' % (self.device, self.pending_since)
+
+    @classmethod
+    def mark_pending(cls, uuids: List[str], now: datetime):
+        table = cls._meta.db_table
+        device_table = Device._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                INSERT INTO {table} (device_id, pending_since, new_data_at)
+                    SELECT id, %(now)s, %(now)s FROM {device_table} WHERE uuid = ANY(%(uuids)s :: uuid[])
+                ON CONFLICT (device_id) DO UPDATE SET
+                    pending_since = COALESCE({table}.pending_since, EXCLUDED.pending_since),
+                    new_data_at = GREATEST({table}.new_data_at, EXCLUDED.new_data_at)
+            """, dict(uuids=[str(x) for x in uuids], now=now))
+
+    @classmethod
+    def clear_pending(cls, device: Device, processed_until: datetime):
+        # Data that arrived while we were processing keeps the device pending
+        cls.objects.filter(device=device, new_data_at__lte=processed_until).update(pending_since=None)
+
+    @classmethod
+    def update_watermark(cls, device: Device, last_sample_time: datetime, open_trip_start: datetime):
+        cls.objects.update_or_create(device=device, defaults=dict(
+            last_sample_time=last_sample_time, open_trip_start=open_trip_start,
+        ))
+
+    @classmethod
+    def get_filter_checkpoints(cls, device: Device) -> Optional[bytes]:
+        data = cls.objects.filter(device=device).values_list('filter_checkpoints', flat=True).first()
+        return bytes(data) if data is not None else None
+
+    @classmethod
+    def set_filter_checkpoints(cls, device: Device, data: Optional[bytes]):
+        cls.objects.update_or_create(device=device, defaults=dict(filter_checkpoints=data))
+
+
 class TripQuerySet(models.QuerySet):
     def annotate_times(self):
         if getattr(self, '_times_annotated', False):
@@ -16,6 +16,7 @@ from budget.models import EmissionBudgetLevel
 from mocaf.graphql_gis import LineStringScalar, PointScalar
 from mocaf.graphql_helpers import GraphQLNeedConfirmation, paginate_queryset
 from mocaf.graphql_types import AuthenticatedDeviceNode, DjangoNode
+from trips_ingest.tasks import delete_archived_device_data
 from trips_ingest.models import Location
 
 from .models import (
@@ -186,6 +187,9 @@ class ClearUserDataMutation(graphene.Mutation, AuthenticatedDeviceNode):
             # Location.objects.filter(uuid=dev.uuid).update(deleted_at=now)
             dev.receive_data.all().delete()
             dev.delete()
+        # Rewriting the archive segments takes a while, so it is done in the background
+        uuid = str(dev.uuid)
+        transaction.on_commit(lambda: delete_archived_device_data.delay(uuid))
 
         return dict(ok=True)
 
@@ -0,0 +1,252 @@
+from datetime import timedelta
+
+import pytest
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.db import connection
+from django.utils import timezone
+
+from calc.trips import LOCAL_2D_CRS
+from calc.wayindex import WAY_LAYERS
+from trips.generate import GeneratorError, TripGenerator
+from trips.models import DeviceProcessingState, Leg, LegLocation, Trip
+from trips.tests.factories import DeviceFactory
+from trips_ingest.models import Location
+from utils.geo import local_to_gps
+from utils.perf import PerfCounter
+
+pytestmark = pytest.mark.django_db
+
+START_TIME = pd.Timestamp('2021-05-01 08:00', tz='UTC')
+
+
+def make_samples(legs):
+    """Build processed trip samples from (atype, start_minute, n_samples) legs.
+
+    The legs get one sample per 10 seconds, moving 10 m east per sample.
+    """
+    frames = []
+    for leg_id, (atype, start_minute, n_samples) in enumerate(legs):
+        time = START_TIME + pd.Timedelta(minutes=start_minute) + pd.to_timedelta(np.arange(n_samples) * 10, unit='s')
+        x = 385000 + np.arange(n_samples) * 10.0 + start_minute * 600
+        frames.append(pd.DataFrame(dict(
+            time=time,
+            x=x,
+            y=np.full(n_samples, 6672000.0),
+            atype=atype,
+            distance=10.0,
+            created_at=time,
+            speed=1.0,
+            leg_id=leg_id,
+        )))
+    return pd.concat(frames, ignore_index=True)
+
+
+def reconcile(device, df, trips):
+    gen = TripGenerator(reconcile=True)
+    lon, lat = local_to_gps(df.x.values, df.y.values, LOCAL_2D_CRS)
+    return gen.reconcile_trip(device, df, trips, lon, lat, {}, PerfCounter('test'))
+
+
+def location_ids(leg):
+    return set(leg.locations.values_list('id', flat=True))
+
+
+def test_reconcile_trip_keeps_unchanged_leg():
+    device = DeviceFactory()
+    df = make_samples([('walking', 0, 10)])
+    trip = reconcile(device, df, [])
+    leg = trip.legs.get()
+    old_locations = location_ids(leg)
+    assert len(old_locations) == 10
+
+    assert reconcile(device, df, [trip]) == trip
+    assert trip.legs.get().id == leg.id
+    assert location_ids(leg) == old_locations
+
+
+def test_reconcile_trip_appends_locations_of_extended_leg():
+    device = DeviceFactory()
+    trip = reconcile(device, make_samples([('walking', 0, 10)]), [])
+    leg = trip.legs.get()
+    old_locations = location_ids(leg)
+
+    reconcile(device, make_samples([('walking', 0, 15)]), [trip])
+    leg.refresh_from_db()
+    assert trip.legs.get().id == leg.id
+    assert leg.end_time == START_TIME + pd.Timedelta(seconds=140)
+    new_locations = location_ids(leg)
+    assert len(new_locations) == 15
+    assert old_locations < new_locations
+
+
+def test_reconcile_trip_replaces_locations_of_changed_leg():
+    device = DeviceFactory()
+    trip = reconcile(device, make_samples([('walking', 0, 10)]), [])
+    leg = trip.legs.get()
+    old_locations = location_ids(leg)
+
+    # Same mode and overlapping in time, but starting later
+    df = make_samples([('walking', 0, 10)])
+    df = df.iloc[2:].reset_index(drop=True)
+    reconcile(device, df, [trip])
+    leg.refresh_from_db()
+    assert trip.legs.get().id == leg.id
+    assert leg.start_time == START_TIME + pd.Timedelta(seconds=20)
+    new_locations = location_ids(leg)
+    assert len(new_locations) == 8
+    assert not old_locations & new_locations
+
+
+def test_reconcile_trip_deletes_vanished_leg():
+    device = DeviceFactory()
+    trip = reconcile(device, make_samples([('walking', 0, 10), ('in_vehicle', 2, 10)]), [])
+    walk_leg, car_leg = trip.legs.order_by('start_time')
+
+    reconcile(device, make_samples([('walking', 0, 10)]), [trip])
+    assert list(trip.legs.all()) == [walk_leg]
+    assert not Leg.objects.filter(id=car_leg.id).exists()
+
+
+def test_reconcile_trip_moves_leg_to_kept_trip():
+    device = DeviceFactory()
+    df = make_samples([('walking', 0, 10), ('in_vehicle', 2, 10)])
+    walk_trip = reconcile(device, df[df.leg_id == 0], [])
+    car_trip = reconcile(device, df[df.leg_id == 1].reset_index(drop=True), [])
+    walk_leg = walk_trip.legs.get()
+    car_leg = car_trip.legs.get()
+    car_locations = location_ids(car_leg)
+
+    assert reconcile(device, df, [walk_trip, car_trip]) == walk_trip
+    assert list(walk_trip.legs.order_by('start_time')) == [walk_leg, car_leg]
+    assert location_ids(car_leg) == car_locations
+    # The trip that was left without legs is removed
+    assert not Trip.objects.filter(id=car_trip.id).exists()
+
+
+def test_reconcile_trip_deletes_emptied_trip():
+    device = DeviceFactory()
+    df = make_samples([('walking', 0, 10), ('in_vehicle', 2, 10)])
+    walk_trip = reconcile(device, df[df.leg_id == 0], [])
+    car_trip = reconcile(device, df[df.leg_id == 1].reset_index(drop=True), [])
+    car_leg = car_trip.legs.get()
+
+    reconcile(device, df[df.leg_id == 0], [walk_trip, car_trip])
+    assert Trip.objects.filter(id=walk_trip.id).exists()
+    assert not Trip.objects.filter(id=car_trip.id).exists()
+    assert not Leg.objects.filter(id=car_leg.id).exists()
+
+
+@pytest.mark.parametrize('new_data_during_run', [False, True])
+def test_generate_new_trips_clears_pending_after_generator_error(monkeypatch, settings, new_data_during_run):
+    device = DeviceFactory()
+    quiet_device = DeviceFactory()
+    now = timezone.now()
+    marked_at = now - timedelta(seconds=settings.TRIP_GENERATION_QUIET_PERIOD + 10)
+    DeviceProcessingState.mark_pending([device.uuid], marked_at)
+    # Still uploading, so not processed yet
+    DeviceProcessingState.mark_pending([quiet_device.uuid], now)
+
+    calls = []
+
+    def generate_trips(uuid, start_time, end_time, generation_started_at=None, pending_until=None):
+        calls.append((uuid, pending_until))
+        if new_data_during_run:
+            DeviceProcessingState.mark_pending([uuid], timezone.now())
+        raise GeneratorError('failed')
+
+    gen = TripGenerator()
+    monkeypatch.setattr(gen, 'generate_trips', generate_trips)
+    gen.generate_new_trips()
+
+    assert calls == [(device.uuid, marked_at)]
+    state = DeviceProcessingState.objects.get(device=device)
+    if new_data_during_run:
+        assert state.pending_since == marked_at
+    else:
+        assert state.pending_since is None
+    assert DeviceProcessingState.objects.get(device=quiet_device).pending_since == now
+
+
+@pytest.fixture
+def osm_ways():
+    """Create empty OSM way tables for reading samples with the closest ways."""
+    with connection.cursor() as cursor:
+        for table, type_column in WAY_LAYERS.values():
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS %s (osm_id bigint, name text, %s text, way geometry(LineString, %d))'
+                % (table, type_column, settings.LOCAL_SRS)
+            )
+
+
+def insert_locations(uuid, start, n_samples, step, atype):
+    """Insert samples 10 seconds and `step` meters apart, ending with a stop."""
+    Location.objects.bulk_create([Location(
+        time=start + timedelta(seconds=i * 10),
+        uuid=uuid,
+        loc=Point(385000 + i * step, 6672000.0, srid=settings.LOCAL_SRS),
+        loc_error=10,
+        atype=atype,
+        aconf=90,
+        speed=step / 10,
+        is_moving=i < n_samples - 1,
+        created_at=start + timedelta(seconds=i * 10 + 5),
+    ) for i in range(n_samples)])
+
+
+def leg_location_times(device):
+    return list(
+        LegLocation.objects.filter(leg__trip__device=device).order_by('time').values_list('time', flat=True)
+    )
+
+
+def generate_from_watermark(gen, device, end_time):
+    state = DeviceProcessingState.objects.filter(device=device).first()
+    start_time = gen.get_read_start(
+        device.id, state.open_trip_start if state else None, end_time - timedelta(days=7)
+    )
+    gen.generate_trips(device.uuid, start_time, end_time, generation_started_at=timezone.now())
+    return DeviceProcessingState.objects.get(device=device)
+
+
+def test_generate_trips_continues_from_watermark(monkeypatch, osm_ways):
+    # The test runs in a transaction that cannot be committed
+    monkeypatch.setattr('trips.generate.transaction.commit', lambda: None)
+    device = DeviceFactory()
+    batch_device = DeviceFactory()
+    walk_start = START_TIME.to_pydatetime() + timedelta(hours=2)
+    # Too few samples for a leg, but far-reaching enough for a trip
+    drive_start = walk_start + timedelta(minutes=30)
+    late_walk_start = walk_start + timedelta(hours=1)
+
+    gen = TripGenerator()
+    for uuid in (device.uuid, batch_device.uuid):
+        insert_locations(uuid, walk_start, 61, 15, 'walking')
+        insert_locations(uuid, drive_start, 14, 200, 'in_vehicle')
+    state = generate_from_watermark(gen, device, drive_start + timedelta(minutes=5))
+    # The last trip has no legs, so it is read again and its filter state is
+    # kept to continue from
+    assert state.open_trip_start == drive_start
+    assert [cp.start_time for cp in gen.get_filter_checkpoints(device)] == [drive_start.timestamp()]
+    assert Trip.objects.filter(device=device).count() == 1
+
+    for uuid in (device.uuid, batch_device.uuid):
+        insert_locations(uuid, late_walk_start, 61, 15, 'walking')
+    end_time = late_walk_start + timedelta(minutes=15)
+    state = generate_from_watermark(gen, device, end_time)
+    times = leg_location_times(device)
+    # The watermark moves past the saved trip, so the unsaved one before it
+    # is not read again
+    assert state.open_trip_start == times[-1]
+    assert gen.get_filter_checkpoints(device) == []
+    assert Trip.objects.filter(device=device).count() == 2
+
+    # Generating the trips in one go gives the same samples
+    gen.generate_trips(batch_device.uuid, walk_start, end_time)
+    assert times == leg_location_times(batch_device)
+    assert len(times) == len(set(times))
+    assert [time for time in times if time < drive_start]
+    assert [time for time in times if time >= late_walk_start]
+    assert not [time for time in times if drive_start <= time < late_walk_start]
@@ -1,5 +1,6 @@
 import pytest
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+from uuid import uuid4
 from django.utils.timezone import make_aware, utc
 
 from budget.tests.factories import DeviceDailyCarbonFootprintFactory, PrizeFactory
@@ -8,7 +9,8 @@ from trips.tests.factories import (
     BackgroundInfoQuestionFactory, DeviceDefaultModeVariantFactory, DeviceFactory, LegFactory, TripFactory
 )
 from trips.generate import make_point
-from trips.models import AlreadyRegistered, Device, MigrationRequired
+from trips.models import AlreadyRegistered, Device, DeviceProcessingState, MigrationRequired
+from trips_ingest.device_cache import DeviceCache, device_cache
 from trips_ingest.models import DeviceHeartbeat, Location
 
 pytestmark = pytest.mark.django_db
@@ -196,3 +198,64 @@ def test_device_register_moves_prize(registered_device):
     new_device.register(registered_device.account_key)
     assert not registered_device.prizes.exists()
     assert list(new_device.prizes.all()) == [prize]
+
+
+def test_device_save_invalidates_ingest_device_cache():
+    device = DeviceFactory()
+    cached = device_cache.get(device.uuid)
+    assert cached.id == device.id
+    assert not cached.needs_debug_handling
+    device.debug_log_level = 1
+    device.save()
+    assert device_cache.get(device.uuid).needs_debug_handling
+
+
+def test_ingest_device_cache_does_not_keep_unknown_devices():
+    cache = DeviceCache(ttl=60, negative_ttl=0)
+    uuid = uuid4()
+    assert cache.get(uuid) is None
+    # Saving the device only invalidates the shared cache instance
+    device = DeviceFactory(uuid=uuid)
+    assert cache.get(uuid).id == device.id
+
+
+def test_device_processing_state_mark_pending():
+    device = DeviceFactory()
+    time = make_aware(datetime(2021, 5, 1, 12, 0), utc)
+    DeviceProcessingState.mark_pending([str(device.uuid), str(uuid4())], time)
+    state = DeviceProcessingState.objects.get()
+    assert state.device == device
+    assert (state.pending_since, state.new_data_at) == (time, time)
+
+    # More data keeps the start of the pending period
+    DeviceProcessingState.mark_pending([device.uuid], time + timedelta(seconds=30))
+    state.refresh_from_db()
+    assert (state.pending_since, state.new_data_at) == (time, time + timedelta(seconds=30))
+
+
+def test_device_processing_state_pending_waits_for_quiet_period():
+    device = DeviceFactory()
+    time = make_aware(datetime(2021, 5, 1, 12, 0), utc)
+    DeviceProcessingState.mark_pending([device.uuid], time)
+    assert not DeviceProcessingState.objects.pending(time - timedelta(seconds=1)).exists()
+    assert DeviceProcessingState.objects.pending(time).get().device == device
+
+    # An upload during the quiet period starts it again
+    DeviceProcessingState.mark_pending([device.uuid], time + timedelta(seconds=10))
+    assert not DeviceProcessingState.objects.pending(time + timedelta(seconds=5)).exists()
+    assert DeviceProcessingState.objects.pending(time + timedelta(seconds=10)).exists()
+
+
+def test_device_processing_state_clear_pending():
+    device = DeviceFactory()
+    time = make_aware(datetime(2021, 5, 1, 12, 0), utc)
+    DeviceProcessingState.mark_pending([device.uuid], time)
+    # Data that arrived during processing keeps the device pending
+    DeviceProcessingState.mark_pending([device.uuid], time + timedelta(seconds=30))
+    DeviceProcessingState.clear_pending(device, time)
+    assert DeviceProcessingState.objects.get().pending_since == time
+
+    DeviceProcessingState.clear_pending(device, time + timedelta(seconds=30))
+    state = DeviceProcessingState.objects.get()
+    assert state.pending_since is None
+    assert not DeviceProcessingState.objects.pending(time + timedelta(hours=1)).exists()
@@ -1,38 +1,64 @@
 import json
 import logging
 
+import orjson
 import sentry_sdk
+from asgiref.sync import sync_to_async
+from django.db import transaction
 from django.utils import timezone
 from django.urls import reverse
-from rest_framework.decorators import api_view, schema
-from django.http import HttpResponse
+from rest_framework.decorators import api_view, parser_classes, schema
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, JsonResponse
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 
 from trips.models import Device
+from .buffer import ingest_buffer
+from .device_cache import device_cache, save_with_cached_device
+from .location_batch import DATA_TYPE as LOCATION_BATCH_TYPE, LocationBatchUpload, decompress_body, parse_upload
 from .models import ReceiveData, ReceiveDebugLog
+from .parsers import DecompressingJSONParser, LocationBatchParser
 
 
 logger = logging.getLogger(__name__)
 
 
-def modify_for_debug_logs(request, data, resp):
+def get_location_upload_uuid(data):
     if not isinstance(data, dict):
-        return
+        return None
+    if data.get('dataType') == LOCATION_BATCH_TYPE:
+        return data.get('uid')
+
     loc_data = data.get('location')
     if not isinstance(loc_data, list):
-        return
+        return None
     if len(loc_data) < 1:
-        return
+        return None
 
     uid = data.get('uid')
     if not isinstance(uid, str):
         extra_data = loc_data[0].get('extras')
         if not isinstance(extra_data, dict):
-            return
+            return None
 
         uid = extra_data.get('uid', None)
         if not isinstance(uid, str):
-            return
+            return None
+    return uid
+
+
+def modify_for_debug_logs(request, data, resp):
+    uid = get_location_upload_uuid(data)
+    if uid is None:
+        return
+
+    # Most devices have no debug settings, so avoid hitting the database for them
+    try:
+        cached_dev = device_cache.get(uid)
+    except Exception:
+        return
+    if cached_dev is None or not cached_dev.needs_debug_handling:
+        return
 
     try:
         dev = Device.objects.get(uuid=uid)
@@ -86,21 +112,64 @@ def modify_for_debug_logs(request, data, resp):
 
 @api_view(['POST'])
 @schema(None)
+@parser_classes([DecompressingJSONParser, LocationBatchParser])
 def ingest_view(request):
     received_at = timezone.now()
     data = request.data
-    obj = ReceiveData(data=data, received_at=received_at)
+    if isinstance(data, LocationBatchUpload):
+        obj = ReceiveData(data=data.metadata, payload=data.payload, received_at=received_at)
+        data = data.metadata
+    else:
+        obj = ReceiveData(data=data, received_at=received_at)
     try:
-        obj.device = Device.objects.get(uuid=obj.get_uuid())
+        cached_dev = device_cache.get(obj.get_uuid())
+        if cached_dev is None:
+            raise Device.DoesNotExist('Device %s not found' % obj.get_uuid())
+        obj.device_id = cached_dev.id
     except Exception as e:
         sentry_sdk.capture_exception(e)
-    obj.save()
+    save_with_cached_device(obj)
 
     resp = {'ok': True, 'received_at': received_at}
     modify_for_debug_logs(request, data, resp)
     return Response(resp)
 
 
+@transaction.non_atomic_requests
+async def ingest_buffered_view(request):
+    """Acknowledge an upload as soon as it has been appended to the ingest buffer.
+
+    The buffered payloads are moved to ReceiveData by the flush task, so
+    no database connection is held for the request.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    received_at = timezone.now()
+    payload = None
+    try:
+        body = decompress_body(request.body, request.headers.get('Content-Encoding'))
+        if request.content_type == LocationBatchParser.media_type:
+            upload = parse_upload(body)
+            data = upload.metadata
+            payload = upload.payload
+        else:
+            data = orjson.loads(body)
+    except Exception:
+        return HttpResponseBadRequest()
+
+    await sync_to_async(ingest_buffer.append, thread_sensitive=False)(data, received_at, payload)
+
+    resp = {'ok': True, 'received_at': received_at}
+    await sync_to_async(modify_for_debug_logs)(request, data, resp)
+    return JsonResponse(resp, encoder=JSONEncoder)
+
+
+# csrf_exempt() would wrap the coroutine function in a sync view, so the
+# attribute it sets is set directly instead.
+ingest_buffered_view.csrf_exempt = True
+
+
 def upload_log_view(request, uuid):
     logger.info('Received debug log for uuid %s' % uuid)
 
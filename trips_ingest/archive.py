@@ -0,0 +1,309 @@
+"""Append-only archive of processed ReceiveData payloads.
+
+Processed events are moved out of Postgres into hourly segment files. Each
+segment `receivedata-YYYYMMDDHH.seg` holds one independent zstd frame per
+event; the matching `.idx` file has one tab-separated line per event:
+
+    uuid, received_at, offset, length, ReceiveData id
+
+The frame contains a 4-byte little-endian length of a JSON header followed
+by the binary payload (if any). Segments are named by the UTC hour of
+`received_at` and are only ever appended to, so expiring old data means
+deleting whole files.
+
+Writing, rewriting and deleting segments is serialized between processes
+with an exclusive lock on the archive's lock file, and readers take a
+shared lock. Deleting events rewrites a segment and its index into `.tmp`
+files that replace the originals, the segment first. If a crash leaves
+only the index `.tmp` file, the segment was already replaced and the
+rewrite is finished the next time the exclusive lock is taken.
+"""
+import fcntl
+import logging
+import os
+import struct
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Iterator, Optional
+
+import orjson
+import pytz
+import zstandard
+from dateutil.parser import isoparse
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import ReceiveData
+
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = 'receivedata-'
+LOCK_FILE = 'archive.lock'
+SEGMENT_TIME_FORMAT = '%Y%m%d%H'
+HEADER_LEN = struct.Struct('<I')
+ARCHIVE_BATCH_SIZE = 5000
+
+
+def segment_hour(dt: datetime) -> datetime:
+    return dt.astimezone(pytz.utc).replace(minute=0, second=0, microsecond=0)
+
+
+class SegmentArchive:
+    def __init__(self, path, compression_level=3):
+        self.path = path
+        self.compression_level = compression_level
+
+    def segment_path(self, hour: datetime, ext='seg'):
+        return os.path.join(self.path, '%s%s.%s' % (SEGMENT_PREFIX, hour.strftime(SEGMENT_TIME_FORMAT), ext))
+
+    @contextmanager
+    def lock(self, shared=False):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, LOCK_FILE), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                if not shared:
+                    self.recover()
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def sync_dir(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def recover(self):
+        """Finish or roll back a segment rewrite interrupted by a crash.
+
+        Must be called with the exclusive lock held.
+        """
+        for fn in os.listdir(self.path):
+            if not fn.endswith('.idx.tmp'):
+                continue
+            tmp_idx = os.path.join(self.path, fn)
+            idx_path = tmp_idx[:-len('.tmp')]
+            tmp_seg = idx_path[:-len('idx')] + 'seg.tmp'
+            if os.path.exists(tmp_seg):
+                # Nothing was replaced yet, so the originals are intact
+                logger.warning('Removing the files of an interrupted rewrite of %s' % idx_path)
+                os.remove(tmp_seg)
+                os.remove(tmp_idx)
+            else:
+                logger.warning('Finishing an interrupted rewrite of %s' % idx_path)
+                os.replace(tmp_idx, idx_path)
+        for fn in os.listdir(self.path):
+            if fn.endswith('.seg.tmp'):
+                os.remove(os.path.join(self.path, fn))
+
+    def list_segments(self):
+        """Return (hour, path) pairs for all segments, oldest first."""
+        if not os.path.isdir(self.path):
+            return []
+        out = []
+        for fn in os.listdir(self.path):
+            if not fn.startswith(SEGMENT_PREFIX) or not fn.endswith('.seg'):
+                continue
+            ts = fn[len(SEGMENT_PREFIX):-len('.seg')]
+            try:
+                hour = pytz.utc.localize(datetime.strptime(ts, SEGMENT_TIME_FORMAT))
+            except ValueError:
+                continue
+            out.append((hour, os.path.join(self.path, fn)))
+        return sorted(out)
+
+    def encode_event(self, event: ReceiveData) -> bytes:
+        header = orjson.dumps(dict(
+            id=event.id,
+            data=event.data,
+            device_id=event.device_id,
+            received_at=event.received_at.isoformat(),
+            imported_at=event.imported_at.isoformat() if event.imported_at else None,
+            import_failed=event.import_failed,
+        ))
+        payload = bytes(event.payload) if event.payload is not None else b''
+        return HEADER_LEN.pack(len(header)) + header + payload
+
+    def decode_event(self, frame: bytes) -> ReceiveData:
+        (header_len,) = HEADER_LEN.unpack_from(frame)
+        header = orjson.loads(frame[HEADER_LEN.size:HEADER_LEN.size + header_len])
+        payload = frame[HEADER_LEN.size + header_len:] or None
+        imported_at = header['imported_at']
+        return ReceiveData(
+            id=header['id'],
+            data=header['data'],
+            payload=payload,
+            device_id=header['device_id'],
+            received_at=isoparse(header['received_at']),
+            imported_at=isoparse(imported_at) if imported_at else None,
+            import_failed=header['import_failed'],
+        )
+
+    def write_events(self, events):
+        """Append events to their hourly segments and sync them to disk."""
+        by_hour = {}
+        for event in events:
+            by_hour.setdefault(segment_hour(event.received_at), []).append(event)
+
+        # Compress before taking the lock, so other writers wait less
+        cctx = zstandard.ZstdCompressor(level=self.compression_level)
+        frames_by_hour = {
+            hour: [cctx.compress(self.encode_event(event)) for event in hour_events]
+            for hour, hour_events in by_hour.items()
+        }
+        with self.lock():
+            for hour, hour_events in by_hour.items():
+                index_lines = []
+                with open(self.segment_path(hour), 'ab') as seg_f:
+                    offset = seg_f.tell()
+                    for event, frame in zip(hour_events, frames_by_hour[hour]):
+                        seg_f.write(frame)
+                        index_lines.append('%s\t%s\t%d\t%d\t%d\n' % (
+                            event.get_uuid() or '', event.received_at.isoformat(), offset, len(frame), event.id
+                        ))
+                        offset += len(frame)
+                    seg_f.flush()
+                    os.fsync(seg_f.fileno())
+                # The index is written only after the segment data is on disk
+                with open(self.segment_path(hour, 'idx'), 'a') as idx_f:
+                    idx_f.write(''.join(index_lines))
+                    idx_f.flush()
+                    os.fsync(idx_f.fileno())
+
+    def read_index(self, hour: datetime):
+        try:
+            f = open(self.segment_path(hour, 'idx'), 'r')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) != 5:
+                    continue
+                uid, received_at, offset, length, event_id = parts
+                yield uid, isoparse(received_at), int(offset), int(length), int(event_id)
+
+    def iter_events(
+        self, uuid: Optional[str] = None, start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> Iterator[ReceiveData]:
+        """Yield archived events as unsaved ReceiveData objects.
+
+        The objects can be inspected or passed to EventProcessor.process_event()
+        for replaying. Events are yielded in segment order. The archive is
+        locked for writing until the iterator is exhausted or closed.
+        """
+        uuid = str(uuid) if uuid is not None else None
+        if not os.path.isdir(self.path):
+            return
+        with self.lock(shared=True):
+            yield from self._iter_events(uuid, start, end)
+
+    def _iter_events(self, uuid, start, end):
+        dctx = zstandard.ZstdDecompressor()
+        seen_ids = set()
+        for hour, seg_path in self.list_segments():
+            if start is not None and hour < segment_hour(start):
+                continue
+            if end is not None and hour > end:
+                continue
+            with open(seg_path, 'rb') as seg_f:
+                for uid, received_at, offset, length, event_id in self.read_index(hour):
+                    if uuid is not None and uid != uuid:
+                        continue
+                    if start is not None and received_at < start:
+                        continue
+                    if end is not None and received_at > end:
+                        continue
+                    # An interrupted archive run may have written an event twice
+                    if event_id in seen_ids:
+                        continue
+                    seg_f.seek(offset)
+                    try:
+                        event = self.decode_event(dctx.decompress(seg_f.read(length)))
+                    except (zstandard.ZstdError, ValueError, KeyError, struct.error):
+                        event = None
+                    # Guards against an index left over from an interrupted rewrite
+                    if event is None or event.id != event_id:
+                        logger.error('Event %d not found in %s at offset %d' % (event_id, seg_path, offset))
+                        continue
+                    seen_ids.add(event_id)
+                    yield event
+
+    def delete_uuid(self, uuid):
+        """Remove all events of a device by rewriting the segments that contain them."""
+        uuid = str(uuid)
+        with self.lock():
+            for hour, seg_path in self.list_segments():
+                entries = list(self.read_index(hour))
+                if not any(uid == uuid for uid, *_ in entries):
+                    continue
+                tmp_seg = seg_path + '.tmp'
+                tmp_idx = self.segment_path(hour, 'idx') + '.tmp'
+                with open(seg_path, 'rb') as src, open(tmp_seg, 'wb') as dst, open(tmp_idx, 'w') as idx_f:
+                    offset = 0
+                    for uid, received_at, old_offset, length, event_id in entries:
+                        if uid == uuid:
+                            continue
+                        src.seek(old_offset)
+                        dst.write(src.read(length))
+                        idx_f.write('%s\t%s\t%d\t%d\t%d\n' % (
+                            uid, received_at.isoformat(), offset, length, event_id
+                        ))
+                        offset += length
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                    idx_f.flush()
+                    os.fsync(idx_f.fileno())
+                # See recover() for how a crash between these is handled
+                os.replace(tmp_seg, seg_path)
+                self.sync_dir()
+                os.replace(tmp_idx, self.segment_path(hour, 'idx'))
+                self.sync_dir()
+
+    def expire(self, older_than: datetime):
+        """Delete all segments whose hour ends before `older_than`."""
+        count = 0
+        with self.lock():
+            for hour, seg_path in self.list_segments():
+                if hour + timedelta(hours=1) > older_than:
+                    break
+                os.remove(seg_path)
+                try:
+                    os.remove(self.segment_path(hour, 'idx'))
+                except FileNotFoundError:
+                    pass
+                count += 1
+        return count
+
+    def archive_processed(self, batch_size=ARCHIVE_BATCH_SIZE):
+        """Move processed events from the database to the archive."""
+        table = ReceiveData._meta.db_table
+        total = 0
+        while True:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(f"""
+                        SELECT id FROM {table}
+                        WHERE imported_at IS NOT NULL
+                        ORDER BY id
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    """, [batch_size])
+                    ids = [row[0] for row in cursor.fetchall()]
+                if not ids:
+                    break
+                events = list(ReceiveData.objects.filter(id__in=ids).order_by('received_at'))
+                self.write_events(events)
+                ReceiveData.objects.filter(id__in=ids).delete()
+            total += len(ids)
+        logger.info('%d processed events archived' % total)
+        return total
+
+
+def get_archive() -> Optional[SegmentArchive]:
+    if not settings.INGEST_ARCHIVE_DIR:
+        return None
+    return SegmentArchive(settings.INGEST_ARCHIVE_DIR)
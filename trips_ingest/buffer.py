@@ -0,0 +1,181 @@
+import logging
+
+import orjson
+import redis
+from redis.exceptions import LockNotOwnedError
+from dateutil.parser import isoparse
+from django.conf import settings
+from django.db import DatabaseError, transaction
+
+from .device_cache import device_cache, immediate_foreign_keys, save_with_cached_device
+from .models import ReceiveData
+
+
+logger = logging.getLogger(__name__)
+
+FLUSH_BATCH_SIZE = 1000
+# At most this many batches are flushed per run; the rest are left for the
+# next run
+FLUSH_MAX_BATCHES = 100
+# The flush lock is renewed to this for every batch
+FLUSH_LOCK_TIMEOUT = 60
+
+
+class IngestBuffer:
+    """Append-only buffer of received payloads kept in a Redis stream.
+
+    The ingest endpoint appends payloads to the stream and returns right
+    away. `flush()` moves the buffered payloads to ReceiveData in large
+    batches. Entries are removed from the stream only after they have been
+    committed to the database, so delivery is at-least-once; the event
+    processor already ignores duplicate samples. Redis should be run with
+    AOF persistence for the buffer to survive restarts.
+
+    Entries that cannot be saved are moved to the dead letter stream
+    `<stream_name>:dead`, so that they do not block the rest of the buffer.
+    """
+
+    group_name = 'flusher'
+    consumer_name = 'flusher'
+
+    def __init__(self, url, stream_name):
+        self.url = url
+        self.stream_name = stream_name
+        self.dead_letter_stream_name = '%s:dead' % stream_name
+        self._redis = None
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = redis.Redis.from_url(self.url)
+        return self._redis
+
+    def append(self, data, received_at, payload=None):
+        fields = {
+            'data': orjson.dumps(data),
+            'received_at': received_at.isoformat(),
+        }
+        if payload is not None:
+            fields['payload'] = payload
+        return self.redis.xadd(self.stream_name, fields)
+
+    def ensure_group(self):
+        try:
+            self.redis.xgroup_create(self.stream_name, self.group_name, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def read(self, start_id, count):
+        resp = self.redis.xreadgroup(
+            self.group_name, self.consumer_name, {self.stream_name: start_id}, count=count
+        )
+        if not resp:
+            return []
+        return resp[0][1]
+
+    def dead_letter(self, entry_id, fields, error):
+        logger.error('Moving buffered ingest entry %s to the dead letter stream: %s' % (entry_id, error))
+        fields = dict(fields)
+        fields[b'entry_id'] = entry_id
+        fields[b'error'] = str(error)
+        self.redis.xadd(self.dead_letter_stream_name, fields)
+
+    def entries_to_objects(self, entries):
+        """Return the (entry_id, fields, obj) of the entries that could be decoded."""
+        objs = []
+        for entry_id, fields in entries:
+            try:
+                data = orjson.loads(fields[b'data'])
+                received_at = isoparse(fields[b'received_at'].decode('ascii'))
+            except Exception as e:
+                self.dead_letter(entry_id, fields, e)
+                continue
+            obj = ReceiveData(data=data, payload=fields.get(b'payload'), received_at=received_at)
+            try:
+                dev = device_cache.get(obj.get_uuid())
+            except Exception:
+                dev = None
+            if dev is not None:
+                obj.device_id = dev.id
+            objs.append((entry_id, fields, obj))
+        return objs
+
+    def save_objects(self, objs):
+        """Save the decoded entries, moving the ones that fail to the dead letter stream.
+
+        The entries are saved in one statement. If that fails, they are saved
+        one at a time to find the ones that cannot be saved.
+        """
+        try:
+            # A device deleted after it was cached fails the batch here
+            # instead of at commit, so that its entries are retried below
+            with immediate_foreign_keys():
+                ReceiveData.objects.bulk_create([obj for _, _, obj in objs])
+            return len(objs)
+        except DatabaseError as e:
+            logger.warning('Saving a batch of %d buffered ingest entries failed, saving them one by one: %s' % (
+                len(objs), e
+            ))
+
+        saved = 0
+        for entry_id, fields, obj in objs:
+            obj.pk = None
+            try:
+                with transaction.atomic():
+                    save_with_cached_device(obj)
+            except DatabaseError as e:
+                self.dead_letter(entry_id, fields, e)
+                continue
+            saved += 1
+        return saved
+
+    def flush(self, batch_size=FLUSH_BATCH_SIZE, max_batches=FLUSH_MAX_BATCHES):
+        lock = self.redis.lock('%s:flush-lock' % self.stream_name, timeout=FLUSH_LOCK_TIMEOUT)
+        if not lock.acquire(blocking=False):
+            logger.info('Ingest buffer is already being flushed')
+            return 0
+
+        total = 0
+        try:
+            self.ensure_group()
+            # First re-deliver entries that an interrupted flush read but did
+            # not get to acknowledge, then continue with new entries.
+            start_id = '0'
+            n_batches = 0
+            while n_batches < max_batches:
+                # All flushers read as the same consumer, so a batch must
+                # only be read while holding the lock.
+                try:
+                    lock.reacquire()
+                except LockNotOwnedError:
+                    logger.warning('Ingest buffer flush lock expired, stopping the flush')
+                    break
+                entries = self.read(start_id, batch_size)
+                if not entries:
+                    if start_id == '0':
+                        start_id = '>'
+                        continue
+                    break
+                saved = self.save_objects(self.entries_to_objects(entries))
+                # Entries that could not be saved are in the dead letter
+                # stream by now, so the whole batch is acknowledged.
+                entry_ids = [entry_id for entry_id, _ in entries]
+                self.redis.xack(self.stream_name, self.group_name, *entry_ids)
+                self.redis.xdel(self.stream_name, *entry_ids)
+                total += saved
+                n_batches += 1
+        finally:
+            try:
+                lock.release()
+            except LockNotOwnedError:
+                pass
+
+        logger.info('%d buffered ingest payloads flushed' % total)
+        return total
+
+
+ingest_buffer = IngestBuffer(
+    url=settings.INGEST_BUFFER_REDIS_URL,
+    stream_name=settings.INGEST_BUFFER_STREAM,
+)
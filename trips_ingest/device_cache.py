@@ -0,0 +1,158 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, connection, transaction
+
+
+@dataclass(frozen=True)
+class CachedDevice:
+    id: int
+    debug_log_level: Optional[int]
+    has_custom_config: bool
+    debugging_enabled: bool
+
+    @property
+    def needs_debug_handling(self):
+        return bool(self.debug_log_level or self.has_custom_config or self.debugging_enabled)
+
+
+# Marker for uuids that do not have a device, so unknown devices are cached too
+NO_DEVICE = object()
+
+
+class DeviceCache:
+    """TTL-bounded LRU cache of the device metadata the ingest endpoint needs.
+
+    Entries are kept in-process and, if `cache_alias` is given, in the
+    configured Django cache so that all processes share them. Saving or
+    deleting a Device invalidates its entry; in other processes the
+    in-process entry lives at most `ttl` seconds. Unknown uuids are cached
+    only for `negative_ttl` seconds, as the device may register any moment.
+    """
+
+    def __init__(self, max_size=10000, ttl=60, cache_alias=None, negative_ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache_alias = cache_alias
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cache_key(self, uuid):
+        return 'ingest-device:%s' % uuid
+
+    def _get_local(self, uuid):
+        with self._lock:
+            entry = self._entries.get(uuid)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[uuid]
+                return None
+            self._entries.move_to_end(uuid)
+            return value
+
+    def _get_ttl(self, value):
+        return self.negative_ttl if value is NO_DEVICE else self.ttl
+
+    def _set_local(self, uuid, value):
+        ttl = self._get_ttl(value)
+        if not ttl:
+            return
+        with self._lock:
+            self._entries[uuid] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(uuid)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _fetch(self, uuid):
+        from trips.models import Device
+
+        row = (
+            Device.objects.filter(uuid=uuid)
+            .values('id', 'debug_log_level', 'custom_config', 'debugging_enabled_at')
+            .first()
+        )
+        if row is None:
+            return NO_DEVICE
+        return CachedDevice(
+            id=row['id'],
+            debug_log_level=row['debug_log_level'],
+            has_custom_config=bool(row['custom_config']),
+            debugging_enabled=row['debugging_enabled_at'] is not None,
+        )
+
+    def get(self, uuid) -> Optional[CachedDevice]:
+        uuid = str(uuid)
+        value = self._get_local(uuid)
+        if value is None and self.cache_alias:
+            data = caches[self.cache_alias].get(self._cache_key(uuid))
+            if data is not None:
+                value = CachedDevice(**data) if data else NO_DEVICE
+        if value is None:
+            value = self._fetch(uuid)
+            ttl = self._get_ttl(value)
+            if self.cache_alias and ttl:
+                data = asdict(value) if value is not NO_DEVICE else {}
+                caches[self.cache_alias].set(self._cache_key(uuid), data, ttl)
+        self._set_local(uuid, value)
+        if value is NO_DEVICE:
+            return None
+        return value
+
+    def invalidate(self, uuid):
+        uuid = str(uuid)
+        with self._lock:
+            self._entries.pop(uuid, None)
+        if self.cache_alias:
+            caches[self.cache_alias].delete(self._cache_key(uuid))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+device_cache = DeviceCache(
+    max_size=settings.INGEST_DEVICE_CACHE_SIZE,
+    ttl=settings.INGEST_DEVICE_CACHE_TTL,
+    negative_ttl=settings.INGEST_DEVICE_CACHE_NEGATIVE_TTL,
+    cache_alias=settings.INGEST_DEVICE_CACHE_ALIAS,
+)
+
+
+@contextmanager
+def immediate_foreign_keys():
+    """Check foreign keys at every statement in the block instead of at commit."""
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        yield
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+
+
+def save_with_cached_device(obj):
+    """Save a ReceiveData whose device was looked up from `device_cache`.
+
+    The device may have been deleted after it was cached in this process.
+    In that case the cache entry is dropped and `obj` is saved without a
+    device, like for unknown devices.
+    """
+    if obj.device_id is None:
+        obj.save()
+        return
+    try:
+        with immediate_foreign_keys():
+            obj.save()
+    except IntegrityError:
+        device_cache.invalidate(obj.get_uuid())
+        obj.pk = None
+        obj.device_id = None
+        obj.save()
@@ -0,0 +1,158 @@
+"""Compact columnar binary format for location uploads.
+
+A batch is a fixed 24-byte header followed by one little-endian column per
+field, each with `count` values:
+
+    header:     magic b'MLB1', uint32 count, 16 bytes device uuid
+    time:       float64, seconds since the Unix epoch
+    lon, lat:   float64, WGS84
+    accuracy:   float32, meters (NaN if unknown)
+    speed:      float32, m/s (NaN if unknown)
+    heading:    float32, degrees (NaN if unknown)
+    odometer:   float32, meters (NaN if unknown)
+    atype:      uint8, index to ACTIVITY_TYPE_CODES
+    aconf:      uint8, activity confidence in percent (255 if unknown)
+    is_moving:  int8, 0 or 1 (-1 if unknown)
+
+The upload body may additionally be compressed with gzip or zstd
+(signalled with the Content-Encoding header). Bodies that decompress to more
+than MAX_DECOMPRESSED_SIZE bytes are rejected.
+"""
+import io
+import uuid
+import zlib
+from dataclasses import dataclass
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MEDIA_TYPE = 'application/vnd.mocaf.location-batch'
+DATA_TYPE = 'location_batch'
+MAGIC = b'MLB1'
+
+HEADER_DTYPE = np.dtype([('magic', 'S4'), ('count', '<u4'), ('uuid', 'V16')])
+COLUMNS = [
+    ('time', '<f8'),
+    ('lon', '<f8'),
+    ('lat', '<f8'),
+    ('accuracy', '<f4'),
+    ('speed', '<f4'),
+    ('heading', '<f4'),
+    ('odometer', '<f4'),
+    ('atype', 'u1'),
+    ('aconf', 'u1'),
+    ('is_moving', 'i1'),
+]
+# Order must stay fixed, as clients send the indexes
+ACTIVITY_TYPE_CODES = [
+    'unknown', 'still', 'on_foot', 'walking', 'running', 'on_bicycle', 'in_vehicle',
+]
+UNKNOWN_ACONF = 255
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+
+class InvalidBatchError(Exception):
+    pass
+
+
+class UnsupportedEncodingError(Exception):
+    pass
+
+
+class BodyTooLargeError(Exception):
+    pass
+
+
+@dataclass
+class LocationBatchUpload:
+    """A parsed binary location upload, still in its encoded form."""
+    uuid: uuid.UUID
+    count: int
+    payload: bytes
+
+    @property
+    def metadata(self):
+        # Stored in ReceiveData.data
+        return {'dataType': DATA_TYPE, 'uid': str(self.uuid), 'count': self.count}
+
+
+def decompress_body(body: bytes, content_encoding: str = None) -> bytes:
+    encoding = (content_encoding or '').strip().lower()
+    if encoding in ('', 'identity'):
+        return body
+    if encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out = decompressor.decompress(body, MAX_DECOMPRESSED_SIZE + 1)
+        if len(out) > MAX_DECOMPRESSED_SIZE:
+            raise BodyTooLargeError('decompressed body too large')
+        if not decompressor.eof:
+            raise zlib.error('truncated gzip body')
+        return out
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise UnsupportedEncodingError('zstd support not installed')
+        # decompress() would trust the content size in the frame header, so
+        # the output is read from a stream up to the limit instead
+        chunks = []
+        size = 0
+        with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)) as reader:
+            while size <= MAX_DECOMPRESSED_SIZE:
+                chunk = reader.read(MAX_DECOMPRESSED_SIZE + 1 - size)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+        if size > MAX_DECOMPRESSED_SIZE:
+            raise BodyTooLargeError('decompressed body too large')
+        return b''.join(chunks)
+    raise UnsupportedEncodingError('unsupported content encoding: %s' % encoding)
+
+
+def read_header(payload: bytes):
+    if len(payload) < HEADER_DTYPE.itemsize:
+        raise InvalidBatchError('batch too short')
+    header = np.frombuffer(payload, dtype=HEADER_DTYPE, count=1)[0]
+    if header['magic'] != MAGIC:
+        raise InvalidBatchError('invalid batch magic')
+    count = int(header['count'])
+    expected_size = HEADER_DTYPE.itemsize + count * sum(np.dtype(dt).itemsize for _, dt in COLUMNS)
+    if len(payload) != expected_size:
+        raise InvalidBatchError('batch size does not match sample count')
+    return uuid.UUID(bytes=header['uuid'].tobytes()), count
+
+
+def parse_upload(payload: bytes) -> LocationBatchUpload:
+    uid, count = read_header(payload)
+    return LocationBatchUpload(uuid=uid, count=count, payload=payload)
+
+
+def decode_location_batch(payload: bytes):
+    """Decode a batch into a dict of NumPy arrays without copying the columns."""
+    _, count = read_header(payload)
+    offset = HEADER_DTYPE.itemsize
+    columns = {}
+    for name, dt in COLUMNS:
+        dt = np.dtype(dt)
+        columns[name] = np.frombuffer(payload, dtype=dt, count=count, offset=offset)
+        offset += count * dt.itemsize
+    return columns
+
+
+def encode_location_batch(uid, columns) -> bytes:
+    count = len(columns['time'])
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header['magic'] = MAGIC
+    header['count'] = count
+    header['uuid'] = np.void(uuid.UUID(str(uid)).bytes)
+    parts = [header.tobytes()]
+    for name, dt in COLUMNS:
+        arr = np.asarray(columns[name], dtype=dt)
+        if len(arr) != count:
+            raise InvalidBatchError('column %s has invalid length' % name)
+        parts.append(arr.tobytes())
+    return b''.join(parts)
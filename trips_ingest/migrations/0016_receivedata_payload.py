@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips_ingest', '0015_add_location_deleted_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receivedata',
+            name='payload',
+            field=models.BinaryField(null=True),
+        ),
+    ]
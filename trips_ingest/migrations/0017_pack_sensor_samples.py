@@ -0,0 +1,118 @@
+import struct
+import zlib
+
+import django.contrib.postgres.fields
+import numpy as np
+from django.db import migrations, models, transaction
+
+
+BATCH_SIZE = 1000
+
+# Copy of the packed format of trips_ingest.sensor_packing at the time of
+# this migration, so that later changes to it do not change the migration
+MAGIC = b'MSS1'
+HEADER = struct.Struct('<4sBxxxQ')
+FLOAT32 = 1
+DELTA_INT16 = 2
+
+
+def pack_sensor_arrays(x, y, z, t):
+    arrays = [np.asarray(a, dtype=np.float64) for a in (x, y, z, t)]
+    count = len(arrays[0])
+    if any(len(a) != count for a in arrays):
+        raise ValueError('sensor arrays must have the same length')
+    parts = [HEADER.pack(MAGIC, FLOAT32, count)]
+    parts += [a.astype('<f4').tobytes() for a in arrays]
+    return zlib.compress(b''.join(parts))
+
+
+def unpack_sensor_arrays(data):
+    buf = zlib.decompress(bytes(data))
+    magic, encoding, count = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ValueError('invalid magic')
+    offset = HEADER.size
+    if encoding == FLOAT32:
+        return tuple(
+            np.frombuffer(buf, dtype='<f4', count=count, offset=offset + i * 4 * count)
+            for i in range(4)
+        )
+    if encoding == DELTA_INT16:
+        scales = np.frombuffer(buf, dtype='<f8', count=4, offset=offset)
+        offset += 8 * 4
+        return tuple(
+            np.cumsum(
+                np.frombuffer(buf, dtype='<i2', count=count, offset=offset + i * 2 * count), dtype=np.int64
+            ) * scales[i]
+            for i in range(4)
+        )
+    raise ValueError('unknown encoding: %s' % encoding)
+
+
+# The migration is not atomic, so that each batch is committed on its own
+# instead of repacking the whole table in one transaction.
+
+def pack_existing_samples(apps, schema_editor):
+    SensorSample = apps.get_model('trips_ingest', 'SensorSample')
+    qs = SensorSample.objects.filter(packed__isnull=True, x__isnull=False).order_by('id')
+    while True:
+        with transaction.atomic():
+            batch = list(qs[:BATCH_SIZE])
+            if not batch:
+                break
+            for obj in batch:
+                obj.packed = pack_sensor_arrays(obj.x, obj.y, obj.z, obj.t)
+                obj.x = obj.y = obj.z = obj.t = None
+            SensorSample.objects.bulk_update(batch, ['packed', 'x', 'y', 'z', 't'])
+
+
+def unpack_existing_samples(apps, schema_editor):
+    SensorSample = apps.get_model('trips_ingest', 'SensorSample')
+    qs = SensorSample.objects.filter(packed__isnull=False).order_by('id')
+    while True:
+        with transaction.atomic():
+            batch = list(qs[:BATCH_SIZE])
+            if not batch:
+                break
+            for obj in batch:
+                x, y, z, t = unpack_sensor_arrays(obj.packed)
+                obj.x, obj.y, obj.z, obj.t = x.tolist(), y.tolist(), z.tolist(), t.tolist()
+                obj.packed = None
+            SensorSample.objects.bulk_update(batch, ['packed', 'x', 'y', 'z', 't'])
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('trips_ingest', '0016_receivedata_payload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sensorsample',
+            name='packed',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='sensorsample',
+            name='t',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), null=True, size=None),
+        ),
+        migrations.AlterField(
+            model_name='sensorsample',
+            name='x',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), null=True, size=None),
+        ),
+        migrations.AlterField(
+            model_name='sensorsample',
+            name='y',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), null=True, size=None),
+        ),
+        migrations.AlterField(
+            model_name='sensorsample',
+            name='z',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), null=True, size=None),
+        ),
+        migrations.RunPython(pack_existing_samples, unpack_existing_samples),
+    ]
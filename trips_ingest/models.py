@@ -1,4 +1,5 @@
 import gzip
+import numpy as np
 import pytz
 from django.db.models import Q
 from django.contrib.gis.db import models
@@ -19,7 +20,7 @@ class ReceiveDataQuerySet(models.QuerySet):
 
     def by_type(self, data_type):
         if data_type == 'location':
-            return self.filter(data__location__isnull=False)
+            return self.filter(Q(data__location__isnull=False) | Q(data__dataType='location_batch'))
         elif data_type == 'sensor':
             return self.filter(data__dataType='sensor2')
         elif data_type == 'device_info':
@@ -30,6 +31,8 @@ class ReceiveDataQuerySet(models.QuerySet):
 
 class ReceiveData(models.Model):
     data = models.JSONField()
+    # Binary location batches are stored here, with only metadata in `data`
+    payload = models.BinaryField(null=True)
     device = models.ForeignKey(
         'trips.Device', on_delete=models.CASCADE, null=True, related_name='receive_data'
     )
@@ -59,6 +62,8 @@ class ReceiveData(models.Model):
             return 'unknown'
         if data_type == 'sensor2':
             return 'sensor'
+        elif data_type == 'location_batch':
+            return 'location'
         elif data_type == 'device_info':
             return 'device_info'
         elif data_type == 'heartbeat':
@@ -73,6 +78,8 @@ class ReceiveData(models.Model):
                 return loc[0].get('extras', {}).get('uid')
         if 'userId' in self.data:
             return self.data['userId']
+        if 'uid' in self.data:
+            return self.data['uid']
 
     def process_event(self):
         from .processor import EventProcessor
@@ -204,10 +211,13 @@ class SensorTypeChoices(models.TextChoices):
 class SensorSample(models.Model):
     time = models.DateTimeField()
     uuid = models.UUIDField()
-    x = ArrayField(models.FloatField())
-    y = ArrayField(models.FloatField())
-    z = ArrayField(models.FloatField())
-    t = ArrayField(models.FloatField())
+    # Legacy unpacked storage; new samples are stored in `packed`
+    x = ArrayField(models.FloatField(), null=True)
+    y = ArrayField(models.FloatField(), null=True)
+    z = ArrayField(models.FloatField(), null=True)
+    t = ArrayField(models.FloatField(), null=True)
+    # x, y, z and t packed with trips_ingest.sensor_packing
+    packed = models.BinaryField(null=True)
     type = models.CharField(max_length=20, choices=SensorTypeChoices.choices)
 
     class Meta:
@@ -215,3 +225,11 @@ class SensorSample(models.Model):
         unique_together = (('uuid', 'time', 'type',),)
         ordering = ('uuid', 'time')
         managed = True
+
+    def get_arrays(self):
+        """Return the x, y, z and t arrays as NumPy arrays."""
+        from .sensor_packing import unpack_sensor_arrays
+
+        if self.packed is not None:
+            return unpack_sensor_arrays(self.packed)
+        return tuple(np.array(getattr(self, col), dtype=np.float64) for col in ('x', 'y', 'z', 't'))
@@ -0,0 +1,40 @@
+import io
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, JSONParser
+
+from .location_batch import (
+    MEDIA_TYPE as LOCATION_BATCH_MEDIA_TYPE, InvalidBatchError, UnsupportedEncodingError, decompress_body,
+    parse_upload
+)
+
+
+def read_body(stream, parser_context):
+    request = parser_context['request']
+    encoding = request.META.get('HTTP_CONTENT_ENCODING')
+    body = stream.read() if stream is not None else b''
+    try:
+        return decompress_body(body, encoding)
+    except UnsupportedEncodingError as e:
+        raise ParseError(str(e))
+    except Exception:
+        raise ParseError('unable to decompress request body')
+
+
+class DecompressingJSONParser(JSONParser):
+    """JSON parser that also accepts gzip or zstd compressed bodies."""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        body = read_body(stream, parser_context)
+        return super().parse(io.BytesIO(body), media_type, parser_context)
+
+
+class LocationBatchParser(BaseParser):
+    media_type = LOCATION_BATCH_MEDIA_TYPE
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        body = read_body(stream, parser_context)
+        try:
+            return parse_upload(body)
+        except InvalidBatchError as e:
+            raise ParseError(str(e))
@@ -1,3 +1,4 @@
+import bisect
 import uuid
 import pytz
 from datetime import datetime, timedelta
@@ -5,22 +6,48 @@ import logging
 
 from dateutil.parser import isoparse
 import sentry_sdk
-from django.db import transaction, IntegrityError
+from django.db import connection, transaction, IntegrityError
 from django.utils import timezone
-from django.contrib.gis.geos import Point
-from django.contrib.gis.gdal import SpatialReference, CoordTransform
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
 from calc.trips import LOCAL_2D_CRS
-from trips.models import Device
+from utils.geo import gps_to_local, valid_local_coords_mask
+from trips.models import Device, DeviceProcessingState
+from .location_batch import (
+    ACTIVITY_TYPE_CODES, DATA_TYPE as LOCATION_BATCH_TYPE, UNKNOWN_ACONF, InvalidBatchError, decode_location_batch
+)
 from .models import ReceiveData, Location, DeviceHeartbeat, ActivityTypeChoices, SensorSample
+from .sensor_packing import pack_sensor_arrays
 
 
 logger = logging.getLogger(__name__)
 
 ACTIVITY_TYPES = set([x.value for x in list(ActivityTypeChoices)])
 
-LOCAL_CRS = SpatialReference(LOCAL_2D_CRS)
-GPS_CRS = SpatialReference(4326)
-coord_transform = CoordTransform(GPS_CRS, LOCAL_CRS)
+LOCATION_TABLE = Location._meta.db_table
+MAX_SAMPLE_AGE = timedelta(days=7)
+MAX_SAMPLE_FUTURE = timedelta(minutes=5)
+# 2000-01-01T00:00:00Z
+MIN_VALID_TIMESTAMP = 946684800
+BATCH_ACTIVITY_TYPES = np.array(ACTIVITY_TYPE_CODES, dtype=object)
+
+# Samples closer in time than this to an existing sample are treated as duplicates
+DUPLICATE_LOCATION_WINDOW = timedelta(seconds=0.5)
+
+HEARTBEAT_TABLE = DeviceHeartbeat._meta.db_table
+SENSOR_SAMPLE_TABLE = SensorSample._meta.db_table
+# Sensor samples of the same type closer in time than this are treated as duplicates
+DUPLICATE_SENSOR_WINDOW = timedelta(seconds=1)
+
+RECEIVE_DATA_TABLE = ReceiveData._meta.db_table
+# Same precedence as ReceiveData.get_uuid()
+RECEIVE_DATA_UUID_SQL = """COALESCE(
+    data->>'uid', data->'location'->0->'extras'->>'uid', data->>'userId', ''
+)"""
+# Advisory lock namespace for the ingest shards ("in" + "gs")
+INGEST_SHARD_LOCK_KEY = 0x696e6773
+CLAIM_BATCH_SIZE = 500
 
 
 def null_float(val):
@@ -43,89 +70,273 @@ def uuid_or_bye(val):
 
 def sane_time_or_bye(dt):
     now = timezone.now()
-    if dt < now - timedelta(days=7):
+    if dt < now - MAX_SAMPLE_AGE:
         raise InvalidEventError('time is too much in the past')
-    if dt > now + timedelta(minutes=5):
+    if dt > now + MAX_SAMPLE_FUTURE:
         raise InvalidEventError('time is too much in the future')
     return dt
 
 
 class EventProcessor:
     def __init__(self):
-        pass
+        # Heartbeat and sensor rows are collected here while processing a batch
+        self.pending_upserts = None
 
     def mark_imported(self, event, failed=False):
         event.import_failed = failed
         event.imported_at = timezone.now()
         event.save(update_fields=['import_failed', 'imported_at'])
 
+    def bulk_mark_imported(self, events, failed=False):
+        if not events:
+            return
+        ReceiveData.objects.filter(id__in=[event.id for event in events]).update(
+            import_failed=failed, imported_at=timezone.now()
+        )
+
+    def location_to_row(self, event, loc):
+        DICT_KEYS = ['activity', 'coords', 'extras']
+        for key in DICT_KEYS:
+            if not isinstance(loc.get(key), dict):
+                raise InvalidEventError("location.%s missing or invalid" % key)
+
+        try:
+            ts = loc.get('timestamp')
+            dt = isoparse(loc.get('timestamp'))
+        except Exception:
+            raise InvalidEventError("location has invalid time")
+
+        # Sometimes we get individual timestamps from 1980s...
+        if dt.year < 2000:
+            logger.info('Invalid timestamp for location: %s' % ts)
+            return None
+
+        row = dict(
+            time=sane_time_or_bye(dt),
+            uuid=uuid_or_bye(event.data.get('uid') or loc['extras'].get('uid')),
+            created_at=event.received_at,
+        )
+
+        atype = loc['activity'].get('type')
+        if atype not in ACTIVITY_TYPES:
+            raise InvalidEventError("invalid activity type")
+        row['atype'] = atype
+        row['aconf'] = null_float(loc['activity'].get('confidence'))
+
+        heading = null_float(loc['coords'].get('heading'))
+        if heading is not None and heading > 360:
+            raise InvalidEventError("invalid heading")
+        row['heading'] = heading
+        row['heading_error'] = null_float(loc['coords'].get('heading_accuracy'))
+        row['altitude'] = null_float(loc['coords'].get('altitude'))
+        row['altitude_error'] = null_float(loc['coords'].get('altitude_accuracy'))
+        row['speed'] = null_float(loc['coords'].get('speed'))
+        row['speed_error'] = null_float(loc['coords'].get('speed_accuracy'))
+        row['odometer'] = null_float(loc.get('odometer'))
+        row['loc_error'] = null_float(loc['coords'].get('accuracy'))
+
+        # Coordinates are transformed for the whole batch at once later
+        row['lon'] = loc['coords']['longitude']
+        row['lat'] = loc['coords']['latitude']
+
+        row['debug'] = bool(event.data.get('debug') or loc['extras'].get('debug', 0))
+        row['is_moving'] = loc.get('is_moving')
+        row['battery_charging'] = loc.get('battery', {}).get('is_charging')
+        return row
+
+    def transform_location_coords(self, rows):
+        if not rows:
+            return
+        try:
+            lon = np.array([row['lon'] for row in rows], dtype=np.float64)
+            lat = np.array([row['lat'] for row in rows], dtype=np.float64)
+        except (TypeError, ValueError):
+            raise InvalidEventError("invalid coords")
+        x, y = gps_to_local(lon, lat, LOCAL_2D_CRS)
+        if not valid_local_coords_mask(x, y).all():
+            raise InvalidEventError("invalid coords")
+        for row, row_x, row_y in zip(rows, x.tolist(), y.tolist()):
+            row['x'] = row_x
+            row['y'] = row_y
+
+    def drop_duplicate_locations(self, rows):
+        """Drop rows that already have a stored sample within DUPLICATE_LOCATION_WINDOW.
+
+        All existing sample times for the batch are fetched with one query.
+        """
+        if not rows:
+            return rows
+
+        uuids = set(row['uuid'] for row in rows)
+        min_time = min(row['time'] for row in rows) - DUPLICATE_LOCATION_WINDOW
+        max_time = max(row['time'] for row in rows) + DUPLICATE_LOCATION_WINDOW
+        existing = (
+            Location.objects.filter(uuid__in=uuids, time__gte=min_time, time__lte=max_time)
+            .values_list('uuid', 'time').order_by('time')
+        )
+        existing_times = {}
+        for uid, time in existing:
+            existing_times.setdefault(uid, []).append(time)
+
+        new_rows = []
+        for row in rows:
+            times = existing_times.setdefault(row['uuid'], [])
+            idx = bisect.bisect_left(times, row['time'] - DUPLICATE_LOCATION_WINDOW)
+            if idx < len(times) and times[idx] <= row['time'] + DUPLICATE_LOCATION_WINDOW:
+                logger.warning('Location for %s at %s already exists' % (row['uuid'], row['time']))
+                continue
+            # Also catch duplicates within the batch itself
+            bisect.insort(times, row['time'])
+            new_rows.append(row)
+
+        return new_rows
+
+    def insert_locations(self, rows):
+        query = f"""
+            INSERT INTO {LOCATION_TABLE}
+                (time, uuid, loc, loc_error, atype, aconf, speed, speed_error,
+                altitude, altitude_error, heading, heading_error, odometer,
+                is_moving, battery_charging, created_at, debug)
+            VALUES %s
+            ON CONFLICT (time, uuid) DO NOTHING
+        """
+        template = "(%(time)s, %(uuid)s, "
+        template += f"ST_SetSRID(ST_MakePoint(%(x)s, %(y)s), {LOCAL_2D_CRS}), "
+        template += "%(loc_error)s, %(atype)s, %(aconf)s, %(speed)s, %(speed_error)s, "
+        template += "%(altitude)s, %(altitude_error)s, %(heading)s, %(heading_error)s, %(odometer)s, "
+        template += "%(is_moving)s, %(battery_charging)s, %(created_at)s, %(debug)s)"
+
+        for row in rows:
+            row['uuid'] = str(row['uuid'])
+        with connection.cursor() as cursor:
+            execute_values(cursor, query, rows, template=template, page_size=2048)
+
     def process_location_event(self, event):
         locs = event.data.get('location')
         if not isinstance(locs, list):
             raise InvalidEventError("location missing or invalid")
 
-        DICT_KEYS = ['activity', 'coords', 'extras']
-        last_uuid = None
+        # Validate the whole batch before touching the database, so that
+        # an invalid sample fails the event without partial writes.
+        rows = []
         for loc in locs:
-            for key in DICT_KEYS:
-                if not isinstance(loc.get(key), dict):
-                    raise InvalidEventError("location.%s missing or invalid" % key)
-
-            obj = Location(created_at=event.received_at)
+            row = self.location_to_row(event, loc)
+            if row is not None:
+                rows.append(row)
+        self.transform_location_coords(rows)
+
+        last_uuid = rows[-1]['uuid'] if rows else None
+        rows = self.drop_duplicate_locations(rows)
+        if rows:
+            self.insert_locations(rows)
+            for uid in set(row['uuid'] for row in rows):
+                self.queue_upsert(event, 'pending_devices', uid)
+
+        logger.info('%d location samples saved for %s' % (len(rows), last_uuid))
+
+    def drop_duplicate_location_times(self, uid, ts):
+        """Return a mask of the (sorted) epoch times that are not duplicates."""
+        window = DUPLICATE_LOCATION_WINDOW.total_seconds()
+        keep = np.ones(len(ts), dtype=bool)
+        # Duplicates within the batch itself
+        keep[1:] = np.diff(ts) > window
+
+        min_time = datetime.fromtimestamp(ts[0] - window, pytz.utc)
+        max_time = datetime.fromtimestamp(ts[-1] + window, pytz.utc)
+        existing = (
+            Location.objects.filter(uuid=uid, time__gte=min_time, time__lte=max_time)
+            .values_list('time', flat=True)
+        )
+        existing_ts = np.sort(np.array([t.timestamp() for t in existing], dtype=np.float64))
+        if len(existing_ts):
+            pos = np.searchsorted(existing_ts, ts - window)
+            nearest = existing_ts[np.minimum(pos, len(existing_ts) - 1)]
+            dup = (pos < len(existing_ts)) & (nearest <= ts + window)
+            if dup.any():
+                logger.warning('%d locations for %s already exist' % (np.count_nonzero(dup), uid))
+            keep &= ~dup
+        return keep
+
+    def process_location_batch_event(self, event):
+        if event.payload is None:
+            raise InvalidEventError("location batch payload missing")
+        try:
+            batch = decode_location_batch(bytes(event.payload))
+        except InvalidBatchError as e:
+            raise InvalidEventError(str(e))
+        uid = uuid_or_bye(event.data.get('uid'))
+
+        ts = batch['time']
+        if not np.isfinite(ts).all():
+            raise InvalidEventError("location has invalid time")
+        # Sometimes we get individual timestamps from 1980s...
+        idx = np.flatnonzero(ts >= MIN_VALID_TIMESTAMP)
+        idx = idx[np.argsort(ts[idx], kind='stable')]
+        if not len(idx):
+            return
 
-            try:
-                ts = loc.get('timestamp')
-                dt = isoparse(loc.get('timestamp'))
-            except Exception:
-                raise InvalidEventError("location has invalid time")
-
-            # Sometimes we get individual timestamps from 1980s...
-            if dt.year < 2000:
-                logger.info('Invalid timestamp for location: %s' % ts)
-                continue
+        ts = ts[idx]
+        now = timezone.now().timestamp()
+        if ts[0] < now - MAX_SAMPLE_AGE.total_seconds():
+            raise InvalidEventError('time is too much in the past')
+        if ts[-1] > now + MAX_SAMPLE_FUTURE.total_seconds():
+            raise InvalidEventError('time is too much in the future')
+
+        atype = batch['atype'][idx]
+        if (atype >= len(BATCH_ACTIVITY_TYPES)).any():
+            raise InvalidEventError("invalid activity type")
+        if (batch['heading'][idx] > 360).any():
+            raise InvalidEventError("invalid heading")
+
+        x, y = gps_to_local(batch['lon'][idx], batch['lat'][idx], LOCAL_2D_CRS)
+        if not valid_local_coords_mask(x, y).all():
+            raise InvalidEventError("invalid coords")
+
+        keep = self.drop_duplicate_location_times(uid, ts)
+        idx = idx[keep]
+        if not len(idx):
+            return
 
-            obj.time = sane_time_or_bye(dt)
-            obj.uuid = uuid_or_bye(event.data.get('uid') or loc['extras'].get('uid'))
-
-            if Location.objects.filter(
-                time__gte=obj.time - timedelta(seconds=0.5), time__lte=obj.time + timedelta(seconds=0.5),
-                uuid=obj.uuid
-            ).exists():
-                logger.warning('Location for %s at %s already exists' % (obj.uuid, obj.time))
-                return
-
-            last_uuid = obj.uuid
-
-            atype = loc['activity'].get('type')
-            if atype not in ACTIVITY_TYPES:
-                raise InvalidEventError("invalid activity type")
-            obj.atype = atype
-            obj.aconf = null_float(loc['activity'].get('confidence'))
-
-            heading = null_float(loc['coords'].get('heading'))
-            if heading is not None and heading > 360:
-                raise InvalidEventError("invalid heading")
-            obj.heading = heading
-            obj.heading_error = null_float(loc['coords'].get('heading_accuracy'))
-            obj.altitude = null_float(loc['coords'].get('altitude'))
-            obj.altitude_accuracy = null_float(loc['coords'].get('altitude_accuracy'))
-            obj.speed = null_float(loc['coords'].get('speed'))
-            obj.speed_error = null_float(loc['coords'].get('speed_accuracy'))
-            obj.odometer = null_float(loc.get('odometer'))
-            obj.loc_error = null_float(loc['coords'].get('accuracy'))
-
-            point = Point(loc['coords']['longitude'], loc['coords']['latitude'], srid=LOCAL_2D_CRS)
-            point.transform(coord_transform)
-            if point.x <= 0 or point.y <= 0:
-                raise InvalidEventError("invalid coords")
-            obj.loc = point
-
-            obj.debug = bool(event.data.get('debug') or loc['extras'].get('debug', 0))
-            obj.is_moving = loc.get('is_moving')
-            obj.battery_charging = loc.get('battery', {}).get('is_charging')
-            obj.save(force_insert=True)
-
-        logger.info('%d location samples saved for %s' % (len(locs), last_uuid))
+        columns = [
+            batch['time'][idx].tolist(),
+            x[keep].tolist(),
+            y[keep].tolist(),
+            batch['accuracy'][idx].tolist(),
+            BATCH_ACTIVITY_TYPES[atype[keep]].tolist(),
+            batch['aconf'][idx].tolist(),
+            batch['speed'][idx].tolist(),
+            batch['heading'][idx].tolist(),
+            batch['odometer'][idx].tolist(),
+            batch['is_moving'][idx].tolist(),
+        ]
+        self.insert_location_columns(uid, event.received_at, columns)
+        self.queue_upsert(event, 'pending_devices', str(uid))
+        logger.info('%d location samples saved for %s' % (len(idx), uid))
+
+    def insert_location_columns(self, uid, created_at, columns):
+        # Missing values are encoded as NaN, 255 (aconf) or -1 (is_moving)
+        query = f"""
+            INSERT INTO {LOCATION_TABLE}
+                (time, loc, loc_error, atype, aconf, speed, heading, odometer,
+                is_moving, uuid, created_at, debug)
+            VALUES %s
+            ON CONFLICT (time, uuid) DO NOTHING
+        """
+        template = f"""(
+            to_timestamp(%s),
+            ST_SetSRID(ST_MakePoint(%s, %s), {LOCAL_2D_CRS}),
+            NULLIF(%s :: float8, 'NaN'),
+            %s,
+            NULLIF(%s, {UNKNOWN_ACONF}),
+            NULLIF(%s :: float8, 'NaN'),
+            NULLIF(%s :: float8, 'NaN'),
+            NULLIF(%s :: float8, 'NaN'),
+            NULLIF(%s, -1) = 1,
+            %s, %s, false
+        )"""
+        rows = [row + (str(uid), created_at) for row in zip(*columns)]
+        with connection.cursor() as cursor:
+            execute_values(cursor, query, rows, template=template, page_size=2048)
 
     def process_device_info_event(self, event):
         data = event.data
@@ -141,17 +352,74 @@ class EventProcessor:
         dev.system_version = data.get('systemVersion')
         dev.save()
 
+    def insert_heartbeats(self, rows):
+        query = f"""
+            INSERT INTO {HEARTBEAT_TABLE} (time, uuid, created_at)
+            VALUES %s
+            ON CONFLICT (uuid, time) DO NOTHING
+        """
+        with connection.cursor() as cursor:
+            execute_values(cursor, query, rows, template='(%(time)s, %(uuid)s, %(created_at)s)')
+
+    def insert_sensor_samples(self, rows):
+        """Insert sensor samples, skipping the ones within DUPLICATE_SENSOR_WINDOW of another."""
+        new_rows = []
+        last = {}
+        for row in sorted(rows, key=lambda row: (row['uuid'], row['type'], row['time'])):
+            key = (row['uuid'], row['type'])
+            if key in last and row['time'] - last[key] <= DUPLICATE_SENSOR_WINDOW:
+                logger.warning('Sensor data for %s at %s already exists' % (row['uuid'], row['time']))
+                continue
+            last[key] = row['time']
+            new_rows.append(row)
+
+        window = "interval '%f seconds'" % DUPLICATE_SENSOR_WINDOW.total_seconds()
+        query = f"""
+            INSERT INTO {SENSOR_SAMPLE_TABLE} (time, uuid, type, packed)
+            SELECT v.time, v.uuid, v.type, v.packed
+            FROM (VALUES %s) AS v(time, uuid, type, packed)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {SENSOR_SAMPLE_TABLE} AS s
+                WHERE
+                    s.uuid = v.uuid AND s.type = v.type
+                    AND s.time BETWEEN v.time - {window} AND v.time + {window}
+            )
+            ON CONFLICT (uuid, time, type) DO NOTHING
+        """
+        template = '(%(time)s :: timestamptz, %(uuid)s :: uuid, %(type)s, %(packed)s :: bytea)'
+        with connection.cursor() as cursor:
+            execute_values(cursor, query, new_rows, template=template, page_size=100)
+
+    def insert_pending_devices(self, uuids):
+        DeviceProcessingState.mark_pending(set(uuids), timezone.now())
+
+    def queue_upsert(self, event, kind, row):
+        """Write a row now, or with the rest of the batch if processing one."""
+        if self.pending_upserts is None:
+            getattr(self, 'insert_%s' % kind)([row])
+        else:
+            self.pending_upserts.setdefault(kind, []).append((event, row))
+
+    def flush_upserts(self):
+        """Write queued rows, returning the events whose rows could not be written."""
+        failed_events = []
+        for kind, items in self.pending_upserts.items():
+            try:
+                with transaction.atomic():
+                    getattr(self, 'insert_%s' % kind)([row for _, row in items])
+            except Exception as e:
+                sentry_sdk.capture_exception(e)
+                failed_events += [event for event, _ in items]
+        self.pending_upserts = {}
+        return failed_events
+
     def process_heartbeat_event(self, event):
         data = event.data
         dt = datetime.fromtimestamp(data.get('time') / 1000, pytz.utc)
         uid = uuid_or_bye(data.get('userId'))
         time = sane_time_or_bye(dt)
-        if DeviceHeartbeat.objects.filter(time=time, uuid=uid).exists():
-            logger.warning('Heartbeat for %s at %s already exists' % (uid, time))
-            return
-
-        obj = DeviceHeartbeat(time=sane_time_or_bye(dt), uuid=uid, created_at=event.received_at)
-        obj.save(force_insert=True)
+        # Duplicates are dropped by the unique constraint on (uuid, time)
+        self.queue_upsert(event, 'heartbeats', dict(time=time, uuid=str(uid), created_at=event.received_at))
 
     def process_sensor_event(self, event):
         data = event.data
@@ -166,17 +434,11 @@ class EventProcessor:
         dt = datetime.fromtimestamp(t0 / 1000, pytz.utc)
         dt = sane_time_or_bye(dt)
 
-        sensor_type = data['sensorType']
-
-        if SensorSample.objects.filter(
-            time__gte=dt - timedelta(seconds=1), time__lte=dt + timedelta(seconds=1),
-            uuid=uid, type=sensor_type
-        ).exists():
-            logger.warning('Sensor data for %s at %s already exists' % (uid, dt))
-            return
-
-        obj = SensorSample(time=dt, uuid=uid, x=x, y=y, z=z, t=time, type=data['sensorType'])
-        obj.save(force_insert=True)
+        # Duplicates are dropped by the unique constraint on (uuid, time, type)
+        packed = psycopg2.Binary(pack_sensor_arrays(x, y, z, time))
+        self.queue_upsert(event, 'sensor_samples', dict(
+            time=dt, uuid=str(uid), type=data['sensorType'], packed=packed,
+        ))
 
     def process_event(self, event):
         data = event.data
@@ -189,6 +451,8 @@ class EventProcessor:
 
         if data_type == 'location':
             self.process_location_event(event)
+        elif data_type == LOCATION_BATCH_TYPE:
+            self.process_location_batch_event(event)
         elif data_type == 'sensor2':
             self.process_sensor_event(event)
         elif data_type == 'device_info':
@@ -220,3 +484,93 @@ class EventProcessor:
                         self.mark_imported(event, failed=True)
                     else:
                         self.mark_imported(event, failed=False)
+
+    def claim_events(self, shard, n_shards, batch_size):
+        """Lock and return the next batch of unimported events for a shard.
+
+        Events are sharded by device uuid, so all events of one device are
+        handled by the same shard in the order they were received. Must be
+        called inside a transaction; the row locks are held until it ends.
+        """
+        query = f"""
+            SELECT id FROM {RECEIVE_DATA_TABLE}
+            WHERE
+                imported_at IS NULL
+                AND mod(abs(hashtext({RECEIVE_DATA_UUID_SQL}) :: bigint), %(n_shards)s) = %(shard)s
+            ORDER BY received_at
+            LIMIT %(batch_size)s
+            FOR UPDATE SKIP LOCKED
+        """
+        params = dict(shard=shard, n_shards=n_shards, batch_size=batch_size)
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return []
+        return list(ReceiveData.objects.filter(id__in=ids).order_by('received_at'))
+
+    def lock_shard(self, shard):
+        # Only one worker drains a shard at a time to keep per-device ordering
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_try_advisory_xact_lock(%s, %s)', [INGEST_SHARD_LOCK_KEY, shard]
+            )
+            return cursor.fetchone()[0]
+
+    def process_event_batch(self, events):
+        imported = []
+        failed = []
+        self.pending_upserts = {}
+        try:
+            self.process_events_in_batch(events, imported, failed)
+            failed_upserts = set(event.id for event in self.flush_upserts())
+        finally:
+            self.pending_upserts = None
+
+        if failed_upserts:
+            failed += [event for event in imported if event.id in failed_upserts]
+            imported = [event for event in imported if event.id not in failed_upserts]
+
+        self.bulk_mark_imported(imported, failed=False)
+        self.bulk_mark_imported(failed, failed=True)
+        return len(imported), len(failed)
+
+    def process_events_in_batch(self, events, imported, failed):
+        for event in events:
+            with sentry_sdk.configure_scope() as scope:
+                scope.set_tag('event-id', int(event.id))
+                scope.set_tag('event-received-at', str(event.received_at))
+                try:
+                    with transaction.atomic():
+                        self.process_event(event)
+                except InvalidEventError as e:
+                    logger.info(e)
+                    failed.append(event)
+                except Exception as e:
+                    sentry_sdk.capture_exception(e)
+                    failed.append(event)
+                else:
+                    imported.append(event)
+
+    def process_claimed_events(self, shard=0, n_shards=1, batch_size=CLAIM_BATCH_SIZE):
+        """Drain unimported events of one shard in claimed batches.
+
+        Several workers can run this concurrently for different shards.
+        """
+        assert 0 <= shard < n_shards
+        total_imported = total_failed = 0
+        while True:
+            with transaction.atomic():
+                if not self.lock_shard(shard):
+                    logger.info('Ingest shard %d is already being processed' % shard)
+                    break
+                events = self.claim_events(shard, n_shards, batch_size)
+                if not events:
+                    break
+                n_imported, n_failed = self.process_event_batch(events)
+            total_imported += n_imported
+            total_failed += n_failed
+
+        logger.info('Shard %d/%d: %d events imported, %d failed' % (
+            shard, n_shards, total_imported, total_failed
+        ))
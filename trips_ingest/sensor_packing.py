@@ -0,0 +1,99 @@
+"""Packed storage format for SensorSample arrays.
+
+The x, y, z and t arrays of a sample are stored in one zlib-compressed
+bytea. After a 16-byte header (magic b'MSS1', encoding, count) come the
+four columns, either as:
+
+    FLOAT32:      little-endian float32 values
+    DELTA_INT16:  float64 scale per column followed by the differences of the
+                  values quantized to multiples of the scale, as int16
+
+Arrays with non-finite values cannot be quantized, so they are always stored
+as FLOAT32.
+"""
+import struct
+import zlib
+
+import numpy as np
+
+
+MAGIC = b'MSS1'
+HEADER = struct.Struct('<4sBxxxQ')
+
+FLOAT32 = 1
+DELTA_INT16 = 2
+DEFAULT_ENCODING = FLOAT32
+
+# Quantized values are kept within +-MAX_QUANTIZED so that their
+# differences always fit in an int16.
+MAX_QUANTIZED = 16383
+MIN_SCALE = 1e-6
+
+COLUMNS = ('x', 'y', 'z', 't')
+
+
+class InvalidPackedDataError(Exception):
+    pass
+
+
+def pack_sensor_arrays(x, y, z, t, encoding=DEFAULT_ENCODING) -> bytes:
+    arrays = [np.asarray(a, dtype=np.float64) for a in (x, y, z, t)]
+    count = len(arrays[0])
+    if any(len(a) != count for a in arrays):
+        raise ValueError('sensor arrays must have the same length')
+    if encoding == DELTA_INT16 and not all(np.isfinite(a).all() for a in arrays):
+        encoding = FLOAT32
+
+    parts = [HEADER.pack(MAGIC, encoding, count)]
+    if encoding == FLOAT32:
+        parts += [a.astype('<f4').tobytes() for a in arrays]
+    elif encoding == DELTA_INT16:
+        scales = []
+        deltas = []
+        for a in arrays:
+            max_abs = float(np.max(np.abs(a))) if count else 0.0
+            scale = max(max_abs / MAX_QUANTIZED, MIN_SCALE)
+            q = np.round(a / scale).astype(np.int64)
+            scales.append(scale)
+            deltas.append(np.diff(q, prepend=0).astype('<i2').tobytes())
+        parts.append(np.array(scales, dtype='<f8').tobytes())
+        parts += deltas
+    else:
+        raise ValueError('unknown encoding: %s' % encoding)
+
+    return zlib.compress(b''.join(parts))
+
+
+def unpack_sensor_arrays(data: bytes):
+    """Return the x, y, z and t arrays of a packed sample.
+
+    With FLOAT32 encoding the arrays are read-only views to the
+    decompressed buffer.
+    """
+    buf = zlib.decompress(bytes(data))
+    if len(buf) < HEADER.size:
+        raise InvalidPackedDataError('packed data too short')
+    magic, encoding, count = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise InvalidPackedDataError('invalid magic')
+
+    offset = HEADER.size
+    if encoding == FLOAT32:
+        if len(buf) != offset + 4 * 4 * count:
+            raise InvalidPackedDataError('invalid packed data length')
+        return tuple(
+            np.frombuffer(buf, dtype='<f4', count=count, offset=offset + i * 4 * count)
+            for i in range(len(COLUMNS))
+        )
+    elif encoding == DELTA_INT16:
+        if len(buf) != offset + 8 * 4 + 4 * 2 * count:
+            raise InvalidPackedDataError('invalid packed data length')
+        scales = np.frombuffer(buf, dtype='<f8', count=4, offset=offset)
+        offset += 8 * 4
+        out = []
+        for i in range(len(COLUMNS)):
+            deltas = np.frombuffer(buf, dtype='<i2', count=count, offset=offset + i * 2 * count)
+            out.append(np.cumsum(deltas, dtype=np.int64) * scales[i])
+        return tuple(out)
+
+    raise InvalidPackedDataError('unknown encoding: %s' % encoding)
@@ -1,11 +1,14 @@
 from datetime import timedelta
 import logging
-from celery import shared_task
+from celery import group, shared_task
+from django.conf import settings
 from django.utils import timezone
 from django.db import connection
 
 from trips.models import LegLocation
 
+from .archive import get_archive
+from .buffer import ingest_buffer
 from .processor import EventProcessor
 from .models import Location, ReceiveData, SensorSample
 
@@ -16,8 +19,44 @@ processor = EventProcessor()
 
 @shared_task
 def ingest_events():
-    logger.info('Processing events')
-    processor.process_events()
+    n_shards = settings.INGEST_SHARDS
+    if n_shards <= 1:
+        logger.info('Processing events')
+        processor.process_claimed_events()
+        return
+
+    logger.info('Processing events in %d shards' % n_shards)
+    group(ingest_events_shard.s(shard, n_shards) for shard in range(n_shards)).apply_async()
+
+
+@shared_task
+def ingest_events_shard(shard, n_shards):
+    logger.info('Processing events for shard %d/%d' % (shard, n_shards))
+    processor.process_claimed_events(shard=shard, n_shards=n_shards)
+
+
+@shared_task
+def flush_ingest_buffer():
+    logger.info('Flushing ingest buffer')
+    ingest_buffer.flush()
+
+
+@shared_task
+def archive_received_data():
+    archive = get_archive()
+    if archive is None:
+        return
+    logger.info('Archiving processed events')
+    archive.archive_processed()
+
+
+@shared_task
+def delete_archived_device_data(uuid):
+    archive = get_archive()
+    if archive is None:
+        return
+    logger.info('Deleting archived events of %s' % uuid)
+    archive.delete_uuid(uuid)
 
 
 @shared_task
@@ -36,6 +75,11 @@ def cleanup():
 
     # Clean up ingest buffers
     two_weeks_ago = timezone.now() - timedelta(days=14)
+    archive = get_archive()
+    if archive is not None:
+        ret = archive.expire(two_weeks_ago)
+        logger.info('Ingest archive segments cleaned: %d' % ret)
+    # With the archive enabled, only events that never got processed remain here
     ret = ReceiveData.objects.filter(received_at__lte=two_weeks_ago).delete()
     logger.info('Ingest receive data cleaned: %s' % str(ret))
 
@@ -0,0 +1,15 @@
+import pytest
+
+from trips.models import Device
+from trips_ingest.device_cache import device_cache
+
+
+@pytest.fixture
+def delete_cached_device():
+    """Delete a device but keep it in the device cache, as another process would."""
+    def func(device):
+        cached_dev = device_cache.get(device.uuid)
+        Device.objects.filter(id=device.id).delete()
+        device_cache._set_local(str(device.uuid), cached_dev)
+    yield func
+    device_cache.clear()
@@ -0,0 +1,72 @@
+import importlib
+import json
+
+import pytest
+from django.test import Client
+from django.urls import clear_url_caches
+
+from mocaf import urls
+from trips_ingest.buffer import ingest_buffer
+from trips_ingest.device_cache import device_cache
+from trips_ingest.models import ReceiveData
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def buffered_ingest(settings, monkeypatch):
+    """Route /v1/ingest/ to the buffered view and collect the appended uploads."""
+    appended = []
+
+    def append(data, received_at, payload=None):
+        appended.append((data, payload))
+
+    monkeypatch.setattr(ingest_buffer, 'append', append)
+    original = settings.INGEST_BUFFER_ENABLED
+    settings.INGEST_BUFFER_ENABLED = True
+    importlib.reload(urls)
+    clear_url_caches()
+    yield appended
+    settings.INGEST_BUFFER_ENABLED = original
+    importlib.reload(urls)
+    clear_url_caches()
+
+
+def test_buffered_ingest_view(buffered_ingest, uuid):
+    data = {
+        'location': [{
+            'timestamp': '2021-05-01T12:00:00.000Z',
+            'coords': {'latitude': 60.17, 'longitude': 24.94, 'accuracy': 10},
+            'extras': {'uid': uuid},
+        }],
+    }
+    client = Client(enforce_csrf_checks=True)
+    response = client.post('/v1/ingest/', data=json.dumps(data), content_type='application/json')
+    assert response.status_code == 200
+    assert response.json()['ok']
+    assert buffered_ingest == [(data, None)]
+
+
+def test_buffered_ingest_view_rejects_invalid_json(buffered_ingest):
+    client = Client(enforce_csrf_checks=True)
+    response = client.post('/v1/ingest/', data='{', content_type='application/json')
+    assert response.status_code == 400
+    assert buffered_ingest == []
+
+
+def test_ingest_view_saves_upload_of_deleted_cached_device(device, delete_cached_device):
+    uuid = str(device.uuid)
+    delete_cached_device(device)
+    data = {
+        'location': [{
+            'timestamp': '2021-05-01T12:00:00.000Z',
+            'coords': {'latitude': 60.17, 'longitude': 24.94, 'accuracy': 10},
+            'extras': {'uid': uuid},
+        }],
+    }
+    response = Client().post('/v1/ingest/', data=json.dumps(data), content_type='application/json')
+    assert response.status_code == 200
+    obj = ReceiveData.objects.get()
+    assert obj.get_uuid() == uuid
+    assert obj.device_id is None
+    assert device_cache.get(uuid) is None
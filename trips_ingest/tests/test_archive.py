@@ -0,0 +1,138 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from django.utils.timezone import make_aware, utc
+
+from trips_ingest.archive import SegmentArchive
+from trips_ingest.models import ReceiveData
+
+UUIDS = ['00000000-0000-0000-0000-000000000001', '00000000-0000-0000-0000-000000000002']
+START_TIME = make_aware(datetime(2021, 5, 1, 12, 0), utc)
+
+
+def make_events(n_hours=3, per_hour=4):
+    events = []
+    for i in range(n_hours * per_hour):
+        received_at = START_TIME + timedelta(minutes=60 * (i // per_hour) + i % per_hour)
+        uuid = UUIDS[i % 2]
+        events.append(ReceiveData(
+            id=i + 1,
+            data=dict(dataType='heartbeat', userId=uuid, seq=i),
+            payload=b'payload-%d' % i if i % 3 == 0 else None,
+            received_at=received_at,
+            imported_at=received_at + timedelta(minutes=1),
+            import_failed=False,
+        ))
+    return events
+
+
+def event_fields(event):
+    payload = bytes(event.payload) if event.payload is not None else None
+    return (event.id, event.data, payload, event.device_id, event.received_at, event.imported_at, event.import_failed)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    return SegmentArchive(str(tmp_path / 'archive'))
+
+
+def test_archive_round_trip(archive):
+    events = make_events()
+    archive.write_events(events[:5])
+    archive.write_events(events[5:])
+    assert len(archive.list_segments()) == 3
+    assert [event_fields(e) for e in archive.iter_events()] == [event_fields(e) for e in events]
+
+    uuid_events = [e for e in events if e.get_uuid() == UUIDS[0]]
+    assert [e.id for e in archive.iter_events(uuid=UUIDS[0])] == [e.id for e in uuid_events]
+    start = START_TIME + timedelta(minutes=61)
+    end = START_TIME + timedelta(minutes=121)
+    assert [e.id for e in archive.iter_events(start=start, end=end)] == [
+        e.id for e in events if start <= e.received_at <= end
+    ]
+
+    archive.delete_uuid(UUIDS[0])
+    assert [event_fields(e) for e in archive.iter_events()] == [
+        event_fields(e) for e in events if e.get_uuid() != UUIDS[0]
+    ]
+    assert not [fn for fn in os.listdir(archive.path) if fn.endswith('.tmp')]
+
+    assert archive.expire(START_TIME + timedelta(hours=1)) == 1
+    assert [e.id for e in archive.iter_events()] == [
+        e.id for e in events if e.get_uuid() != UUIDS[0] and e.received_at >= START_TIME + timedelta(hours=1)
+    ]
+
+
+def test_archive_skips_duplicate_events(archive):
+    events = make_events(n_hours=1)
+    archive.write_events(events)
+    archive.write_events(events[:2])
+    assert [e.id for e in archive.iter_events()] == [e.id for e in events]
+
+
+def test_archive_recovers_from_crash_between_replacing_segment_and_index(archive, monkeypatch):
+    events = make_events()
+    archive.write_events(events)
+    remaining = [event_fields(e) for e in events if e.get_uuid() != UUIDS[0]]
+
+    real_replace = os.replace
+
+    def replace(src, dst):
+        if src.endswith('.idx.tmp'):
+            raise OSError('crash')
+        real_replace(src, dst)
+
+    monkeypatch.setattr(os, 'replace', replace)
+    with pytest.raises(OSError):
+        archive.delete_uuid(UUIDS[0])
+    monkeypatch.setattr(os, 'replace', real_replace)
+
+    # The first segment was replaced but its index was not, so its events
+    # cannot be found until the rewrite is finished. The later segments were
+    # not rewritten yet.
+    assert [event_fields(e) for e in archive.iter_events()] == [
+        event_fields(e) for e in events if e.received_at >= START_TIME + timedelta(hours=1)
+    ]
+
+    archive.delete_uuid(UUIDS[0])
+    assert [event_fields(e) for e in archive.iter_events()] == remaining
+    assert not [fn for fn in os.listdir(archive.path) if fn.endswith('.tmp')]
+
+
+def test_archive_removes_files_of_interrupted_rewrite(archive):
+    events = make_events(n_hours=1)
+    archive.write_events(events)
+    hour, seg_path = archive.list_segments()[0]
+    with open(seg_path + '.tmp', 'wb') as f:
+        f.write(b'partial')
+    with open(archive.segment_path(hour, 'idx') + '.tmp', 'w') as f:
+        f.write('partial')
+
+    assert archive.expire(START_TIME) == 0
+    assert not [fn for fn in os.listdir(archive.path) if fn.endswith('.tmp')]
+    assert [event_fields(e) for e in archive.iter_events()] == [event_fields(e) for e in events]
+
+
+@pytest.mark.django_db
+def test_archive_processed(archive, device):
+    uuid = str(device.uuid)
+    objs = []
+    for i in range(5):
+        received_at = START_TIME + timedelta(minutes=i)
+        objs.append(ReceiveData.objects.create(
+            data=dict(dataType='heartbeat', userId=uuid, seq=i),
+            device=device,
+            received_at=received_at,
+            imported_at=received_at if i < 4 else None,
+            import_failed=False if i < 4 else None,
+        ))
+
+    assert archive.archive_processed(batch_size=3) == 4
+    assert list(ReceiveData.objects.values_list('id', flat=True)) == [objs[4].id]
+    archived = list(archive.iter_events(uuid=uuid))
+    assert [e.id for e in archived] == [obj.id for obj in objs[:4]]
+    assert all(e.device_id == device.id for e in archived)
+
+    archive.delete_uuid(uuid)
+    assert list(archive.iter_events()) == []
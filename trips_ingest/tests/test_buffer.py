@@ -0,0 +1,143 @@
+from datetime import datetime
+
+import pytest
+from django.utils.timezone import make_aware, utc
+
+from trips.tests.factories import DeviceFactory
+from trips_ingest.buffer import IngestBuffer
+from trips_ingest.models import ReceiveData
+
+pytestmark = pytest.mark.django_db
+
+RECEIVED_AT = make_aware(datetime(2021, 5, 1, 12, 0), utc)
+
+
+class FakeLock:
+    def acquire(self, blocking=True):
+        return True
+
+    def reacquire(self):
+        pass
+
+    def release(self):
+        pass
+
+
+class FakeRedis:
+    """The subset of the Redis stream commands that IngestBuffer uses."""
+
+    def __init__(self):
+        self.streams = {}
+        self.pending = []
+        self.last_delivered = 0
+        self.next_id = 1
+
+    def xadd(self, name, fields):
+        entry_id = b'%d-0' % self.next_id
+        self.next_id += 1
+        fields = {
+            k.encode() if isinstance(k, str) else k: v.encode() if isinstance(v, str) else v
+            for k, v in fields.items()
+        }
+        self.streams.setdefault(name, []).append((entry_id, fields))
+        return entry_id
+
+    def xgroup_create(self, name, group, id='0', mkstream=False):
+        self.streams.setdefault(name, [])
+
+    def xreadgroup(self, group, consumer, streams, count=None):
+        (name, start_id), = streams.items()
+        entries = self.streams[name]
+        if start_id == '0':
+            result = [entry for entry in entries if entry[0] in self.pending]
+        else:
+            result = entries[self.last_delivered:]
+        result = result[:count]
+        if start_id != '0':
+            self.last_delivered += len(result)
+            self.pending += [entry_id for entry_id, _ in result]
+        if not result:
+            return []
+        return [[name, result]]
+
+    def xack(self, name, group, *entry_ids):
+        self.pending = [entry_id for entry_id in self.pending if entry_id not in entry_ids]
+
+    def xdel(self, name, *entry_ids):
+        entries = self.streams[name]
+        delivered = entries[:self.last_delivered]
+        self.last_delivered -= len([entry for entry in delivered if entry[0] in entry_ids])
+        self.streams[name] = [entry for entry in entries if entry[0] not in entry_ids]
+
+    def lock(self, name, timeout=None):
+        return FakeLock()
+
+
+@pytest.fixture
+def buffer():
+    buf = IngestBuffer(url=None, stream_name='test-ingest')
+    buf._redis = FakeRedis()
+    return buf
+
+
+def heartbeat(uuid, **extra):
+    return dict(dataType='heartbeat', userId=uuid, **extra)
+
+
+def test_flush_saves_buffered_entries(buffer, device):
+    uuid = str(device.uuid)
+    for i in range(5):
+        buffer.append(heartbeat(uuid, seq=i), RECEIVED_AT)
+    buffer.append(dict(dataType='location_batch', uid=uuid), RECEIVED_AT, payload=b'\x01\x02')
+
+    assert buffer.flush(batch_size=2) == 6
+    objs = list(ReceiveData.objects.order_by('id'))
+    assert [obj.data.get('seq') for obj in objs] == [0, 1, 2, 3, 4, None]
+    assert all(obj.device_id == device.id for obj in objs)
+    assert objs[-1].payload.tobytes() == b'\x01\x02'
+    assert buffer.redis.streams['test-ingest'] == []
+    assert buffer.redis.pending == []
+    assert buffer.flush() == 0
+
+
+def test_flush_moves_failing_entries_to_dead_letter_stream(buffer, device):
+    uuid = str(device.uuid)
+    buffer.append(heartbeat(uuid, seq=0), RECEIVED_AT)
+    # orjson accepts NUL characters, but jsonb does not
+    buffer.append(heartbeat(uuid, seq=1, note='a\u0000b'), RECEIVED_AT)
+    buffer.redis.xadd('test-ingest', {'data': b'{', 'received_at': RECEIVED_AT.isoformat()})
+    buffer.append(heartbeat(uuid, seq=2), RECEIVED_AT)
+
+    assert buffer.flush() == 2
+    assert sorted(ReceiveData.objects.values_list('data__seq', flat=True)) == [0, 2]
+    dead = buffer.redis.streams['test-ingest:dead']
+    assert len(dead) == 2
+    assert all(b'error' in fields and b'entry_id' in fields for _, fields in dead)
+    # The failing entries do not block later ones
+    assert buffer.redis.streams['test-ingest'] == []
+    buffer.append(heartbeat(uuid, seq=3), RECEIVED_AT)
+    assert buffer.flush() == 1
+
+
+def test_flush_redelivers_unacknowledged_entries(buffer, device):
+    uuid = str(device.uuid)
+    buffer.append(heartbeat(uuid, seq=0), RECEIVED_AT)
+    buffer.ensure_group()
+    # A flush that read the entry but did not get to acknowledge it
+    assert len(buffer.read('>', 10)) == 1
+    buffer.append(heartbeat(uuid, seq=1), RECEIVED_AT)
+
+    assert buffer.flush() == 2
+    assert sorted(ReceiveData.objects.values_list('data__seq', flat=True)) == [0, 1]
+
+
+def test_flush_saves_entries_of_deleted_cached_device(buffer, device, delete_cached_device):
+    other_device = DeviceFactory()
+    buffer.append(heartbeat(str(device.uuid)), RECEIVED_AT)
+    buffer.append(heartbeat(str(other_device.uuid)), RECEIVED_AT)
+    delete_cached_device(device)
+
+    assert buffer.flush() == 2
+    assert ReceiveData.objects.get(device__isnull=True).get_uuid() == str(device.uuid)
+    assert ReceiveData.objects.get(device__isnull=False).device_id == other_device.id
+    assert 'test-ingest:dead' not in buffer.redis.streams
@@ -0,0 +1,101 @@
+import gzip
+import uuid
+import zlib
+
+import numpy as np
+import pytest
+import zstandard
+
+from trips_ingest import location_batch
+from trips_ingest.location_batch import (
+    MAGIC, BodyTooLargeError, InvalidBatchError, UnsupportedEncodingError, decode_location_batch, decompress_body,
+    encode_location_batch, parse_upload
+)
+
+
+UID = uuid.UUID('12345678-1234-5678-1234-567812345678')
+
+
+@pytest.fixture
+def columns():
+    return {
+        'time': np.array([1620000000.0, 1620000005.5, 1620000011.0]),
+        'lon': np.array([24.94, 24.95, 24.96]),
+        'lat': np.array([60.17, 60.18, 60.19]),
+        'accuracy': np.array([5.0, np.nan, 12.5]),
+        'speed': np.array([1.5, 2.0, np.nan]),
+        'heading': np.array([90.0, 180.0, 270.0]),
+        'odometer': np.array([100.0, 110.0, 120.0]),
+        'atype': np.array([3, 3, 6]),
+        'aconf': np.array([80, 255, 100]),
+        'is_moving': np.array([1, -1, 0]),
+    }
+
+
+def test_location_batch_round_trip(columns):
+    payload = encode_location_batch(UID, columns)
+    upload = parse_upload(payload)
+    assert upload.uuid == UID
+    assert upload.count == 3
+    assert upload.metadata == {'dataType': 'location_batch', 'uid': str(UID), 'count': 3}
+
+    decoded = decode_location_batch(payload)
+    for name, _ in location_batch.COLUMNS:
+        np.testing.assert_array_equal(decoded[name], np.asarray(columns[name], dtype=decoded[name].dtype))
+
+
+def test_empty_location_batch(columns):
+    payload = encode_location_batch(UID, {name: vals[:0] for name, vals in columns.items()})
+    assert parse_upload(payload).count == 0
+    assert len(decode_location_batch(payload)['time']) == 0
+
+
+def test_location_batch_rejects_invalid_payloads(columns):
+    payload = encode_location_batch(UID, columns)
+    with pytest.raises(InvalidBatchError):
+        parse_upload(payload[:10])
+    with pytest.raises(InvalidBatchError):
+        parse_upload(b'XXXX' + payload[len(MAGIC):])
+    with pytest.raises(InvalidBatchError):
+        parse_upload(payload[:-1])
+    with pytest.raises(InvalidBatchError):
+        parse_upload(payload + b'\0')
+
+    columns['lat'] = columns['lat'][:2]
+    with pytest.raises(InvalidBatchError):
+        encode_location_batch(UID, columns)
+
+
+@pytest.mark.parametrize('encoding, compress', [
+    ('gzip', gzip.compress),
+    ('zstd', zstandard.ZstdCompressor().compress),
+])
+def test_decompress_body(encoding, compress, columns):
+    payload = encode_location_batch(UID, columns)
+    assert decompress_body(compress(payload), encoding) == payload
+    assert decompress_body(compress(payload), encoding.upper()) == payload
+
+
+def test_decompress_body_identity():
+    assert decompress_body(b'abc', None) == b'abc'
+    assert decompress_body(b'abc', 'identity') == b'abc'
+    with pytest.raises(UnsupportedEncodingError):
+        decompress_body(b'abc', 'br')
+
+
+@pytest.mark.parametrize('encoding, compress', [
+    ('gzip', gzip.compress),
+    ('zstd', zstandard.ZstdCompressor().compress),
+    ('zstd', zstandard.ZstdCompressor(write_content_size=False).compress),
+])
+def test_decompress_body_size_limit(monkeypatch, encoding, compress):
+    monkeypatch.setattr(location_batch, 'MAX_DECOMPRESSED_SIZE', 1000)
+    assert len(decompress_body(compress(b'\0' * 1000), encoding)) == 1000
+    with pytest.raises(BodyTooLargeError):
+        decompress_body(compress(b'\0' * 1001), encoding)
+
+
+def test_decompress_body_truncated_gzip():
+    body = gzip.compress(b'x' * 1000)
+    with pytest.raises(zlib.error):
+        decompress_body(body[:len(body) // 2], 'gzip')
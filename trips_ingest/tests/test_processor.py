@@ -0,0 +1,205 @@
+from datetime import timedelta
+from uuid import uuid4
+
+import pytest
+from django.db import transaction
+from django.utils import timezone
+
+from trips_ingest.models import DeviceHeartbeat, Location, ReceiveData, SensorSample
+from trips_ingest.processor import EventProcessor
+
+pytestmark = pytest.mark.django_db
+
+
+def make_location(uuid, time, **coords):
+    return {
+        'timestamp': time.isoformat(),
+        'coords': dict(dict(latitude=60.17, longitude=24.94, accuracy=10), **coords),
+        'activity': {'type': 'walking', 'confidence': 80},
+        'extras': {'uid': uuid},
+        'is_moving': True,
+    }
+
+
+def make_location_event(uuid, times, **coords):
+    return ReceiveData.objects.create(
+        data={'location': [make_location(uuid, time, **coords) for time in times]},
+        received_at=timezone.now(),
+    )
+
+
+def location_times(uuid):
+    return list(Location.objects.filter(uuid=uuid).order_by('time').values_list('time', flat=True))
+
+
+def test_process_location_event_drops_duplicates_within_batch(uuid):
+    start = timezone.now().replace(microsecond=0) - timedelta(hours=1)
+    times = [start, start, start + timedelta(seconds=0.2), start + timedelta(seconds=5)]
+    EventProcessor().process_event(make_location_event(uuid, times))
+    assert location_times(uuid) == [start, start + timedelta(seconds=5)]
+
+
+def test_process_location_event_drops_only_existing_samples(uuid):
+    start = timezone.now().replace(microsecond=0) - timedelta(hours=1)
+    processor = EventProcessor()
+    processor.process_event(make_location_event(uuid, [start, start + timedelta(seconds=5)]))
+
+    # One sample is already stored and one is near a stored one, but the
+    # rest of the event is still saved
+    times = [
+        start, start + timedelta(seconds=5.3), start + timedelta(seconds=10), start + timedelta(seconds=15)
+    ]
+    processor.process_event(make_location_event(uuid, times))
+    assert location_times(uuid) == [
+        start, start + timedelta(seconds=5), start + timedelta(seconds=10), start + timedelta(seconds=15)
+    ]
+
+
+def test_insert_locations_ignores_conflicting_rows(uuid):
+    start = timezone.now().replace(microsecond=0) - timedelta(hours=1)
+    event = make_location_event(uuid, [start, start + timedelta(seconds=5)])
+    processor = EventProcessor()
+
+    def make_rows():
+        rows = [processor.location_to_row(event, loc) for loc in event.data['location']]
+        processor.transform_location_coords(rows)
+        return rows
+
+    processor.insert_locations(make_rows()[:1])
+    # The duplicate check is bypassed, so the first row conflicts
+    processor.insert_locations(make_rows())
+    assert location_times(uuid) == [start, start + timedelta(seconds=5)]
+
+
+def test_process_location_event_stores_all_fields(uuid):
+    time = timezone.now().replace(microsecond=0) - timedelta(hours=1)
+    event = make_location_event(
+        uuid, [time], altitude=25.5, altitude_accuracy=3.5, speed=1.5, speed_accuracy=0.5,
+        heading=90, heading_accuracy=10,
+    )
+    EventProcessor().process_event(event)
+    loc = Location.objects.get(uuid=uuid)
+    assert loc.time == time
+    assert loc.created_at == event.received_at
+    assert (loc.altitude, loc.altitude_error) == (25.5, 3.5)
+    assert (loc.speed, loc.speed_error) == (1.5, 0.5)
+    assert (loc.heading, loc.heading_error) == (90, 10)
+    assert (loc.atype, loc.aconf, loc.loc_error) == ('walking', 80, 10)
+    assert loc.is_moving
+    assert not loc.debug
+
+
+def make_heartbeat_event(uuid, time):
+    return ReceiveData.objects.create(
+        data=dict(dataType='heartbeat', userId=str(uuid), time=time.timestamp() * 1000),
+        received_at=timezone.now(),
+    )
+
+
+def test_shards_claim_disjoint_events():
+    start = timezone.now().replace(microsecond=0) - timedelta(hours=1)
+    uuids = [uuid4() for _ in range(20)]
+    events = [make_heartbeat_event(uid, start + timedelta(seconds=i)) for uid in uuids for i in range(3)]
+    processor = EventProcessor()
+
+    with transaction.atomic():
+        claimed = [processor.claim_events(shard, 2, 1000) for shard in range(2)]
+    ids = [set(event.id for event in shard_events) for shard_events in claimed]
+    assert ids[0] and ids[1]
+    assert not ids[0] & ids[1]
+    assert ids[0] | ids[1] == set(event.id for event in events)
+    # All events of a device go to the same shard
+    shard_uuids = [set(event.get_uuid() for event in shard_events) for shard_events in claimed]
+    assert not shard_uuids[0] & shard_uuids[1]
+
+
+def test_process_claimed_events_marks_every_event():
+    start = timezone.now().replace(microsecond=0) - timedelta(hours=1)
+    uuids = [uuid4() for _ in range(10)]
+    for uid in uuids:
+        for i in range(3):
+            make_heartbeat_event(uid, start + timedelta(seconds=i))
+    invalid = ReceiveData.objects.create(
+        data=dict(dataType='heartbeat', userId='not-a-uuid', time=start.timestamp() * 1000),
+        received_at=timezone.now(),
+    )
+
+    processor = EventProcessor()
+    for shard in range(2):
+        processor.process_claimed_events(shard=shard, n_shards=2, batch_size=4)
+
+    assert not ReceiveData.objects.filter(imported_at__isnull=True).exists()
+    assert list(ReceiveData.objects.filter(import_failed=True)) == [invalid]
+    assert DeviceHeartbeat.objects.count() == 30
+
+
+def make_sensor_event(uuid, time, sensor_type='acce'):
+    t0 = time.timestamp() * 1000
+    return ReceiveData.objects.create(
+        data=dict(dataType='sensor2', userId=str(uuid), sensorType=sensor_type, data=[
+            dict(time=t0 + i * 20, x=0.1 * i, y=0.2 * i, z=9.8) for i in range(10)
+        ]),
+        received_at=timezone.now(),
+    )
+
+
+def import_states(events):
+    return [
+        (event.imported_at is not None, event.import_failed)
+        for event in ReceiveData.objects.filter(id__in=[e.id for e in events]).order_by('id')
+    ]
+
+
+def test_process_event_batch_skips_duplicate_heartbeats(uuid):
+    time = timezone.now().replace(microsecond=0) - timedelta(hours=1)
+    processor = EventProcessor()
+    events = [make_heartbeat_event(uuid, time), make_heartbeat_event(uuid, time)]
+    assert processor.process_event_batch(events) == (2, 0)
+    events.append(make_heartbeat_event(uuid, time))
+    assert processor.process_event_batch(events[2:]) == (1, 0)
+
+    assert list(DeviceHeartbeat.objects.filter(uuid=uuid).values_list('time', flat=True)) == [time]
+    assert import_states(events) == [(True, False)] * 3
+
+
+def test_process_event_batch_skips_sensor_samples_within_window(uuid):
+    time = timezone.now().replace(microsecond=0) - timedelta(hours=1)
+    processor = EventProcessor()
+    events = [
+        make_sensor_event(uuid, time),
+        make_sensor_event(uuid, time + timedelta(seconds=0.5)),
+        make_sensor_event(uuid, time, sensor_type='gyro'),
+    ]
+    assert processor.process_event_batch(events) == (3, 0)
+    events = [
+        make_sensor_event(uuid, time - timedelta(seconds=0.8)),
+        make_sensor_event(uuid, time + timedelta(seconds=3)),
+    ]
+    assert processor.process_event_batch(events) == (2, 0)
+
+    samples = SensorSample.objects.filter(uuid=uuid).order_by('type', 'time')
+    assert [(s.type, s.time) for s in samples] == [
+        ('acce', time), ('acce', time + timedelta(seconds=3)), ('gyro', time)
+    ]
+    x, y, z, t = samples[0].get_arrays()
+    assert len(x) == 10
+    assert t[-1] == pytest.approx(0.18)
+
+
+def test_failed_upsert_flush_marks_its_events_failed(uuid, monkeypatch):
+    time = timezone.now().replace(microsecond=0) - timedelta(hours=1)
+    processor = EventProcessor()
+
+    def insert_heartbeats(rows):
+        raise Exception('insert failed')
+
+    monkeypatch.setattr(processor, 'insert_heartbeats', insert_heartbeats)
+    events = [
+        make_heartbeat_event(uuid, time),
+        make_sensor_event(uuid, time),
+        make_heartbeat_event(uuid, time + timedelta(seconds=10)),
+    ]
+    assert processor.process_event_batch(events) == (1, 2)
+    assert import_states(events) == [(True, True), (True, False), (True, True)]
+    assert SensorSample.objects.filter(uuid=uuid).count() == 1
+    assert not DeviceHeartbeat.objects.exists()
@@ -0,0 +1,136 @@
+import importlib
+import zlib
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import numpy as np
+import pytest
+from django.apps import apps
+from django.utils.timezone import make_aware, utc
+
+from trips_ingest.models import SensorSample
+from trips_ingest.sensor_packing import (
+    DELTA_INT16, FLOAT32, HEADER, MAX_QUANTIZED, InvalidPackedDataError, pack_sensor_arrays, unpack_sensor_arrays
+)
+
+TIME = make_aware(datetime(2021, 5, 1, 12, 0), utc)
+
+pack_migration = importlib.import_module('trips_ingest.migrations.0017_pack_sensor_samples')
+
+
+def make_arrays(n=50, seed=0):
+    rng = np.random.default_rng(seed)
+    x, y, z = rng.normal(0, 3, (3, n))
+    return x, y, z + 9.81, np.arange(n) * 0.02
+
+
+def packed_encoding(data):
+    return HEADER.unpack_from(zlib.decompress(data))[1]
+
+
+def test_float32_round_trip():
+    arrays = make_arrays()
+    data = pack_sensor_arrays(*arrays, encoding=FLOAT32)
+    assert packed_encoding(data) == FLOAT32
+    for a, out in zip(arrays, unpack_sensor_arrays(data)):
+        np.testing.assert_array_equal(out, a.astype(np.float32))
+
+
+def test_delta_int16_round_trip():
+    arrays = make_arrays()
+    data = pack_sensor_arrays(*arrays, encoding=DELTA_INT16)
+    assert packed_encoding(data) == DELTA_INT16
+    for a, out in zip(arrays, unpack_sensor_arrays(data)):
+        # The values are within one quantization step; the errors do not
+        # accumulate in the differences
+        np.testing.assert_allclose(out, a, rtol=0, atol=np.max(np.abs(a)) / MAX_QUANTIZED)
+
+
+def test_delta_int16_fits_largest_swings():
+    # Every difference is as large as the quantized values allow
+    x = np.tile([1000.0, -1000.0], 20)
+    arrays = (x, -x, np.zeros(40), np.full(40, 1e-9))
+    out = unpack_sensor_arrays(pack_sensor_arrays(*arrays, encoding=DELTA_INT16))
+    for a, b in zip(arrays, out):
+        np.testing.assert_allclose(b, a, rtol=0, atol=1e-6)
+
+
+def test_delta_int16_falls_back_to_float32_for_non_finite_values():
+    x, y, z, t = make_arrays(10)
+    x[3] = np.nan
+    y[5] = np.inf
+    data = pack_sensor_arrays(x, y, z, t, encoding=DELTA_INT16)
+    assert packed_encoding(data) == FLOAT32
+    for a, out in zip((x, y, z, t), unpack_sensor_arrays(data)):
+        np.testing.assert_array_equal(out, a.astype(np.float32))
+
+
+@pytest.mark.parametrize('encoding', [FLOAT32, DELTA_INT16])
+def test_pack_empty_arrays(encoding):
+    out = unpack_sensor_arrays(pack_sensor_arrays([], [], [], [], encoding=encoding))
+    assert [len(a) for a in out] == [0, 0, 0, 0]
+
+
+def test_pack_rejects_invalid_input():
+    with pytest.raises(ValueError):
+        pack_sensor_arrays([1.0], [1.0], [1.0], [])
+    with pytest.raises(ValueError):
+        pack_sensor_arrays([1.0], [1.0], [1.0], [1.0], encoding=3)
+
+
+def test_unpack_rejects_invalid_data():
+    data = zlib.decompress(pack_sensor_arrays(*make_arrays(10)))
+    with pytest.raises(InvalidPackedDataError):
+        unpack_sensor_arrays(zlib.compress(b'XXXX' + data[4:]))
+    with pytest.raises(InvalidPackedDataError):
+        unpack_sensor_arrays(zlib.compress(data[:-4]))
+    with pytest.raises(InvalidPackedDataError):
+        unpack_sensor_arrays(zlib.compress(data[:8]))
+
+
+@pytest.mark.django_db
+def test_get_arrays_of_packed_and_legacy_samples():
+    arrays = make_arrays(10)
+    uuid = uuid4()
+    packed = SensorSample.objects.create(
+        time=TIME, uuid=uuid, type='acce', packed=pack_sensor_arrays(*arrays),
+    )
+    legacy = SensorSample.objects.create(
+        time=TIME, uuid=uuid, type='gyro', x=arrays[0].tolist(), y=arrays[1].tolist(), z=arrays[2].tolist(),
+        t=arrays[3].tolist(),
+    )
+
+    for a, out in zip(arrays, SensorSample.objects.get(id=packed.id).get_arrays()):
+        np.testing.assert_array_equal(out, a.astype(np.float32))
+    for a, out in zip(arrays, SensorSample.objects.get(id=legacy.id).get_arrays()):
+        assert out.dtype == np.float64
+        np.testing.assert_array_equal(out, a)
+
+
+@pytest.mark.django_db
+def test_pack_migration_round_trip(monkeypatch):
+    monkeypatch.setattr(pack_migration, 'BATCH_SIZE', 2)
+    uuid = uuid4()
+    samples = []
+    for i in range(5):
+        x, y, z, t = make_arrays(10, seed=i)
+        samples.append((x, y, z, t))
+        SensorSample.objects.create(
+            time=TIME + timedelta(seconds=i), uuid=uuid, type='acce',
+            x=x.tolist(), y=y.tolist(), z=z.tolist(), t=t.tolist(),
+        )
+
+    pack_migration.pack_existing_samples(apps, None)
+    objs = list(SensorSample.objects.filter(uuid=uuid).order_by('id'))
+    assert all(obj.packed is not None and obj.x is None for obj in objs)
+    for obj, arrays in zip(objs, samples):
+        # The migration writes the current format
+        for a, out in zip(arrays, unpack_sensor_arrays(obj.packed)):
+            np.testing.assert_array_equal(out, a.astype(np.float32))
+
+    pack_migration.unpack_existing_samples(apps, None)
+    objs = list(SensorSample.objects.filter(uuid=uuid).order_by('id'))
+    assert all(obj.packed is None for obj in objs)
+    for obj, arrays in zip(objs, samples):
+        for a, out in zip(arrays, obj.get_arrays()):
+            np.testing.assert_array_equal(out, a.astype(np.float32))
@@ -0,0 +1,56 @@
+from functools import lru_cache
+from typing import Tuple
+
+import numpy as np
+from django.conf import settings
+from pyproj import Transformer
+
+
+GPS_SRS = 4326
+
+FINLAND_BOUNDS = {
+    'lat': [59.846373196, 70.1641930203],
+    'lon': [20.6455928891, 31.5160921567]
+}
+
+
+@lru_cache(maxsize=None)
+def get_transformer(from_srs: int, to_srs: int) -> Transformer:
+    # Transformer construction is expensive, so reuse them
+    return Transformer.from_crs(from_srs, to_srs, always_xy=True)
+
+
+def gps_to_local(lon, lat, local_srs: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Transform WGS84 lon/lat arrays to local x/y arrays in one call."""
+    if local_srs is None:
+        local_srs = settings.LOCAL_SRS
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    x, y = get_transformer(GPS_SRS, local_srs).transform(lon, lat)
+    return np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+
+
+def local_to_gps(x, y, local_srs: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Transform local x/y arrays to WGS84 lon/lat arrays in one call."""
+    if local_srs is None:
+        local_srs = settings.LOCAL_SRS
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    lon, lat = get_transformer(local_srs, GPS_SRS).transform(x, y)
+    return np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+
+
+def finland_bounds_mask(lon, lat) -> np.ndarray:
+    """Return a boolean mask of the lon/lat pairs that fall inside Finland."""
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    min_lon, max_lon = FINLAND_BOUNDS['lon']
+    min_lat, max_lat = FINLAND_BOUNDS['lat']
+    return (lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat)
+
+
+def valid_local_coords_mask(x, y) -> np.ndarray:
+    """Return a boolean mask of the transformed coordinates that are usable."""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    return np.isfinite(x) & np.isfinite(y) & (x > 0) & (y > 0)